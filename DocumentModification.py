@@ -1,12 +1,91 @@
-from typing import Tuple
+from typing import Dict, Iterable, List, Set, Tuple
 from MetadataManagerCore import Keys
+from MetadataManagerCore.versioning.document_versioning import VersionHistoryWriter, createVersionEntry
 import pymongo
+from pymongo import DeleteOne, InsertOne, ReplaceOne, UpdateOne
 from enum import Enum
+import hashlib
+import json
 
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Keys that are not part of the content hash because they are maintained by the document operations:
+CONTENT_HASH_EXCLUDED_KEYS = set(['_id', Keys.systemIDKey, Keys.systemVersionKey, Keys.collection, Keys.contentHashKey])
+
+def _tagNonJsonValue(value):
+    # Tag the type so e.g. a datetime and its string representation hash differently:
+    return {'$type': type(value).__name__, 'value': str(value)}
+
+def computeContentHash(document: dict) -> str:
+    """
+    Returns a stable hash of the data keys of the document: blake2b over the canonical JSON representation (sorted keys).
+    Equal hashes imply equal data. Different hashes don't necessarily imply different data (e.g. 1 and 1.0).
+    """
+    data = {key: val for key, val in document.items() if not key in CONTENT_HASH_EXCLUDED_KEYS}
+    canonicalJson = json.dumps(data, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=_tagNonJsonValue)
+    return hashlib.blake2b(canonicalJson.encode('utf-8'), digest_size=16).hexdigest()
+
+def createUnchangedDocument(storedFields: dict, dataDict: dict) -> dict:
+    """
+    Returns the full document of an unchanged document from its stored system fields and the data dictionary with the same content hash.
+    """
+    document = {key: val for key, val in dataDict.items() if not key in CONTENT_HASH_EXCLUDED_KEYS}
+    for key in CONTENT_HASH_EXCLUDED_KEYS:
+        if key in storedFields:
+            document[key] = storedFields[key]
+
+    return document
+
+_MISSING = object()
+
+def getPathValue(document: dict, path: str):
+    """
+    Returns the value at the dotted path (like MongoDB's dot notation for nested documents and array indices) or _MISSING.
+    """
+    value = document
+    for part in path.split('.'):
+        if isinstance(value, dict) and part in value:
+            value = value[part]
+        elif isinstance(value, list) and part.isdigit() and int(part) < len(value):
+            value = value[int(part)]
+        else:
+            return _MISSING
+
+    return value
+
+def setPathValue(document: dict, path: str, value):
+    """
+    Sets the value at the dotted path the way $set does. Nested documents and arrays along the path are copied, 
+    so documents sharing them (e.g. the previous version) aren't changed. Missing nested documents are created.
+    """
+    parts = path.split('.')
+    container = document
+    for i, part in enumerate(parts):
+        isLast = i == len(parts) - 1
+        if isinstance(container, list):
+            index = int(part)
+            while len(container) <= index:
+                container.append(None)
+
+            if isLast:
+                container[index] = value
+            else:
+                child = container[index]
+                container[index] = list(child) if isinstance(child, list) else dict(child) if isinstance(child, dict) else dict()
+                container = container[index]
+        else:
+            if isLast:
+                container[part] = value
+            else:
+                child = container.get(part)
+                container[part] = list(child) if isinstance(child, list) else dict(child) if isinstance(child, dict) else dict()
+                container = container[part]
+
+# Projection of the fields needed to detect unchanged documents by their content hash:
+CONTENT_HASH_PROJECTION = {'_id': 1, Keys.systemIDKey: 1, Keys.systemVersionKey: 1, Keys.collection: 1, Keys.contentHashKey: 1}
+
 class DocOpResult(Enum):
     Successful = 1
     MergeConflict = 2
@@ -17,16 +96,24 @@ class DocumentOperation:
     If a document with the given sid exists a new version is created with the specified data defined in a dictionary.
     If it doesn't exist a new document is inserted. Both operations must be applied with applyOperation().
     """
-    def __init__(self, database, collectionName, sid, dataDict):
+    def __init__(self, database, collectionName, sid, dataDict, snapshotInterval: int = 1):
+        """
+        snapshotInterval: Previous versions are stored as full copy every snapshotInterval versions and as reverse patch otherwise.
+                          See versioning.document_versioning.
+        """
         self.sid = sid
+        self.snapshotInterval = snapshotInterval
         self.collectionName = collectionName
         self.collection = database[collectionName]
         self.versionCollection = database[collectionName + Keys.OLD_VERSIONS_COLLECTION_SUFFIX]
         self.dataDict = dataDict
         self.version = 0
-        currentDocument = self.getNewestDocument()
-        if currentDocument != None:
-            self.version = currentDocument[Keys.systemVersionKey]
+        # True if applyOperation inserted a new document (not a new version of an existing document):
+        self.inserted = False
+        # Only the system fields are fetched here, the full document is only needed if it changed:
+        self.storedFields = self.collection.find_one({Keys.systemIDKey:self.sid}, CONTENT_HASH_PROJECTION)
+        if self.storedFields != None:
+            self.version = self.storedFields[Keys.systemVersionKey]
 
     def getId(self, version):
         return self.sid + "_" + str(version)
@@ -41,11 +128,17 @@ class DocumentOperation:
 
         Note: Document operations may only add new data or modify existing data but never remove data. This is an important property because modification dictionaries may be incomplete.
         """
+        # Skip unchanged documents without fetching them if the stored content hash matches:
+        if checkForModifications and self.storedFields != None:
+            storedContentHash = self.storedFields.get(Keys.contentHashKey)
+            if storedContentHash != None and storedContentHash == computeContentHash(self.dataDict):
+                return createUnchangedDocument(self.storedFields, self.dataDict), DocOpResult.Successful
+
         # Get the newest version and check if it matches the expected version
         currentDocument = self.getNewestDocument()
         if currentDocument != None:
             if currentDocument[Keys.systemVersionKey] == self.version:
-                newDict = currentDocument
+                newDict = dict(currentDocument)
 
                 # Do nothing if checkForModifications is true and the documents are identical.
                 if checkForModifications:
@@ -56,18 +149,27 @@ class DocumentOperation:
                             break
 
                     if allDataEntriesEqual:
+                        # Store the missing hash (e.g. of documents written before hashing or by AtomicDocumentOperation) so the next check is cheap:
+                        if newDict.get(Keys.contentHashKey) == None:
+                            newDict[Keys.contentHashKey] = computeContentHash(newDict)
+                            self.collection.update_one({'_id': newDict['_id'], Keys.systemVersionKey: self.version}, 
+                                                       {'$set': {Keys.contentHashKey: newDict[Keys.contentHashKey]}})
+
                         return newDict, DocOpResult.Successful
                     
-                # Move old version to versioning collection:
-                self.versionCollection.replace_one({"_id":currentDocument.get('_id')}, currentDocument, upsert=True)
-                self.collection.delete_one({'_id':(self.getId(self.version))})
-
                 # Apply modifications:
                 for key, val in self.dataDict.items():
                     newDict[key] = val
 
                 newVersion = self.version + 1
                 newDict[Keys.systemVersionKey] = newVersion
+                newDict[Keys.collection] = self.collectionName
+
+                # Move old version to versioning collection:
+                # The version entry _id is sid_version even if the live document has the stable _id (see AtomicDocumentOperation):
+                versionEntry = createVersionEntry(currentDocument, newDict, self.snapshotInterval)
+                self.versionCollection.replace_one({"_id":versionEntry['_id']}, versionEntry, upsert=True)
+                self.collection.delete_one({'_id':currentDocument.get('_id')})
             else:
                 logger.warning("The document with sid " + self.sid + " was modified by a different user.")
                 return None, DocOpResult.MergeConflict
@@ -82,11 +184,320 @@ class DocumentOperation:
         try:
             newDict[Keys.collection] = self.collectionName
             newDict['_id'] = self.getId(newVersion)
+            newDict[Keys.contentHashKey] = computeContentHash(newDict)
             self.collection.insert_one(newDict)
+            self.inserted = currentDocument == None
             return newDict, DocOpResult.Successful
         except pymongo.errors.PyMongoError as e:
             logger.error(str(e))
             return None, DocOpResult.MergeConflict
                 
     def getNewestDocument(self):
-        return self.collection.find_one({Keys.systemIDKey:self.sid})
\ No newline at end of file
+        return self.collection.find_one({Keys.systemIDKey:self.sid})
+
+class BulkDocumentOperation:
+    """
+    Batched counterpart of DocumentOperation. The newest versions of all documents in the batch are prefetched with a single query,
+    unchanged documents are detected in memory and all writes are applied with unordered bulk writes to the live and the versioning collection.
+    If the same sid occurs multiple times in a batch, the data dictionaries are merged in order and applied as a single modification.
+    """
+    def __init__(self, database, collectionName, sidDataPairs: Iterable[Tuple[str, dict]], snapshotInterval: int = 1, contentHashes: Dict[str, dict] = None):
+        """
+        contentHashes: Optional snapshot of the stored content hashes as returned by loadContentHashes(). Unchanged documents in the snapshot
+                       are skipped without any query. The snapshot must be loaded before the documents are modified by others.
+                       applyOperation updates the snapshot with the documents it writes, so it can be reused for following batches.
+        """
+        self.collectionName = collectionName
+        self.contentHashes = contentHashes
+        self.snapshotInterval = snapshotInterval
+        self.collection = database[collectionName]
+        self.versionCollection = database[collectionName + Keys.OLD_VERSIONS_COLLECTION_SUFFIX]
+        self.dataDicts: Dict[str, dict] = dict()
+        # Sids of the documents inserted by applyOperation (not new versions of existing documents):
+        self.insertedSids: Set[str] = set()
+
+        for sid, dataDict in sidDataPairs:
+            self.dataDicts.setdefault(sid, dict()).update(dataDict)
+
+    @staticmethod
+    def getId(sid, version):
+        return sid + "_" + str(version)
+
+    @staticmethod
+    def loadContentHashes(collection, sids: Iterable[str] = None) -> Dict[str, dict]:
+        """
+        Returns the system fields and the content hash of the newest version of the given sids or of all documents if sids is None.
+        """
+        documentFilter = {Keys.systemIDKey: {'$in': list(sids)}} if sids != None else {}
+        return BulkDocumentOperation.getNewestPerSid(collection.find(documentFilter, CONTENT_HASH_PROJECTION))
+
+    @staticmethod
+    def getNewestPerSid(documents: Iterable[dict]) -> Dict[str, dict]:
+        newestDocuments = dict()
+        for document in documents:
+            sid = document[Keys.systemIDKey]
+            newestDocument = newestDocuments.get(sid)
+            if newestDocument == None or newestDocument[Keys.systemVersionKey] < document[Keys.systemVersionKey]:
+                newestDocuments[sid] = document
+
+        return newestDocuments
+
+    def getNewestDocuments(self, sids: Iterable[str] = None) -> Dict[str, dict]:
+        sids = list(sids) if sids != None else list(self.dataDicts.keys())
+        if len(sids) == 0:
+            return dict()
+
+        return BulkDocumentOperation.getNewestPerSid(self.collection.find({Keys.systemIDKey: {'$in': sids}}))
+
+    def findUnchangedDocuments(self) -> Dict[str, dict]:
+        """
+        Returns the documents whose stored content hash matches the content hash of their data dictionary.
+        Uses the content hash snapshot if available and otherwise a projection-only query.
+        """
+        contentHashes = self.contentHashes
+        if contentHashes == None:
+            contentHashes = BulkDocumentOperation.loadContentHashes(self.collection, self.dataDicts.keys())
+
+        unchangedDocuments = dict()
+        for sid, dataDict in self.dataDicts.items():
+            storedFields = contentHashes.get(sid)
+            storedContentHash = storedFields.get(Keys.contentHashKey) if storedFields != None else None
+            if storedContentHash != None and storedContentHash == computeContentHash(dataDict):
+                unchangedDocuments[sid] = createUnchangedDocument(storedFields, dataDict)
+
+        return unchangedDocuments
+
+    def applyOperation(self, checkForModifications) -> Dict[str, Tuple[dict, DocOpResult]]:
+        """
+        Applies the operation for all documents of the batch and returns a dictionary mapping each sid to the same (document, DocOpResult)
+        tuple DocumentOperation.applyOperation() would return. Sids with a merge conflict are mapped to (None, DocOpResult.MergeConflict).
+        """
+        results: Dict[str, Tuple[dict, DocOpResult]] = dict()
+        if len(self.dataDicts) == 0:
+            return results
+
+        # Unchanged documents are detected by their content hashes, only the remaining documents are fetched:
+        unchangedDocuments = self.findUnchangedDocuments() if checkForModifications else dict()
+        for sid, document in unchangedDocuments.items():
+            results[sid] = (document, DocOpResult.Successful)
+
+        currentDocuments = self.getNewestDocuments(sid for sid in self.dataDicts.keys() if not sid in unchangedDocuments)
+        versionRequests = []
+        versionRequestSids: List[str] = []
+        # The live requests are written after the previous versions were stored:
+        liveRequestsPerSid: Dict[str, list] = dict()
+        insertedDocumentSids: List[str] = []
+        hashedSids = []
+
+        for sid, dataDict in self.dataDicts.items():
+            if sid in unchangedDocuments:
+                continue
+
+            currentDocument = currentDocuments.get(sid)
+            if currentDocument != None:
+                version = currentDocument[Keys.systemVersionKey]
+
+                # Do nothing if checkForModifications is true and the documents are identical.
+                if checkForModifications and all(key in currentDocument and currentDocument[key] == val for key, val in dataDict.items()):
+                    # Store the missing hash so the document is detected as unchanged by its hash next time:
+                    if currentDocument.get(Keys.contentHashKey) == None:
+                        currentDocument[Keys.contentHashKey] = computeContentHash(currentDocument)
+                        liveRequestsPerSid[sid] = [UpdateOne({'_id': currentDocument['_id'], Keys.systemVersionKey: version}, 
+                                                             {'$set': {Keys.contentHashKey: currentDocument[Keys.contentHashKey]}})]
+                        hashedSids.append(sid)
+
+                    results[sid] = (currentDocument, DocOpResult.Successful)
+                    continue
+
+                newDict = dict(currentDocument)
+                newDict.update(dataDict)
+                newVersion = version + 1
+                newDict[Keys.systemVersionKey] = newVersion
+                newDict[Keys.collection] = self.collectionName
+
+                # Move old version to versioning collection:
+                versionEntry = createVersionEntry(currentDocument, newDict, self.snapshotInterval)
+                versionRequests.append(ReplaceOne({"_id": versionEntry['_id']}, versionEntry, upsert=True))
+                versionRequestSids.append(sid)
+                liveRequestsPerSid[sid] = [DeleteOne({'_id': currentDocument.get('_id'), Keys.systemVersionKey: version})]
+            else:
+                newDict = dict(dataDict)
+                newDict[Keys.systemIDKey] = sid
+                newVersion = 0
+                self.insertedSids.add(sid)
+
+            newDict[Keys.systemVersionKey] = newVersion
+            newDict[Keys.collection] = self.collectionName
+            newDict['_id'] = self.getId(sid, newVersion)
+            newDict[Keys.contentHashKey] = computeContentHash(newDict)
+
+            liveRequestsPerSid.setdefault(sid, []).append(InsertOne(newDict))
+            insertedDocumentSids.append(sid)
+            results[sid] = (newDict, DocOpResult.Successful)
+
+        if len(versionRequests) > 0:
+            try:
+                self.versionCollection.bulk_write(versionRequests, ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                # Like DocumentOperation, the live document isn't modified if its previous version couldn't be stored:
+                for writeError in e.details.get('writeErrors', []):
+                    logger.error(writeError.get('errmsg'))
+                    sid = versionRequestSids[writeError.get('index')]
+                    results[sid] = (None, DocOpResult.MergeConflict)
+                    liveRequestsPerSid.pop(sid, None)
+
+        liveRequests = []
+        insertRequestSids: Dict[int, str] = dict()
+        for sid, requests in liveRequestsPerSid.items():
+            for request in requests:
+                if isinstance(request, InsertOne):
+                    insertRequestSids[len(liveRequests)] = sid
+
+                liveRequests.append(request)
+
+        # Note: Just like in DocumentOperation a race-condition is possible. If another writer inserted the same version first
+        # the insert fails with a duplicate key error which is reported as merge conflict for the affected sid.
+        if len(liveRequests) > 0:
+            try:
+                self.collection.bulk_write(liveRequests, ordered=False)
+            except pymongo.errors.BulkWriteError as e:
+                for writeError in e.details.get('writeErrors', []):
+                    logger.error(writeError.get('errmsg'))
+                    sid = insertRequestSids.get(writeError.get('index'))
+                    if sid != None:
+                        results[sid] = (None, DocOpResult.MergeConflict)
+                        self.insertedSids.discard(sid)
+
+        # Keep the snapshot up to date, otherwise later batches with the same sids would compare against outdated hashes:
+        if self.contentHashes != None:
+            for sid in insertedDocumentSids + hashedSids:
+                document, result = results[sid]
+                if result == DocOpResult.Successful:
+                    self.contentHashes[sid] = {key: document[key] for key in CONTENT_HASH_PROJECTION if key in document}
+
+        return results
+
+
+class AtomicDocumentOperation:
+    """
+    Optimistic-concurrency counterpart of DocumentOperation. The live document is kept at the stable _id sid
+    and modified with a single find_one_and_update that sets the data and increments the version.
+    If an expected version is given, the update only applies if the live document still has this version.
+    Otherwise concurrent modifications of different keys never conflict.
+
+    The previous version is returned by the update and written to the versioning collection by a VersionHistoryWriter.
+    Documents stored with the legacy _id sid_version are migrated to the stable _id on their first atomic modification.
+
+    Note: Keys of the data dictionary are applied with $set, so keys containing dots address nested fields (see setPathValue).
+    """
+    maxAttempts = 5
+
+    def __init__(self, database, collectionName, sid, dataDict, historyWriter: VersionHistoryWriter, snapshotInterval: int = 1, expectedVersion: int = None):
+        self.sid = sid
+        self.collectionName = collectionName
+        self.collection = database[collectionName]
+        # The system fields are maintained by the operation. Setting them as well would conflict with the version increment:
+        self.dataDict = {key: val for key, val in dataDict.items() if not key in CONTENT_HASH_EXCLUDED_KEYS}
+        self.historyWriter = historyWriter
+        self.snapshotInterval = snapshotInterval
+        self.expectedVersion = expectedVersion
+        # True if applyOperation inserted a new document:
+        self.inserted = False
+
+    def getUpdateFilter(self, checkForModifications, pinnedVersion: int = None) -> dict:
+        """
+        pinnedVersion: Version of a document that was compared in python and is known to change. The update only applies to this version
+                       and doesn't repeat the comparison in the query.
+        """
+        updateFilter = {'_id': self.sid}
+        if pinnedVersion != None:
+            updateFilter[Keys.systemVersionKey] = pinnedVersion
+            return updateFilter
+
+        if self.expectedVersion != None:
+            updateFilter[Keys.systemVersionKey] = self.expectedVersion
+
+        # Documents that already contain the data don't match, so unchanged documents aren't modified.
+        # The query misses some changes (e.g. setting a missing key to None or an array to one of its elements), 
+        # these are detected by the python comparison and applied with a pinned version:
+        if checkForModifications and len(self.dataDict) > 0:
+            updateFilter['$or'] = [{key: {'$ne': val}} for key, val in self.dataDict.items()]
+
+        return updateFilter
+
+    def applyOperation(self, checkForModifications) -> Tuple[dict, DocOpResult]:
+        """
+        Applies the document operation with a single round trip if the document exists with the stable _id.
+        Returns the same tuple as DocumentOperation.applyOperation().
+        """
+        setEntries = dict(self.dataDict)
+        setEntries[Keys.collection] = self.collectionName
+        # The content hash of the modified document is unknown without reading it first, so it is removed.
+        # Unchanged documents without a hash are detected by comparing their data.
+        update = {'$set': setEntries, '$inc': {Keys.systemVersionKey: 1}, '$unset': {Keys.contentHashKey: ''}}
+
+        pinnedVersion = None
+        for _ in range(AtomicDocumentOperation.maxAttempts):
+            previousDocument = self.collection.find_one_and_update(self.getUpdateFilter(checkForModifications, pinnedVersion), update, 
+                                                                   return_document=pymongo.ReturnDocument.BEFORE)
+            if previousDocument != None:
+                newDocument = dict(previousDocument)
+                for key, val in setEntries.items():
+                    setPathValue(newDocument, key, val)
+
+                newDocument.pop(Keys.contentHashKey, None)
+                newDocument[Keys.systemVersionKey] = previousDocument[Keys.systemVersionKey] + 1
+
+                versionEntry = createVersionEntry(previousDocument, newDocument, self.snapshotInterval)
+                self.historyWriter.write(self.collectionName, versionEntry)
+                return newDocument, DocOpResult.Successful
+
+            # Uncommon cases: The document doesn't exist, is stored with the legacy _id, has a different version or is unchanged.
+            currentDocument = self.collection.find_one({Keys.systemIDKey: self.sid})
+            if currentDocument == None:
+                if self.expectedVersion != None:
+                    logger.warning(f"The document with sid {self.sid} was expected at version {self.expectedVersion} but doesn't exist.")
+                    return None, DocOpResult.MergeConflict
+
+                newDocument = dict()
+                for key, val in self.dataDict.items():
+                    setPathValue(newDocument, key, val)
+
+                newDocument['_id'] = self.sid
+                newDocument[Keys.systemIDKey] = self.sid
+                newDocument[Keys.systemVersionKey] = 0
+                newDocument[Keys.collection] = self.collectionName
+                newDocument[Keys.contentHashKey] = computeContentHash(newDocument)
+                try:
+                    self.collection.insert_one(newDocument)
+                    self.inserted = True
+                    return newDocument, DocOpResult.Successful
+                except pymongo.errors.DuplicateKeyError:
+                    # Inserted concurrently, apply the modification to the inserted document:
+                    continue
+            elif currentDocument['_id'] != self.sid:
+                self.migrateLegacyDocument(currentDocument)
+            elif self.expectedVersion != None and currentDocument[Keys.systemVersionKey] != self.expectedVersion:
+                logger.warning(f"The document with sid {self.sid} was modified by a different user.")
+                return None, DocOpResult.MergeConflict
+            elif checkForModifications and all(getPathValue(currentDocument, key) == val for key, val in self.dataDict.items()):
+                return currentDocument, DocOpResult.Successful
+            else:
+                pinnedVersion = currentDocument[Keys.systemVersionKey]
+
+        logger.error(f"Failed to modify the document with sid {self.sid} after {AtomicDocumentOperation.maxAttempts} attempts.")
+        return None, DocOpResult.MergeConflict
+
+    def migrateLegacyDocument(self, legacyDocument: dict):
+        """
+        Moves the live document from the legacy _id sid_version to the stable _id sid.
+        """
+        migratedDocument = dict(legacyDocument)
+        migratedDocument['_id'] = self.sid
+        try:
+            self.collection.insert_one(migratedDocument)
+        except pymongo.errors.DuplicateKeyError:
+            # Migrated concurrently.
+            pass
+
+        self.collection.delete_one({'_id': legacyDocument['_id'], Keys.systemVersionKey: legacyDocument[Keys.systemVersionKey]})
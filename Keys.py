@@ -6,12 +6,15 @@ systemIDKey = "s_id"
 
 systemVersionKey = "s_version"
 
+# Hash of the data keys of a document, used to detect unchanged documents without transferring them.
+contentHashKey = "s_hash"
+
 collection = 's_collection'
 
 preview = "preview"
 
 # s_id is not unique but s_id + s_version is which happens to be defined as _id = s_id + s_version
-systemKeys = ["_id", systemIDKey, systemVersionKey, preview]
+systemKeys = ["_id", systemIDKey, systemVersionKey, contentHashKey, preview]
 
 collectionsMD = "collectionsMD"
 
@@ -26,6 +29,8 @@ ARCHIVED_ENV_COLLECTION = "arch_env"
 HOST_PROCESSES_COLLECTION = "host_processes"
 SERVICE_COLLECTION = "services"
 SERVICE_PROCESS_COLLECTION = "service_processes"
+TASK_QUEUE_COLLECTION = "task_queue"
+DOCUMENT_ACTION_WORK_COLLECTION = "document_action_work"
 ACTION_MANAGER_ID = "action_manager"
 ENVIRONMENT_MANAGER_ID = "environment_manager"
 ARCHIVED_ENVIRONMENTS_ID = "archived_environments"
@@ -34,4 +39,5 @@ TAGS = 's_tags'
 
 RABBITMQ_ENVIRONMENT_EXCHANGE = "env_exchange"
 
-hiddenCollections = set([collectionsMD, STATE_COLLECTION, HOST_PROCESSES_COLLECTION, SERVICE_COLLECTION, SERVICE_PROCESS_COLLECTION])
\ No newline at end of file
+hiddenCollections = set([collectionsMD, STATE_COLLECTION, HOST_PROCESSES_COLLECTION, SERVICE_COLLECTION, SERVICE_PROCESS_COLLECTION, TASK_QUEUE_COLLECTION,
+                         DOCUMENT_ACTION_WORK_COLLECTION])
\ No newline at end of file
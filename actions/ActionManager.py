@@ -4,21 +4,109 @@ from MetadataManagerCore.actions.Action import Action
 from MetadataManagerCore.actions.ActionType import ActionType
 from MetadataManagerCore.Event import Event
 from MetadataManagerCore import Keys
+from contextlib import contextmanager
+from pymongo import UpdateOne
+import itertools
 import json
 import logging
 
+# Field of the action manager state document storing the collection links as {'collection': ..., 'actionId': ...} subdocuments:
+ACTION_LINKS_KEY = 'actionLinks'
+
+# Former field storing the whole collection to action map as JSON string. Migrated on load.
+LEGACY_ACTION_MAP_KEY = 'collectionToActionMapAsJson'
+
+class ActionSearchIndex(object):
+    """
+    Maps all substrings of up to 3 characters (n-grams) of the action ids and filter tags to the ids of the actions containing them.
+    Filter strings of up to 3 characters are answered directly by the index. For longer filter strings,
+    the candidates containing all trigrams of the filter string are verified with a substring test.
+    """
+    maxGramLength = 3
+
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.gramToActionIds: typing.Dict[str, typing.Set[str]] = dict()
+        self.actionIdToGrams: typing.Dict[str, typing.Set[str]] = dict()
+        self.actionIdToSearchTexts: typing.Dict[str, typing.List[str]] = dict()
+
+    @staticmethod
+    def getGrams(text: str, gramLength: int) -> typing.Set[str]:
+        return set(text[i:i + gramLength] for i in range(len(text) - gramLength + 1))
+
+    def add(self, actionId: str, searchTexts: typing.List[str]):
+        grams = set()
+        for text in searchTexts:
+            for gramLength in range(1, ActionSearchIndex.maxGramLength + 1):
+                grams.update(ActionSearchIndex.getGrams(text, gramLength))
+
+        for gram in grams:
+            actionIds = self.gramToActionIds.get(gram)
+            if actionIds == None:
+                actionIds = set()
+                self.gramToActionIds[gram] = actionIds
+
+            actionIds.add(actionId)
+
+        self.actionIdToGrams[actionId] = grams
+        self.actionIdToSearchTexts[actionId] = searchTexts
+
+    def remove(self, actionId: str):
+        for gram in self.actionIdToGrams.pop(actionId, set()):
+            actionIds = self.gramToActionIds[gram]
+            actionIds.discard(actionId)
+            if len(actionIds) == 0:
+                del self.gramToActionIds[gram]
+
+        self.actionIdToSearchTexts.pop(actionId, None)
+
+    def search(self, filterString: str) -> typing.Set[str]:
+        """Returns the ids of the actions whose id or filter tags contain the filter string.
+        """
+        if len(filterString) <= ActionSearchIndex.maxGramLength:
+            return self.gramToActionIds.get(filterString, set())
+
+        postings = []
+        for gram in ActionSearchIndex.getGrams(filterString, ActionSearchIndex.maxGramLength):
+            actionIds = self.gramToActionIds.get(gram)
+            if actionIds == None:
+                return set()
+
+            postings.append(actionIds)
+
+        postings.sort(key=len)
+        candidates = postings[0].intersection(*postings[1:])
+        return set(actionId for actionId in candidates if any(filterString in t for t in self.actionIdToSearchTexts[actionId]))
+
 class ActionManager(object):
     def __init__(self):
         self.logger = logging.getLogger(__name__)
-        self.actions: typing.List[Action] = []
+        self.actionIdToActionMap: typing.Dict[str, Action] = dict()
+        self.categoryToActionIdsMap: typing.Dict[str, typing.Dict[str, None]] = dict()
+        self.actionIdToRegistrationIndexMap: typing.Dict[str, int] = dict()
+        self.registrationCounter = itertools.count()
+        self.searchIndex = ActionSearchIndex()
         self.collectionToActionsMap = dict()
 
+        # Pending link changes of the current batch: (collectionName, actionId) -> None
+        self.batchDepth = 0
+        self.pendingLinkChanges: typing.Dict[typing.Tuple[str, str], None] = dict()
+
         self.m_linkActionToCollectionEvent = Event()
         self.m_unlinkActionFromCollectionEvent = Event()
         self.m_registerActionEvent = Event()
 
         self.dbManager = None
 
+    @property
+    def actions(self) -> typing.List[Action]:
+        """
+        Returns:
+            The registered actions in registration order.
+        """
+        return list(self.actionIdToActionMap.values())
+
     @property
     def registerActionEvent(self) -> Event:
         """
@@ -41,25 +129,31 @@ class ActionManager(object):
         return self.m_unlinkActionFromCollectionEvent
 
     def getAllCategories(self):
-        categories = []
-        for a in self.actions:
-            if not a.category in categories:
-                categories.append(a.category)
-
-        return categories
+        return list(self.categoryToActionIdsMap.keys())
 
     def getActionIdsOfCategory(self, category):
-        return [a.id for a in self.actions if a.category == category]
+        return list(self.categoryToActionIdsMap.get(category, dict()).keys())
     
     def registerAction(self, action: Action):
+        """
+        Registers the action. The id, category and filter tags of the action are indexed and must not change while it is registered.
+        """
         self.logger.debug(f"Registering action: {action.id}")
 
-        for a in self.actions:
-            if a.id == action.id:
-                self.logger.warning(f"Action {action.id} is already registered.")
-                return
+        if action.id in self.actionIdToActionMap:
+            self.logger.warning(f"Action {action.id} is already registered.")
+            return
                 
-        self.actions.append(action)
+        self.actionIdToActionMap[action.id] = action
+        self.actionIdToRegistrationIndexMap[action.id] = next(self.registrationCounter)
+
+        categoryActionIds = self.categoryToActionIdsMap.get(action.category)
+        if categoryActionIds == None:
+            categoryActionIds = dict()
+            self.categoryToActionIdsMap[action.category] = categoryActionIds
+
+        categoryActionIds[action.id] = None
+        self.searchIndex.add(action.id, [action.id] + list(action.filterTags))
 
         for collectionName, actionIds in self.collectionToActionsMap.items():
             if action.id in actionIds:
@@ -89,40 +183,131 @@ class ActionManager(object):
         actionManagerState = dbManager.db[Keys.STATE_COLLECTION].find_one({"_id":Keys.ACTION_MANAGER_ID})
 
         if actionManagerState != None:
-            collectionToActionMapAsJson = actionManagerState.get('collectionToActionMapAsJson')
-            if collectionToActionMapAsJson != None:
-                self.collectionToActionsMap = json.loads(collectionToActionMapAsJson)
+            actionLinks = actionManagerState.get(ACTION_LINKS_KEY)
+            if actionLinks != None:
+                self.collectionToActionsMap = dict()
+                for link in actionLinks:
+                    self.collectionToActionsMap.setdefault(link['collection'], []).append(link['actionId'])
+            else:
+                collectionToActionMapAsJson = actionManagerState.get(LEGACY_ACTION_MAP_KEY)
+                if collectionToActionMapAsJson != None:
+                    self.collectionToActionsMap = json.loads(collectionToActionMapAsJson)
+                    self.logger.info("Migrating the action collection links to subdocuments.")
+                    self.saveToDatabase()
+
+    @staticmethod
+    def createActionLink(collectionName: str, actionId: str) -> dict:
+        return {'collection': collectionName, 'actionId': actionId}
 
     def saveToDatabase(self):
-        collectionToActionMapAsJson = json.dumps(self.collectionToActionsMap)
+        """
+        Writes all collection links. Link changes are written incrementally, so this is only needed to replace the stored state.
+        """
         if self.dbManager:
-            self.dbManager.db[Keys.STATE_COLLECTION].replace_one({"_id":Keys.ACTION_MANAGER_ID}, {"collectionToActionMapAsJson": collectionToActionMapAsJson}, upsert=True)
+            actionLinks = [ActionManager.createActionLink(collectionName, actionId) 
+                           for collectionName, actionIds in self.collectionToActionsMap.items() for actionId in actionIds]
+            self.dbManager.db[Keys.STATE_COLLECTION].replace_one({"_id":Keys.ACTION_MANAGER_ID}, {ACTION_LINKS_KEY: actionLinks}, upsert=True)
+
+    @contextmanager
+    def batchLinkChanges(self):
+        """
+        Coalesces the collection link changes made inside the with-block into a single database write at its end.
+        Batches can be nested. The in-memory state and the events are updated immediately.
+
+        Example:
+            with actionManager.batchLinkChanges():
+                for actionId in actionIds:
+                    actionManager.linkActionToCollection(actionId, collectionName)
+        """
+        self.batchDepth += 1
+        try:
+            yield self
+        finally:
+            self.batchDepth -= 1
+            if self.batchDepth == 0:
+                self.writeLinkChanges()
+
+    def onLinkChanged(self, actionId, collectionName):
+        self.pendingLinkChanges[(collectionName, actionId)] = None
+        if self.batchDepth == 0:
+            self.writeLinkChanges()
+
+    def writeLinkChanges(self):
+        """
+        Writes the pending link changes with $pull/$addToSet. The final in-memory state of each changed link decides whether it is added or removed,
+        so linking and unlinking the same action within a batch cancels out.
+        """
+        pendingLinkChanges = list(self.pendingLinkChanges.keys())
+        self.pendingLinkChanges.clear()
+        if len(pendingLinkChanges) == 0 or not self.dbManager:
+            return
+
+        addedLinks = []
+        removedLinks = []
+        for collectionName, actionId in pendingLinkChanges:
+            link = ActionManager.createActionLink(collectionName, actionId)
+            if self.isActionRegisteredForCollection(actionId, collectionName):
+                addedLinks.append(link)
+            else:
+                removedLinks.append(link)
+
+        # $pull and $addToSet can't modify the same field in one update. Both updates are sent in one ordered bulk write:
+        documentFilter = {"_id":Keys.ACTION_MANAGER_ID}
+        operations = []
+        if len(removedLinks) > 0:
+            operations.append(UpdateOne(documentFilter, {'$pull': {ACTION_LINKS_KEY: {'$in': removedLinks}}}))
+
+        if len(addedLinks) > 0:
+            operations.append(UpdateOne(documentFilter, {'$addToSet': {ACTION_LINKS_KEY: {'$each': addedLinks}}}, upsert=True))
+
+        self.dbManager.db[Keys.STATE_COLLECTION].bulk_write(operations, ordered=True)
 
     def unregisterAction(self, action):
         if action != None:
             self.unregisterActionId(action.id)
 
     def unregisterActionId(self, actionId):
-        self.actions = [a for a in self.actions if a.id != actionId]
+        action = self.actionIdToActionMap.pop(actionId, None)
+        if action == None:
+            return
+
+        self.actionIdToRegistrationIndexMap.pop(actionId, None)
+
+        categoryActionIds = self.categoryToActionIdsMap.get(action.category)
+        if categoryActionIds != None:
+            categoryActionIds.pop(actionId, None)
+            if len(categoryActionIds) == 0:
+                del self.categoryToActionIdsMap[action.category]
+
+        self.searchIndex.remove(actionId)
 
     def applyFilter(self, actions, filterString):
         if not filterString:
             return actions
 
+        matchingActionIds = self.searchIndex.search(filterString)
         filteredActions = []
 
         for a in actions:
-            if filterString in a.id or len([t for t in a.filterTags if filterString in t]) > 0:
+            if self.actionIdToActionMap.get(a.id) is a:
+                if a.id in matchingActionIds:
+                    filteredActions.append(a)
+            elif filterString in a.id or len([t for t in a.filterTags if filterString in t]) > 0:
+                # Not indexed because it isn't registered:
                 filteredActions.append(a)
 
         return filteredActions
 
     def getActionsFiltered(self, filterString):
-        return self.applyFilter(self.actions, filterString)
+        if not filterString:
+            return self.actions
+
+        # Only the matching actions are visited, sorted to keep the registration order:
+        matchingActionIds = sorted(self.searchIndex.search(filterString), key=self.actionIdToRegistrationIndexMap.__getitem__)
+        return [self.actionIdToActionMap[actionId] for actionId in matchingActionIds]
 
     def getActionById(self, actionId) -> Action:
-        actionsWithId = [a for a in self.actions if a.id == actionId]
-        return actionsWithId[0] if len(actionsWithId) > 0 else None
+        return self.actionIdToActionMap.get(actionId)
 
     def linkActionToCollection(self, actionId, collectionName):
         action = self.getActionById(actionId)
@@ -138,7 +323,7 @@ class ActionManager(object):
 
         self.m_linkActionToCollectionEvent(actionId, collectionName)
 
-        self.saveToDatabase()
+        self.onLinkChanged(actionId, collectionName)
 
     def unlinkActionFromCollection(self, actionId, collectionName):
         self.collectionToActionsMap[collectionName].remove(actionId)
@@ -149,7 +334,7 @@ class ActionManager(object):
 
         self.m_unlinkActionFromCollectionEvent(actionId, collectionName)
         
-        self.saveToDatabase()
+        self.onLinkChanged(actionId, collectionName)
 
     def getCollectionActionIds(self, collectionName):
         actionIds = self.collectionToActionsMap.get(collectionName)
@@ -160,20 +345,17 @@ class ActionManager(object):
 
     def getCollectionActionsFiltered(self, collectionName, filterString=None):
         actionIds = self.getCollectionActionIds(collectionName)
-        actionIdToActionMap = {
-            action.id: action for action in self.actions
-        }
-        actions = [actionIdToActionMap[id] for id in actionIds if id in actionIdToActionMap]
+        actions = [self.actionIdToActionMap[id] for id in actionIds if id in self.actionIdToActionMap]
         return self.applyFilter(actions, filterString)
 
     def isValidActionId(self, actionId):
         return self.isActionIdRegistered(actionId)
 
     def isActionIdRegistered(self, actionId):
-        return actionId in [action.id for action in self.actions]
+        return actionId in self.actionIdToActionMap
 
     def getGeneralActions(self):
-        return [action for action in self.actions if action.actionType == ActionType.GeneralAction]
+        return [action for action in self.actionIdToActionMap.values() if action.actionType == ActionType.GeneralAction]
 
     def getDocumentActions(self):
-        return [action for action in self.actions if action.actionType == ActionType.DocumentAction]
\ No newline at end of file
+        return [action for action in self.actionIdToActionMap.values() if action.actionType == ActionType.DocumentAction]
\ No newline at end of file
@@ -12,6 +12,26 @@ class DocumentAction(Action):
     def execute(self, document):
         pass
 
+    @property
+    def requiredFields(self):
+        """The document fields read by execute. If None, the whole document is fetched.
+        Returning a list allows the document retrieval to skip unneeded (possibly large) fields.
+        """
+        return None
+
+    @property
+    def isThreadSafe(self) -> bool:
+        """If True, execute may be called concurrently from multiple threads.
+        """
+        return False
+
+    @property
+    def isProcessSafe(self) -> bool:
+        """If True, the action can be pickled and executed in worker processes (e.g. for CPU-bound actions).
+        Side effects on the state of the submitting process are lost in this mode.
+        """
+        return False
+
     @property
     def askForConfirmation(self) -> bool:
         return True
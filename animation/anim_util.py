@@ -1,15 +1,25 @@
 import os
+import re
+import bisect
+from array import array
+from typing import Iterable, List, Tuple
 
 def idxToFrameString(idx, maxDigits):
     s = str(idx)
 
     if len(s) > maxDigits:
-        raise f"Invalid input: The index {idx} exceeds the max digit count {maxDigits}"
+        raise RuntimeError(f"Invalid input: The index {idx} exceeds the max digit count {maxDigits}")
 
-    for _ in range(len(s), maxDigits):
-        s = "0" + s
-    
-    return s
+    return s.zfill(maxDigits)
+
+def getFrameFilename(filename: str, idx: int):
+    """Replaces the # pattern in the filename with the zero padded frame index.
+    """
+    idxStart = filename.find("#")
+    idxEnd = filename.rfind("#")
+    maxDigits = (idxEnd + 1) - idxStart
+
+    return idxToFrameString(idx, maxDigits).join([filename[:idxStart],filename[idxEnd+1:]])
 
 def extractFrameFilenames(filename: str, frameCount: int, startsAtZero=False):
     # Check for animation frame pattern:
@@ -30,7 +40,117 @@ def extractFrameFilenames(filename: str, frameCount: int, startsAtZero=False):
             
     return frames
 
-def yieldExistingFrameFilenames(filename: str):
+class FrameSequence(object):
+    """
+    The existing frames of a # frame pattern as a sorted array of frame numbers.
+    """
+    def __init__(self, filename: str, frames: Iterable[int]) -> None:
+        super().__init__()
+
+        self.filename = filename
+        self.frames = array('q', sorted(frames))
+
+        idxStart = filename.find("#")
+        idxEnd = filename.rfind("#")
+        self.prefix = filename[:idxStart]
+        self.suffix = filename[idxEnd+1:]
+        self.maxDigits = (idxEnd + 1) - idxStart
+
+    def __len__(self):
+        return len(self.frames)
+
+    def __contains__(self, frame: int):
+        idx = bisect.bisect_left(self.frames, frame)
+        return idx < len(self.frames) and self.frames[idx] == frame
+
+    def __iter__(self):
+        return iter(self.frames)
+
+    @property
+    def first(self) -> int:
+        return self.frames[0] if len(self.frames) > 0 else None
+
+    @property
+    def last(self) -> int:
+        return self.frames[-1] if len(self.frames) > 0 else None
+
+    @property
+    def ranges(self) -> List[Tuple[int,int]]:
+        """Returns the runs of consecutive frames as inclusive (start, end) tuples.
+        """
+        ranges = []
+        for frame in self.frames:
+            if len(ranges) > 0 and ranges[-1][1] + 1 == frame:
+                ranges[-1] = (ranges[-1][0], frame)
+            else:
+                ranges.append((frame, frame))
+
+        return ranges
+
+    @property
+    def gaps(self) -> List[Tuple[int,int]]:
+        """Returns the missing frames between the first and the last frame as inclusive (start, end) tuples.
+        """
+        ranges = self.ranges
+        return [(ranges[i][1] + 1, ranges[i+1][0] - 1) for i in range(len(ranges) - 1)]
+
+    def frameFilename(self, frame: int):
+        return f'{self.prefix}{idxToFrameString(frame, self.maxDigits)}{self.suffix}'
+
+    def consecutiveFrames(self, startFrame: int):
+        """Yields the frames starting at startFrame until the first missing frame.
+        """
+        idx = bisect.bisect_left(self.frames, startFrame)
+        frame = startFrame
+        while idx < len(self.frames) and self.frames[idx] == frame:
+            yield frame
+            idx += 1
+            frame += 1
+
+    def frameFilenames(self):
+        return [self.frameFilename(frame) for frame in self.frames]
+
+    def __str__(self):
+        return ','.join(f'{start}-{end}' if start != end else str(start) for start, end in self.ranges)
+
+def frameSequenceRegex(basename: str):
+    """Compiles a regex matching the basenames of the frames of the given # pattern basename. The frame number is captured in group 1.
+    """
+    idxStart = basename.find("#")
+    idxEnd = basename.rfind("#")
+    maxDigits = (idxEnd + 1) - idxStart
+    flags = re.IGNORECASE if os.name == 'nt' else 0
+
+    return re.compile(f'{re.escape(basename[:idxStart])}(\\d{{{maxDigits}}}){re.escape(basename[idxEnd+1:])}', flags)
+
+def scanFrameSequence(filename: str, directoryFilenames: Iterable[str] = None) -> FrameSequence:
+    """
+    Determines the existing frames of the # pattern in the basename of the filename by listing the directory once.
+    If directoryFilenames is specified, it is used instead of listing the directory.
+    """
+    directory, basename = os.path.split(filename)
+    if not '#' in basename:
+        return FrameSequence(filename, [])
+
+    if directoryFilenames == None:
+        try:
+            with os.scandir(directory if directory else '.') as entries:
+                directoryFilenames = [entry.name for entry in entries]
+        except OSError:
+            directoryFilenames = []
+
+    regex = frameSequenceRegex(basename)
+    frames = []
+    for fn in directoryFilenames:
+        match = regex.fullmatch(fn)
+        if match:
+            frames.append(int(match.group(1)))
+
+    return FrameSequence(filename, frames)
+
+def yieldExistingFrameFilenamesByStat(filename: str):
+    """Checks the existence of every frame with a separate stat call. Used if the # pattern is not part of the basename.
+    """
     # Check for animation frame pattern:
     idxStart = filename.find("#")
     idxEnd = filename.rfind("#")
@@ -46,6 +166,17 @@ def yieldExistingFrameFilenames(filename: str):
                 yield framePath
             elif i > 0: # Support frames starting at 1
                 break
+
+def yieldExistingFrameFilenames(filename: str):
+    """Yields the consecutive existing frames starting at frame 0 or 1.
+    """
+    if not '#' in os.path.basename(filename):
+        yield from yieldExistingFrameFilenamesByStat(filename)
+        return
+
+    sequence = scanFrameSequence(filename)
+    for frame in sequence.consecutiveFrames(0 if 0 in sequence else 1):
+        yield sequence.frameFilename(frame)
  
 def extractExistingFrameFilenames(filename: str):
     return [fn for fn in yieldExistingFrameFilenames(filename)]
@@ -54,4 +185,4 @@ def hasExistingFrameFilenames(filename: str):
     for _ in yieldExistingFrameFilenames(filename):
         return True
 
-    return False
\ No newline at end of file
+    return False
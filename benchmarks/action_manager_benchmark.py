@@ -0,0 +1,96 @@
+"""
+Compares the ActionManager lookups with the former list based implementation for 10k registered actions.
+
+Measures registration, id lookups, category queries and filter string searches of different lengths.
+The legacy functions replicate the former linear scans over the action list.
+
+Usage: python -m MetadataManagerCore.benchmarks.action_manager_benchmark
+"""
+from MetadataManagerCore.actions.ActionManager import ActionManager
+from MetadataManagerCore.actions.DocumentAction import DocumentAction
+import random
+import time
+
+class BenchmarkAction(DocumentAction):
+    def __init__(self, index: int) -> None:
+        super().__init__()
+
+        self.index = index
+
+    @property
+    def id(self):
+        return f'BenchmarkAction{self.index:05d}'
+
+    @property
+    def category(self):
+        return f'Category{self.index % 50}'
+
+    @property
+    def filterTags(self):
+        return [f'tag{self.index % 200}', f'render_{self.index % 7}', 'benchmark']
+
+def legacyRegister(actions, action):
+    for a in actions:
+        if a.id == action.id:
+            return
+
+    actions.append(action)
+
+def legacyGetActionById(actions, actionId):
+    actionsWithId = [a for a in actions if a.id == actionId]
+    return actionsWithId[0] if len(actionsWithId) > 0 else None
+
+def legacyGetAllCategories(actions):
+    categories = []
+    for a in actions:
+        if not a.category in categories:
+            categories.append(a.category)
+
+    return categories
+
+def legacyApplyFilter(actions, filterString):
+    return [a for a in actions if filterString in a.id or len([t for t in a.filterTags if filterString in t]) > 0]
+
+def measure(label: str, count: int, function):
+    tStart = time.perf_counter()
+    for i in range(count):
+        function(i)
+
+    duration = time.perf_counter() - tStart
+    print(f'{label:>32} | {count:>6} | {duration / count * 1e6:>12.1f}')
+    return duration
+
+def run(actionCount: int = 10000):
+    actions = [BenchmarkAction(i) for i in range(actionCount)]
+    actionIds = [a.id for a in actions]
+    random.seed(0)
+    lookupIds = [random.choice(actionIds) for _ in range(1000)]
+    filterStrings = ['9', 'g1', 'tag17', 'render_3', 'Action0042', 'missing']
+
+    print(f'{actionCount} actions')
+    print(f'{"operation":>32} | {"calls":>6} | {"us/call":>12}')
+
+    legacyActions = []
+    measure('legacy register', actionCount, lambda i: legacyRegister(legacyActions, actions[i]))
+    actionManager = ActionManager()
+    measure('register', actionCount, lambda i: actionManager.registerAction(actions[i]))
+
+    measure('legacy getActionById', len(lookupIds), lambda i: legacyGetActionById(legacyActions, lookupIds[i]))
+    measure('getActionById', len(lookupIds), lambda i: actionManager.getActionById(lookupIds[i]))
+
+    measure('legacy isActionIdRegistered', len(lookupIds), lambda i: lookupIds[i] in [a.id for a in legacyActions])
+    measure('isActionIdRegistered', len(lookupIds), lambda i: actionManager.isActionIdRegistered(lookupIds[i]))
+
+    measure('legacy getAllCategories', 10, lambda i: legacyGetAllCategories(legacyActions))
+    measure('getAllCategories', 10, lambda i: actionManager.getAllCategories())
+
+    for filterString in filterStrings:
+        legacyResult = legacyApplyFilter(legacyActions, filterString)
+        result = actionManager.getActionsFiltered(filterString)
+        assert [a.id for a in legacyResult] == [a.id for a in result]
+
+        measure(f'legacy filter "{filterString}"', 10, lambda i: legacyApplyFilter(legacyActions, filterString))
+        measure(f'filter "{filterString}" ({len(result)} hits)', 10, lambda i: actionManager.getActionsFiltered(filterString))
+
+if __name__ == "__main__":
+    run()
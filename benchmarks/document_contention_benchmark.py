@@ -0,0 +1,142 @@
+"""
+Compares DocumentOperation with AtomicDocumentOperation under contention:
+N concurrent writers modify different keys of the same small set of documents.
+
+Reports the write latency, the number of merge conflicts and other failures and checks that the final version of every document
+equals the number of successful modifications.
+Finally checks that documents modified atomically can be modified by the legacy and the batched operations afterwards (and vice versa).
+
+Uses mongomock if no MongoDB url is given. mongomock serializes all operations, so the conflict rates are only representative on a real server.
+
+Usage: python -m MetadataManagerCore.benchmarks.document_contention_benchmark [mongodbUrl]
+"""
+from MetadataManagerCore.mongodb_manager import MongoDBManager
+from MetadataManagerCore.DocumentModification import DocOpResult
+from MetadataManagerCore import Keys
+import threading
+import logging
+import time
+import sys
+
+def createDBManager(mongodbUrl: str) -> MongoDBManager:
+    if mongodbUrl:
+        dbManager = MongoDBManager(mongodbUrl, 'document_contention_benchmark')
+        dbManager.connect()
+        dbManager.client.drop_database('document_contention_benchmark')
+    else:
+        import mongomock
+        dbManager = MongoDBManager(None, 'document_contention_benchmark')
+        dbManager.db = mongomock.MongoClient()['document_contention_benchmark']
+
+    return dbManager
+
+def measure(dbManager: MongoDBManager, atomic: bool, writerCount: int, sidCount: int, modificationsPerWriter: int):
+    collectionName = 'atomic' if atomic else 'legacy'
+    dbManager.atomicDocumentUpdates = atomic
+    sids = [f'doc{i}' for i in range(sidCount)]
+    latencies = []
+    counts = {'successful': 0, 'conflicts': 0, 'errors': 0}
+    lock = threading.Lock()
+
+    def write(writerIndex: int):
+        writerLatencies = []
+        writerCounts = {'successful': 0, 'conflicts': 0, 'errors': 0}
+        for i in range(modificationsPerWriter):
+            sid = sids[(writerIndex + i) % sidCount]
+            tStart = time.perf_counter()
+            try:
+                _, result = dbManager.insertOrModifyDocument(collectionName, sid, {f'writer{writerIndex}': i}, False)
+                writerCounts['successful' if result == DocOpResult.Successful else 'conflicts'] += 1
+            except Exception:
+                writerCounts['errors'] += 1
+
+            writerLatencies.append(time.perf_counter() - tStart)
+
+        with lock:
+            latencies.extend(writerLatencies)
+            for key, count in writerCounts.items():
+                counts[key] += count
+
+    threads = [threading.Thread(target=write, args=(i,)) for i in range(writerCount)]
+    tStart = time.perf_counter()
+    for thread in threads:
+        thread.start()
+
+    for thread in threads:
+        thread.join()
+
+    duration = time.perf_counter() - tStart
+    dbManager.flushVersionHistory()
+
+    # Every successful modification of an existing document creates exactly one version:
+    liveDocuments = list(dbManager.db[collectionName].find())
+    versionSum = sum(d[Keys.systemVersionKey] + 1 for d in liveDocuments)
+    consistent = len(liveDocuments) == sidCount and versionSum == counts['successful']
+
+    latencies.sort()
+    averageLatency = sum(latencies) / len(latencies)
+    p95Latency = latencies[int(len(latencies) * 0.95)]
+    print(f'{collectionName:>7} | {writerCount:>7} | {counts["successful"] / duration:>10.1f} | {averageLatency * 1000.0:>9.2f} | {p95Latency * 1000.0:>9.2f} | '
+          f'{counts["conflicts"]:>9} | {counts["errors"]:>6} | {str(consistent):>10}')
+
+def checkMixedPaths(dbManager: MongoDBManager, sidCount: int = 10, rounds: int = 3):
+    """Alternates atomic, legacy and batched modifications of the same documents and checks that none fails,
+    that every modification creates exactly one version and that every previous version can be reconstructed.
+    """
+    collectionName = 'mixed'
+    sids = [f'doc{i}' for i in range(sidCount)]
+    successfulCount = 0
+    errors = []
+
+    for i in range(rounds):
+        try:
+            dbManager.atomicDocumentUpdates = True
+            for sid in sids:
+                _, result = dbManager.insertOrModifyDocument(collectionName, sid, {'atomic': i}, False)
+                successfulCount += result == DocOpResult.Successful
+
+            dbManager.flushVersionHistory()
+            dbManager.atomicDocumentUpdates = False
+            for sid in sids:
+                _, result = dbManager.insertOrModifyDocument(collectionName, sid, {'legacy': i}, False)
+                successfulCount += result == DocOpResult.Successful
+
+            resultCounts = dbManager.insertOrModifyDocuments(collectionName, [(sid, {'batch': i}) for sid in sids], checkForModifications=False)
+            successfulCount += resultCounts[DocOpResult.Successful]
+        except Exception as e:
+            errors.append(str(e))
+
+    dbManager.flushVersionHistory()
+
+    liveDocuments = list(dbManager.db[collectionName].find())
+    versionSum = sum(d[Keys.systemVersionKey] + 1 for d in liveDocuments)
+    consistent = len(errors) == 0 and len(liveDocuments) == sidCount and versionSum == successfulCount
+    for document in liveDocuments:
+        for version in range(document[Keys.systemVersionKey]):
+            if dbManager.reconstructVersion(collectionName, document[Keys.systemIDKey], version) == None:
+                consistent = False
+
+    print(f'Mixed atomic/legacy/batched modifications: {successfulCount} successful, {len(errors)} errors, consistent: {consistent}')
+    for error in errors[:5]:
+        print(f'  {error}')
+
+    dbManager.db.drop_collection(collectionName)
+    dbManager.db.drop_collection(collectionName + Keys.OLD_VERSIONS_COLLECTION_SUFFIX)
+
+def run(mongodbUrl: str = None):
+    dbManager = createDBManager(mongodbUrl)
+
+    # Conflicts are counted, don't log each of them:
+    logging.getLogger('MetadataManagerCore.DocumentModification').setLevel(logging.CRITICAL)
+
+    print(f'{"mode":>7} | {"writers":>7} | {"writes/s":>10} | {"avg (ms)":>9} | {"p95 (ms)":>9} | {"conflicts":>9} | {"errors":>6} | {"consistent":>10}')
+    for writerCount in [1, 4, 16]:
+        for atomic in [False, True]:
+            measure(dbManager, atomic, writerCount, 10, 200)
+            dbManager.db.drop_collection('atomic' if atomic else 'legacy')
+            dbManager.db.drop_collection(('atomic' if atomic else 'legacy') + Keys.OLD_VERSIONS_COLLECTION_SUFFIX)
+
+    checkMixedPaths(dbManager)
+
+if __name__ == "__main__":
+    run(sys.argv[1] if len(sys.argv) > 1 else None)
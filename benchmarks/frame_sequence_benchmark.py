@@ -0,0 +1,50 @@
+"""
+Compares the stat-based frame resolution with the directory listing based frame sequence scanner of anim_util.
+
+Usage: python -m MetadataManagerCore.benchmarks.frame_sequence_benchmark [frameCount]
+"""
+from MetadataManagerCore.animation import anim_util
+import tempfile
+import time
+import sys
+import os
+
+def createSyntheticSequence(directory: str, frameCount: int, gapEvery: int = 0):
+    pattern = os.path.join(directory, 'render_#####.exr')
+    for frame in range(1, frameCount + 1):
+        if gapEvery > 0 and frame % gapEvery == 0:
+            continue
+
+        with open(anim_util.getFrameFilename(pattern, frame), 'w'):
+            pass
+
+    return pattern
+
+def measure(func, repetitions: int = 3):
+    best = None
+    result = None
+    for _ in range(repetitions):
+        tStart = time.perf_counter()
+        result = func()
+        duration = time.perf_counter() - tStart
+        best = duration if best == None else min(best, duration)
+
+    return best, result
+
+def run(frameCount: int = 10000):
+    with tempfile.TemporaryDirectory() as directory:
+        pattern = createSyntheticSequence(directory, frameCount)
+
+        statDuration, statFrames = measure(lambda: list(anim_util.yieldExistingFrameFilenamesByStat(pattern)))
+        scanDuration, scanFrames = measure(lambda: anim_util.extractExistingFrameFilenames(pattern))
+        sequenceDuration, sequence = measure(lambda: anim_util.scanFrameSequence(pattern))
+
+        assert statFrames == scanFrames, 'The frame resolution results differ.'
+
+        print(f'{frameCount} frames:')
+        print(f'  stat per frame:       {statDuration * 1000.0:8.1f}ms')
+        print(f'  directory listing:    {scanDuration * 1000.0:8.1f}ms ({statDuration / scanDuration:.1f}x)')
+        print(f'  scanFrameSequence:    {sequenceDuration * 1000.0:8.1f}ms, ranges: {sequence}')
+
+if __name__ == "__main__":
+    run(int(sys.argv[1]) if len(sys.argv) > 1 else 10000)
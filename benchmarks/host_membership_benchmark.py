@@ -0,0 +1,142 @@
+"""
+Compares the query load of the legacy host process polling loop with the change stream based HostProcessMembershipTracker
+for 10, 100 and 500 simulated host processes.
+
+Every simulated second all hosts write a heartbeat and every tenth second one host leaves and another one joins.
+The legacy loop reads the whole host table every second. The tracker receives the membership changes from the change stream
+(heartbeat-only updates are filtered on the server, so the stream is simulated by feeding the insert/delete events directly)
+and issues one stale sweep every two seconds.
+
+Uses mongomock if no MongoDB url is given.
+
+Usage: python -m MetadataManagerCore.benchmarks.host_membership_benchmark [mongodbUrl]
+"""
+from MetadataManagerCore.host.HostProcessMembershipTracker import HostProcessMembershipTracker
+from MetadataManagerCore.host.HostProcess import HostProcess
+from datetime import datetime, timedelta
+from pymongo import UpdateOne
+import time
+import sys
+
+class CountingCollection(object):
+    """Wraps a collection and counts the issued read queries and the documents they returned.
+    """
+    def __init__(self, collection) -> None:
+        super().__init__()
+
+        self.collection = collection
+        self.queryCount = 0
+        self.documentCount = 0
+
+    def find(self, *args, **kwargs):
+        self.queryCount += 1
+        documents = list(self.collection.find(*args, **kwargs))
+        self.documentCount += len(documents)
+        return documents
+
+    def delete_many(self, *args, **kwargs):
+        self.queryCount += 1
+        return self.collection.delete_many(*args, **kwargs)
+
+    def delete_one(self, *args, **kwargs):
+        self.queryCount += 1
+        return self.collection.delete_one(*args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+class SimulatedDBManager(object):
+    def __init__(self, collection) -> None:
+        super().__init__()
+
+        self.hostProcessesCollection = CountingCollection(collection)
+
+def legacyPollPass(dbManager: SimulatedDBManager, hostProcessInfos: dict):
+    """The host process check of the former HostProcessController.run loop.
+    """
+    dirtyIds = set(hostProcessInfos.keys())
+    for processInfo in dbManager.hostProcessesCollection.find({}):
+        hostname = processInfo.get('hostname')
+        pid = processInfo.get('pid')
+        hostProcessId = f'{hostname}_{pid}'
+        dirtyIds.discard(hostProcessId)
+        hostProcessInfos[hostProcessId] = processInfo
+
+        heartbeatTime = processInfo.get('heartbeat_time')
+        if heartbeatTime and (datetime.utcnow() - heartbeatTime > timedelta(seconds=HostProcess.dyingTimeInSeconds)):
+            dbManager.hostProcessesCollection.delete_one({'hostname': hostname, 'pid': pid})
+            dirtyIds.add(hostProcessId)
+
+    for hostProcessId in dirtyIds:
+        hostProcessInfos.pop(hostProcessId, None)
+
+def simulate(collection, hostCount: int, useTracker: bool, seconds: int = 60):
+    collection.delete_many({})
+    collection.insert_many([{'hostname': f'host{i}', 'pid': i, 'close': False, 'heartbeat_time': datetime.utcnow()} for i in range(hostCount)])
+
+    dbManager = SimulatedDBManager(collection)
+    tracker = HostProcessMembershipTracker(dbManager, lambda processInfo: HostProcess.dyingTimeInSeconds)
+    tracker.staleSweepIntervalInSeconds = 0.0
+    hostProcessInfos = dict()
+
+    if useTracker:
+        tracker.resync()
+    else:
+        legacyPollPass(dbManager, hostProcessInfos)
+
+    dbManager.hostProcessesCollection.queryCount = 0
+    dbManager.hostProcessesCollection.documentCount = 0
+    nextPid = hostCount
+    processingTime = 0.0
+
+    for second in range(seconds):
+        collection.bulk_write([UpdateOne({'pid': p['pid']}, {'$set': {'heartbeat_time': datetime.utcnow()}}) for p in collection.find({}, {'pid': 1})])
+
+        changes = []
+        if second % 10 == 0:
+            leavingHost = collection.find_one({}, sort=[('pid', 1)])
+            collection.delete_one({'_id': leavingHost['_id']})
+            changes.append({'operationType': 'delete', 'documentKey': {'_id': leavingHost['_id']}})
+
+            joiningHost = {'hostname': f'host{nextPid}', 'pid': nextPid, 'close': False, 'heartbeat_time': datetime.utcnow()}
+            collection.insert_one(joiningHost)
+            changes.append({'operationType': 'insert', 'documentKey': {'_id': joiningHost['_id']}, 'fullDocument': joiningHost})
+            nextPid += 1
+
+        tStart = time.perf_counter()
+        if useTracker:
+            for change in changes:
+                tracker.handleChange(change)
+
+            if second % 2 == 0:
+                tracker.sweepStaleHostProcesses()
+        else:
+            legacyPollPass(dbManager, hostProcessInfos)
+
+        processingTime += time.perf_counter() - tStart
+
+    trackedCount = len(tracker.hostProcesses) if useTracker else len(hostProcessInfos)
+    return dbManager.hostProcessesCollection.queryCount, dbManager.hostProcessesCollection.documentCount, processingTime, trackedCount
+
+def run(mongodbUrl: str = None, hostCounts=(10, 100, 500), seconds: int = 60):
+    if mongodbUrl:
+        import pymongo
+        client = pymongo.MongoClient(mongodbUrl)
+    else:
+        import mongomock
+        client = mongomock.MongoClient()
+
+    collection = client['host_membership_benchmark']['host_processes']
+
+    print(f'Simulated seconds: {seconds}')
+    print(f'{"hosts":>6} | {"mode":>8} | {"queries":>8} | {"docs read":>10} | {"time [ms]":>10} | {"tracked":>8}')
+    for hostCount in hostCounts:
+        for useTracker in (False, True):
+            queries, documents, duration, tracked = simulate(collection, hostCount, useTracker, seconds)
+            mode = 'tracker' if useTracker else 'polling'
+            print(f'{hostCount:>6} | {mode:>8} | {queries:>8} | {documents:>10} | {duration * 1000.0:>10.1f} | {tracked:>8}')
+
+    collection.drop()
+
+if __name__ == "__main__":
+    run(sys.argv[1] if len(sys.argv) > 1 else None)
@@ -0,0 +1,94 @@
+"""
+Measures the message throughput of the socket_util framings for 1KB, 1MB and 50MB payloads over a local socket pair.
+
+"chunked" receives the legacy framing with the former 2048 byte recv loop, "legacy" with the recv_into based receiver.
+The "raw" modes send pre-encoded frames and skip decoding to isolate the framing cost from the codec cost.
+The msgpack codec is skipped if msgpack is not installed.
+
+Usage: python -m MetadataManagerCore.benchmarks.socket_throughput_benchmark
+"""
+from MetadataManagerCore.communication import socket_util
+from MetadataManagerCore.communication.socket_util import FrameInfo
+import threading
+import base64
+import socket
+import struct
+import json
+import time
+import os
+
+def readBlobChunked(sock, size):
+    chunks = []
+    bytes_recd = 0
+    while bytes_recd < size:
+        chunk = sock.recv(min(size - bytes_recd, 2048))
+        if chunk == b'':
+            raise RuntimeError("Socket closed.")
+
+        chunks.append(chunk)
+        bytes_recd = bytes_recd + len(chunk)
+
+    return b''.join(chunks)
+
+def recvBlobChunked(sock):
+    size = struct.unpack(socket_util.SIZE_FORMAT, readBlobChunked(sock, socket_util.SIZE_LENGTH))[0]
+    return readBlobChunked(sock, size)
+
+def recvDictChunked(sock):
+    return json.loads(recvBlobChunked(sock))
+
+def createPayload(sizeInBytes: int) -> dict:
+    # Base64 encoded random data is a text payload that compresses like typical mixed content:
+    return {'taskType': 'benchmark', 'data': base64.b64encode(os.urandom(sizeInBytes * 3 // 4)).decode('ascii')}
+
+def measure(payload: dict, count: int, frameInfo: FrameInfo, receive, raw: bool = False):
+    sender, receiver = socket.socketpair()
+
+    if raw:
+        frameInfo = frameInfo if frameInfo != None else FrameInfo.legacy()
+        encodedPayload = socket_util.encodePayload(payload, frameInfo)
+        frame = socket_util.packHeader(len(encodedPayload), frameInfo) + encodedPayload
+
+    def send():
+        for _ in range(count):
+            if raw:
+                sender.sendall(frame)
+            else:
+                socket_util.sendDict(sender, payload, frameInfo)
+
+    tStart = time.perf_counter()
+    sendThread = threading.Thread(target=send)
+    sendThread.start()
+    for _ in range(count):
+        receive(receiver)
+
+    sendThread.join()
+    duration = time.perf_counter() - tStart
+
+    sender.close()
+    receiver.close()
+    return duration
+
+def run():
+    modes = [
+        ('chunked raw', None, recvBlobChunked, True),
+        ('legacy raw', None, socket_util.recvFrame, True),
+        ('v2 raw', FrameInfo(), socket_util.recvFrame, True),
+        ('chunked', None, recvDictChunked),
+        ('legacy', None, socket_util.recvDict),
+        ('v2 json', FrameInfo(), socket_util.recvDict),
+        ('v2 json+zlib', FrameInfo(compress=True), socket_util.recvDict)
+    ]
+
+    if socket_util.msgpack != None:
+        modes.append(('v2 msgpack', FrameInfo(socket_util.CODEC_MSGPACK), socket_util.recvDict))
+
+    print(f'{"payload":>8} | {"mode":>14} | {"messages/s":>12} | {"MB/s":>10}')
+    for label, sizeInBytes, count in [('1KB', 1024, 20000), ('1MB', 1024 * 1024, 200), ('50MB', 50 * 1024 * 1024, 4)]:
+        payload = createPayload(sizeInBytes)
+        for mode, frameInfo, receive, *raw in modes:
+            duration = measure(payload, count, frameInfo, receive, len(raw) > 0 and raw[0])
+            print(f'{label:>8} | {mode:>14} | {count / duration:>12.1f} | {count * sizeInBytes / duration / (1024 * 1024):>10.1f}')
+
+if __name__ == "__main__":
+    run()
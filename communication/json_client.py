@@ -0,0 +1,180 @@
+from MetadataManagerCore.communication.socket_util import JsonSocket, FrameInfo, REQUEST_ID_KEY, recvDict, sendDict
+from concurrent.futures import Future
+from typing import Dict, List
+import itertools
+import threading
+import select
+import socket
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class PersistentJsonClient(object):
+    """
+    Sends requests over one persistent connection using the request/response protocol of JsonSocket.
+    Requests are pipelined: submit() doesn't wait for the response of previous requests.
+    The responses are received on a background thread and resolve the futures returned by submit().
+
+    Requests are never resent after a connection loss because tasks are not necessarily idempotent.
+    Their futures fail with a ConnectionError instead. The next submit() reconnects with exponential backoff.
+    If a response doesn't arrive within responseTimeout, the connection is dropped and the pending futures fail with a ConnectionError.
+    """
+    def __init__(self, port, host = None, timeout=None, maxPendingRequests=1000, frameInfo: FrameInfo = None, responseTimeout=None) -> None:
+        """
+        Args:
+            timeout: Timeout in seconds for establishing a connection. None waits until the server is available.
+            responseTimeout: Timeout in seconds for the response of a request. None waits until the server responds or closes the connection.
+            maxPendingRequests: submit() blocks while this many requests are waiting for their response.
+            frameInfo: Framing and codec of the requests. None uses the legacy framing understood by older servers.
+        """
+        super().__init__()
+
+        self.port = port
+        self.host = host
+        self.timeout = timeout
+        self.frameInfo = frameInfo
+        self.sock: socket.socket = None
+        self.lock = threading.Lock()
+        self.requestIds = itertools.count(1)
+        self.responseTimeout = responseTimeout
+        self.pendingRequests: Dict[int, Future] = dict()
+        self.requestTimes: Dict[int, float] = dict()
+        self.pendingSlots = threading.BoundedSemaphore(maxPendingRequests)
+        self.isOpen = True
+
+    @property
+    def pendingRequestCount(self) -> int:
+        return len(self.pendingRequests)
+
+    def connect(self):
+        jsonSocket = JsonSocket(self.timeout)
+        jsonSocket.connectClientInsistently(self.port, self.host)
+        jsonSocket.sock.settimeout(None)
+        jsonSocket.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.sock = jsonSocket.sock
+
+        threading.Thread(target=self.receiveResponses, args=(self.sock,), name='PersistentJsonClientReceiver', daemon=True).start()
+
+    def submit(self, theDict: dict) -> Future:
+        """Sends the dict as request and returns a future that resolves to the result sent back by the server.
+        """
+        self.pendingSlots.acquire()
+        future = Future()
+        future.add_done_callback(lambda _: self.pendingSlots.release())
+
+        try:
+            with self.lock:
+                if not self.isOpen:
+                    raise ConnectionError("The client was closed.")
+
+                if self.sock == None:
+                    self.connect()
+
+                requestId = next(self.requestIds)
+                message = dict(theDict)
+                message[REQUEST_ID_KEY] = requestId
+                self.pendingRequests[requestId] = future
+                self.requestTimes[requestId] = time.time()
+
+                try:
+                    sendDict(self.sock, message, self.frameInfo)
+                except OSError as e:
+                    self.pendingRequests.pop(requestId, None)
+                    self.requestTimes.pop(requestId, None)
+                    self.dropConnection(self.sock, e)
+                    raise ConnectionError(f"Failed to send the request: {str(e)}")
+        except Exception as e:
+            if not future.done():
+                future.set_exception(e)
+
+        return future
+
+    def request(self, theDict: dict, timeout=None):
+        """Sends the dict as request and waits for the result. Raises a RuntimeError if the server failed to handle the request.
+        """
+        return self.submit(theDict).result(timeout)
+
+    def receiveResponses(self, sock: socket.socket):
+        try:
+            while True:
+                # Wait for the next response without reading partial messages, so the stream stays intact if the wait times out:
+                if self.responseTimeout != None and len(select.select([sock], [], [], self.responseTimeout)[0]) == 0:
+                    # Only requests without a response for responseTimeout end the connection, an idle connection stays open:
+                    with self.lock:
+                        oldestRequestTime = min(self.requestTimes.values(), default=None)
+
+                    if oldestRequestTime == None or time.time() - oldestRequestTime < self.responseTimeout:
+                        continue
+
+                    raise TimeoutError(f"No response within {self.responseTimeout}s.")
+
+                response = recvDict(sock)
+                self.requestTimes.pop(response.get(REQUEST_ID_KEY), None)
+                future = self.pendingRequests.pop(response.get(REQUEST_ID_KEY), None)
+                if future == None:
+                    continue
+
+                if response.get('success'):
+                    future.set_result(response.get('result'))
+                else:
+                    future.set_exception(RuntimeError(response.get('error')))
+        except Exception as e:
+            with self.lock:
+                self.dropConnection(sock, e)
+
+    def dropConnection(self, sock: socket.socket, reason: Exception):
+        """Closes the given connection and fails its pending requests. Must be called with the lock held.
+        """
+        if self.sock != sock:
+            return
+
+        self.sock = None
+        try:
+            sock.close()
+        except OSError:
+            pass
+
+        pendingRequests = list(self.pendingRequests.values())
+        self.pendingRequests.clear()
+        self.requestTimes.clear()
+        for future in pendingRequests:
+            if not future.done():
+                future.set_exception(ConnectionError(f"The connection was lost before a response was received: {str(reason)}"))
+
+    def close(self):
+        with self.lock:
+            self.isOpen = False
+            if self.sock != None:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+                self.dropConnection(self.sock, ConnectionError("The client was closed."))
+
+class JsonClientPool(object):
+    """
+    A pool of persistent connections to one server. Requests are sent over the connection with the fewest pending requests.
+    Connections are established lazily on first use.
+    """
+    def __init__(self, port, host = None, size=4, timeout=None, maxPendingRequestsPerConnection=1000, frameInfo: FrameInfo = None, responseTimeout=None) -> None:
+        """
+        Each connection of the pool is a persistent connection of the server. Blocking servers (JsonSocket.runServer) accept at most 
+        JsonSocket.maxPersistentConnections of them. See PersistentJsonClient for the arguments.
+        """
+        super().__init__()
+
+        self.clients: List[PersistentJsonClient] = [PersistentJsonClient(port, host, timeout, maxPendingRequestsPerConnection, frameInfo, responseTimeout) 
+                                                    for _ in range(size)]
+
+    def submit(self, theDict: dict) -> Future:
+        client = min(self.clients, key=lambda c: c.pendingRequestCount)
+        return client.submit(theDict)
+
+    def request(self, theDict: dict, timeout=None):
+        return self.submit(theDict).result(timeout)
+
+    def close(self):
+        for client in self.clients:
+            client.close()
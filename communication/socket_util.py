@@ -1,49 +1,246 @@
 import socket
 import json
 import struct
+import zlib
 from concurrent.futures import ThreadPoolExecutor
+import asyncio
+import threading
 import time
 import logging
 
 logger = logging.getLogger(__name__)
 
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Legacy framing (version 1): Native unsigned long size followed by the json payload.
+# The size is 4 bytes on Windows and 8 bytes on Linux, so version 1 doesn't work across platforms.
+SIZE_FORMAT = "L"
+SIZE_LENGTH = struct.calcsize(SIZE_FORMAT)
+LEGACY_FRAME_VERSION = 1
+
+# Framing version 2: Magic bytes, version, flags, codec id and the payload size as 8 byte network-order integer.
+# The magic bytes can't be the start of a plausible legacy size, so receivers detect the framing of each message.
+FRAME_MAGIC = b"\xffMMF"
+FRAME_VERSION = 2
+FRAME_HEADER_FORMAT = "!4sBBBQ"
+FRAME_HEADER_LENGTH = struct.calcsize(FRAME_HEADER_FORMAT)
+
+CODEC_JSON = 0
+CODEC_MSGPACK = 1
+
+FLAG_ZLIB = 1
+
+# Favor speed over ratio, the payloads are compressed on every send:
+ZLIB_LEVEL = 1
+
+# Payloads above this size are sent without copying them behind the header:
+MAX_COALESCED_SEND_SIZE = 64 * 1024
+
+# Blobs up to this size are received with a single recv call if possible:
+MAX_SINGLE_RECV_SIZE = 64 * 1024
+
+# Messages with a request id switch the connection to the persistent protocol:
+# The connection carries any number of requests and the server answers each with a response dict carrying the same id.
+# Messages without a request id are handled as single fire-and-forget messages and the connection is closed afterwards.
+REQUEST_ID_KEY = "_requestId"
+
+class FrameInfo(object):
+    """
+    Describes the framing and encoding of a message. The default is the portable version 2 framing with json encoding.
+    """
+    def __init__(self, codec=CODEC_JSON, compress=False, version=FRAME_VERSION):
+        super().__init__()
+
+        self.version = version
+        self.codec = codec
+        self.flags = FLAG_ZLIB if compress else 0
+
+    @property
+    def compressed(self):
+        return self.flags & FLAG_ZLIB != 0
+
+    @property
+    def isLegacy(self):
+        return self.version == LEGACY_FRAME_VERSION
+
+    @staticmethod
+    def legacy():
+        return FrameInfo(version=LEGACY_FRAME_VERSION)
+
+def encodePayload(theDict : dict, frameInfo : FrameInfo) -> bytes:
+    if frameInfo.codec == CODEC_JSON:
+        payload = json.dumps(theDict).encode(encoding="utf-8")
+    elif frameInfo.codec == CODEC_MSGPACK:
+        if msgpack == None:
+            raise RuntimeError("The msgpack codec requires the msgpack package.")
+
+        payload = msgpack.packb(theDict, use_bin_type=True)
+    else:
+        raise RuntimeError(f"Unknown codec: {frameInfo.codec}")
+
+    if frameInfo.compressed:
+        payload = zlib.compress(payload, ZLIB_LEVEL)
+
+    return payload
+
+def decodePayload(payload, frameInfo : FrameInfo) -> dict:
+    if frameInfo.compressed:
+        payload = zlib.decompress(payload)
+
+    if frameInfo.codec == CODEC_JSON:
+        return json.loads(payload)
+    elif frameInfo.codec == CODEC_MSGPACK:
+        if msgpack == None:
+            raise RuntimeError("The msgpack codec requires the msgpack package.")
+
+        return msgpack.unpackb(payload, raw=False)
+    else:
+        raise RuntimeError(f"Unknown codec: {frameInfo.codec}")
+
+def packHeader(payloadSize : int, frameInfo : FrameInfo) -> bytes:
+    if frameInfo.isLegacy:
+        if frameInfo.codec != CODEC_JSON or frameInfo.flags != 0:
+            raise RuntimeError("The legacy framing only supports uncompressed json.")
+
+        return struct.pack(SIZE_FORMAT, payloadSize)
+
+    return struct.pack(FRAME_HEADER_FORMAT, FRAME_MAGIC, frameInfo.version, frameInfo.flags, frameInfo.codec, payloadSize)
+
+def unpackHeader(header) -> tuple:
+    """Returns (payload size, FrameInfo) of a version 2 header.
+    """
+    _, version, flags, codec, size = struct.unpack(FRAME_HEADER_FORMAT, header)
+    if version != FRAME_VERSION:
+        raise RuntimeError(f"Unsupported frame version: {version}")
+
+    frameInfo = FrameInfo(codec, version=version)
+    frameInfo.flags = flags
+    return size, frameInfo
+
 def readBlob(sock, size):
-    chunks = []
-    bytes_recd = 0
+    """Receives exactly size bytes. Small blobs are tried with a single recv, larger ones are received into a preallocated buffer.
+    """
+    data = sock.recv(size) if 0 < size <= MAX_SINGLE_RECV_SIZE else b''
+    if len(data) == size:
+        return data
+
+    if len(data) == 0 and size <= MAX_SINGLE_RECV_SIZE:
+        raise RuntimeError("Socket closed.")
+
+    blob = bytearray(size)
+    blob[:len(data)] = data
+    view = memoryview(blob)
+    bytes_recd = len(data)
     while bytes_recd < size:
-        chunk = sock.recv(min(size - bytes_recd, 2048))
-        if chunk == b'':
+        n = sock.recv_into(view[bytes_recd:], size - bytes_recd)
+        if n == 0:
             raise RuntimeError("Socket closed.")
 
-        chunks.append(chunk)
-        bytes_recd = bytes_recd + len(chunk)
+        bytes_recd = bytes_recd + n
 
-    return b''.join(chunks)
+    return blob
 
 def readSize(sock):
-    size = struct.calcsize("L")
-    data = readBlob(sock, size)
-    return struct.unpack("L", data)[0]
+    data = readBlob(sock, SIZE_LENGTH)
+    return struct.unpack(SIZE_FORMAT, data)[0]
+
+def recvFrame(sock):
+    """Receives one message in either framing. Returns (payload, FrameInfo).
+    """
+    # The legacy size is at least as long as the magic bytes, so reading it never consumes payload bytes:
+    prefix = readBlob(sock, SIZE_LENGTH)
+    if prefix[:len(FRAME_MAGIC)] == FRAME_MAGIC:
+        size, frameInfo = unpackHeader(bytes(prefix) + readBlob(sock, FRAME_HEADER_LENGTH - SIZE_LENGTH))
+    else:
+        size = struct.unpack(SIZE_FORMAT, prefix)[0]
+        frameInfo = FrameInfo.legacy()
+
+    return readBlob(sock, size), frameInfo
+
+def recvMessage(sock):
+    """Receives one dict in either framing. Returns (dict, FrameInfo).
+    """
+    payload, frameInfo = recvFrame(sock)
+    return decodePayload(payload, frameInfo), frameInfo
 
 def recvDict(sock):
-    size = readSize(sock)
-    jsonBlob = readBlob(sock, size)
-    jdict = json.loads(jsonBlob, encoding="utf-8")
-    return jdict
+    return recvMessage(sock)[0]
+
+def sendDict(sock, theDict : dict, frameInfo : FrameInfo = None):
+    """Sends the dict with the given framing. If frameInfo is None the legacy framing is used for compatibility with older receivers.
+    """
+    frameInfo = frameInfo if frameInfo != None else FrameInfo.legacy()
+    payload = encodePayload(theDict, frameInfo)
+    header = packHeader(len(payload), frameInfo)
+
+    if len(payload) > MAX_COALESCED_SEND_SIZE:
+        sock.sendall(header)
+        sock.sendall(payload)
+    else:
+        sock.sendall(header + payload)
 
-def sendDict(sock, theDict : dict):
-    jsonBlob = json.dumps(theDict).encode(encoding="utf-8")
-    sock.sendall(struct.pack("L", len(jsonBlob)))
-    sock.sendall(jsonBlob)
+async def recvFrameAsync(reader: asyncio.StreamReader, maxSizeInBytes: int = None):
+    """Reads one message in either framing. Returns (payload, FrameInfo).
+    Raises a RuntimeError if the message exceeds maxSizeInBytes and asyncio.IncompleteReadError if the stream ends early.
+    """
+    prefix = await reader.readexactly(SIZE_LENGTH)
+    if prefix[:len(FRAME_MAGIC)] == FRAME_MAGIC:
+        size, frameInfo = unpackHeader(prefix + await reader.readexactly(FRAME_HEADER_LENGTH - SIZE_LENGTH))
+    else:
+        size = struct.unpack(SIZE_FORMAT, prefix)[0]
+        frameInfo = FrameInfo.legacy()
+
+    if maxSizeInBytes != None and size > maxSizeInBytes:
+        raise RuntimeError(f"Message size {size} exceeds the maximum of {maxSizeInBytes} bytes.")
+
+    return await reader.readexactly(size), frameInfo
+
+async def recvDictAsync(reader: asyncio.StreamReader, maxSizeInBytes: int = None) -> dict:
+    payload, frameInfo = await recvFrameAsync(reader, maxSizeInBytes)
+    return decodePayload(payload, frameInfo)
+
+async def sendDictAsync(writer: asyncio.StreamWriter, theDict : dict, frameInfo : FrameInfo = None):
+    frameInfo = frameInfo if frameInfo != None else FrameInfo.legacy()
+    payload = encodePayload(theDict, frameInfo)
+    writer.write(packHeader(len(payload), frameInfo))
+    writer.write(payload)
+    await writer.drain()
 
 class JsonSocket(object):
     def __init__(self, timeout=None):
         super().__init__()
 
+        # Reconnect backoff of connectClientInsistently:
+        self.initialRetryDelayInSeconds = 0.01
+        self.maxRetryDelayInSeconds = 1.0
+
+        # Maximum number of requests of a persistent connection that are handled concurrently by the asyncio server:
+        self.maxPipelinedRequests = 64
+
+        # Smaller messages are decoded directly on the event loop of the asyncio server:
+        self.maxInlineDecodeSizeInBytes = 64 * 1024
+
+        # Blocking server: Time a connected client may take to send a message before the connection is closed.
+        self.clientReceiveTimeoutInSeconds = 30.0
+
+        # Blocking server: Persistent connections are served by their own threads, so they don't occupy the workers of one-shot messages.
+        # Idle persistent connections are closed after persistentIdleTimeoutInSeconds, further persistent connections are rejected.
+        self.maxPersistentConnections = 64
+        self.persistentIdleTimeoutInSeconds = 300.0
+        self.persistentConnectionCount = 0
+        self.persistentConnectionLock = threading.Lock()
+
         self.sock : socket = None
         self.running = True
         self.timeout = timeout
 
+        # Set while the asyncio server is running:
+        self.serverLoop: asyncio.AbstractEventLoop = None
+        self.serverStopEvent: asyncio.Event = None
+
     def connectClient(self, port, host = None):
         """
         Tries to connect once. Raises an exception if the connection fails.
@@ -68,6 +265,7 @@ class JsonSocket(object):
             host = socket.gethostname()
 
         connected = False
+        retryDelay = self.initialRetryDelayInSeconds
         tStart = time.time()
         while not connected and (self.timeout == None or (time.time() - tStart) < self.timeout):
             try:
@@ -75,8 +273,13 @@ class JsonSocket(object):
                 self.sock.connect((host, port))
                 self.sock.settimeout(self.timeout)
                 connected = True
-            except:
-                pass
+            except OSError:
+                self.sock.close()
+
+                # Back off exponentially instead of spinning while the server is unavailable:
+                delay = retryDelay if self.timeout == None else min(retryDelay, max(self.timeout - (time.time() - tStart), 0.0))
+                time.sleep(delay)
+                retryDelay = min(retryDelay * 2.0, self.maxRetryDelayInSeconds)
 
         if not connected:
             raise socket.timeout(f"Could not connect to ({host},{port}). Timeout.")
@@ -93,13 +296,120 @@ class JsonSocket(object):
 
     def runServer(self):
         """
-        If the host is None, socket.gethostname() is used.
+        Serves connections with a pool of numConnections threads (see connectServer) until close() is called.
+        One-shot messages are handled by the pool. Persistent connections are moved to their own thread after their first request.
         """
         with ThreadPoolExecutor(max_workers=self.numConnections) as executor:
             while self.running:
                 clientSocket, address = self.sock.accept()
                 executor.submit(self.processClientSocket, clientSocket, address)
     
+    def runAsyncServer(self, port, host = None, maxConnections=100, maxConcurrentRequests=4, maxMessageSizeInBytes=None, backlog=128):
+        """
+        Runs an asyncio based server until close() is called. Wire-compatible with sendDict/recvDict clients.
+        Messages are read with readexactly and handled by handleClientData on a thread pool with maxConcurrentRequests workers.
+
+        Backpressure: At most maxConnections connections are read concurrently. Further connections are accepted but not read
+        until a slot is free, so their senders are throttled by TCP flow control instead of piling up in the listen backlog.
+        If the host is None, socket.gethostname() is used.
+        """
+        if host == None:
+            host = socket.gethostname()
+
+        asyncio.run(self.serveAsync(port, host, maxConnections, maxConcurrentRequests, maxMessageSizeInBytes, backlog))
+
+    async def serveAsync(self, port, host, maxConnections, maxConcurrentRequests, maxMessageSizeInBytes, backlog):
+        self.serverLoop = asyncio.get_running_loop()
+        self.serverStopEvent = asyncio.Event()
+        connectionSlots = asyncio.Semaphore(maxConnections)
+
+        with ThreadPoolExecutor(max_workers=maxConcurrentRequests) as executor:
+            async def onClientConnected(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+                try:
+                    async with connectionSlots:
+                        await self.processClientStream(reader, writer, executor, maxMessageSizeInBytes)
+                except asyncio.CancelledError:
+                    # Open connections are cancelled when the server shuts down.
+                    pass
+
+            server = await asyncio.start_server(onClientConnected, host, port, backlog=backlog)
+            async with server:
+                if not self.running:
+                    return
+
+                await self.serverStopEvent.wait()
+
+        self.serverLoop = None
+
+    async def processClientStream(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter, executor: ThreadPoolExecutor, maxMessageSizeInBytes):
+        address = writer.get_extra_info('peername')
+        loop = asyncio.get_running_loop()
+        pipelineSlots = asyncio.Semaphore(self.maxPipelinedRequests)
+        writeLock = asyncio.Lock()
+        pendingRequests = set()
+
+        try:
+            while True:
+                try:
+                    payload, frameInfo = await recvFrameAsync(reader, maxMessageSizeInBytes)
+                except asyncio.IncompleteReadError as e:
+                    if len(e.partial) > 0:
+                        logger.warning(f"Connection from {address} was closed before a complete message was received.")
+                    break
+
+                # Decoding large payloads and handling the request may be CPU-heavy and must not block the event loop:
+                if len(payload) <= self.maxInlineDecodeSizeInBytes:
+                    dataDictionary = decodePayload(payload, frameInfo)
+                else:
+                    dataDictionary = await loop.run_in_executor(executor, decodePayload, payload, frameInfo)
+
+                if not REQUEST_ID_KEY in dataDictionary:
+                    await loop.run_in_executor(executor, self.handleClientData, address, dataDictionary)
+                    break
+
+                await pipelineSlots.acquire()
+                request = asyncio.ensure_future(self.processRequestAsync(writer, writeLock, executor, address, dataDictionary, frameInfo))
+                request.add_done_callback(lambda _: pipelineSlots.release())
+                pendingRequests.add(request)
+                request.add_done_callback(pendingRequests.discard)
+
+            if len(pendingRequests) > 0:
+                await asyncio.gather(*pendingRequests, return_exceptions=True)
+        except Exception as e:
+            logger.error(f"Failed to process the message from {address}. Reason: {str(e)}")
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except Exception:
+                pass
+
+    async def processRequestAsync(self, writer: asyncio.StreamWriter, writeLock: asyncio.Lock, executor: ThreadPoolExecutor, address, requestDict: dict, frameInfo: FrameInfo):
+        response = await asyncio.get_running_loop().run_in_executor(executor, self.processRequest, address, requestDict)
+
+        # Responses use the framing and codec of the request:
+        async with writeLock:
+            await sendDictAsync(writer, response, frameInfo)
+
+    def processRequest(self, address, requestDict: dict) -> dict:
+        """
+        Handles a request of the persistent protocol and returns the response dict.
+        """
+        requestId = requestDict.pop(REQUEST_ID_KEY)
+        try:
+            result = self.handleRequest(address, requestDict)
+            return {REQUEST_ID_KEY: requestId, 'success': True, 'result': result}
+        except Exception as e:
+            return {REQUEST_ID_KEY: requestId, 'success': False, 'error': str(e)}
+
+    def handleRequest(self, address, dataDictionary : dict):
+        """
+        Handles a request of the persistent protocol. This function is meant to be overriden.
+        The returned value must be json serializable and is sent back as result. Raised exceptions are sent back as error.
+        By default the data is passed to handleClientData.
+        """
+        self.handleClientData(address, dataDictionary)
+
     def handleClientSocket(self, clientSocket : socket.socket, address, dataDictionary : dict):
         """
         Executed on a different thread. This function is meant to be overriden.
@@ -108,14 +418,75 @@ class JsonSocket(object):
         print(f"Handling client socket with address {address}")
         print(dataDictionary)
 
+    def handleClientData(self, address, dataDictionary : dict):
+        """
+        Executed on a thread of the asyncio server. This function is meant to be overriden.
+        By default the data is passed to handleClientSocket without a client socket.
+        """
+        self.handleClientSocket(None, address, dataDictionary)
+
     def processClientSocket(self, clientSocket, address):
-        dataDictionary = recvDict(clientSocket)
-        self.handleClientSocket(clientSocket, address, dataDictionary)
-        clientSocket.close()
+        servedByThread = False
+        try:
+            # A client that connects but doesn't send anything must not occupy the worker:
+            clientSocket.settimeout(self.clientReceiveTimeoutInSeconds)
+            dataDictionary, frameInfo = recvMessage(clientSocket)
+            if not REQUEST_ID_KEY in dataDictionary:
+                self.handleClientSocket(clientSocket, address, dataDictionary)
+                return
+
+            with self.persistentConnectionLock:
+                accepted = self.persistentConnectionCount < self.maxPersistentConnections
+                if accepted:
+                    self.persistentConnectionCount += 1
+
+            if not accepted:
+                logger.warning(f"Rejected the persistent connection from {address}: {self.maxPersistentConnections} persistent connections are open.")
+                sendDict(clientSocket, {REQUEST_ID_KEY: dataDictionary.get(REQUEST_ID_KEY), 'success': False, 
+                                        'error': 'Too many persistent connections.'}, frameInfo)
+                return
+
+            threading.Thread(target=self.processPersistentConnection, args=(clientSocket, address, dataDictionary, frameInfo),
+                             name='JsonSocketPersistentConnection', daemon=True).start()
+            servedByThread = True
+        except Exception as e:
+            logger.error(f"Failed to process the message from {address}. Reason: {str(e)}")
+        finally:
+            if not servedByThread:
+                clientSocket.close()
+
+    def processPersistentConnection(self, clientSocket, address, dataDictionary: dict, frameInfo: FrameInfo):
+        """
+        Handles the requests of a persistent connection in order until the client closes the connection or is idle for too long.
+        """
+        try:
+            while self.running:
+                clientSocket.settimeout(self.clientReceiveTimeoutInSeconds)
+                sendDict(clientSocket, self.processRequest(address, dataDictionary), frameInfo)
+
+                try:
+                    clientSocket.settimeout(self.persistentIdleTimeoutInSeconds)
+                    dataDictionary, frameInfo = recvMessage(clientSocket)
+                except socket.timeout:
+                    logger.info(f"Closing the idle persistent connection from {address}.")
+                    break
+                except (RuntimeError, ConnectionError):
+                    break
+        except Exception as e:
+            logger.error(f"Failed to process the request from {address}. Reason: {str(e)}")
+        finally:
+            clientSocket.close()
+            with self.persistentConnectionLock:
+                self.persistentConnectionCount -= 1
 
     def close(self):
         self.running = False
-        self.sock.close()
+
+        if self.serverLoop != None:
+            self.serverLoop.call_soon_threadsafe(self.serverStopEvent.set)
+
+        if self.sock:
+            self.sock.close()
 
 if __name__ == "__main__":
     serverSocket = JsonSocket()
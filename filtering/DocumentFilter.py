@@ -1,11 +1,23 @@
-from typing import Callable
+from typing import Callable, List
 
 
 class DocumentFilter(object):
-    def __init__(self, filterFunction = None, uniqueFilterLabel : str = None, active : bool = False, hasStringArg : bool = False) -> None:
+    def __init__(self, filterFunction = None, uniqueFilterLabel : str = None, active : bool = False, hasStringArg : bool = False, requiredFields : List[str] = None,
+                 mongoQueryFunction = None, mongoQueryIsExact : bool = True) -> None:
+        """
+        Args:
+            requiredFields (List[str], optional): The document fields the filter function reads. None means the filter needs the whole document.
+            mongoQueryFunction (optional): Returns a mongodb query fragment for the filter (called with the args if hasStringArg is true) 
+                                           so it can be evaluated by the server. May return None if the current args can't be translated.
+            mongoQueryIsExact (bool, optional): If true, the query fragment is equivalent to the filter function and the function is skipped.
+                                                Otherwise the fragment is only a necessary condition used to prefilter documents on the server.
+        """
         super().__init__()
 
         self.filterFunction: Callable[[dict, str], bool] = filterFunction
+        self.requiredFields = requiredFields
+        self.mongoQueryFunction: Callable[..., dict] = mongoQueryFunction
+        self.mongoQueryIsExact = mongoQueryIsExact
         self.uniqueFilterLabel = uniqueFilterLabel
         self.active = active
         self.args = None
@@ -29,15 +41,54 @@ class DocumentFilter(object):
         else:
             return True
 
+    def getMongoQuery(self) -> dict:
+        """Returns the mongodb query fragment of the active filter or None if the filter can't be evaluated by the server.
+        """
+        if not self.active or self.mongoQueryFunction == None:
+            return None
+
+        query = self.mongoQueryFunction(self.args) if self.hasStringArg else self.mongoQueryFunction()
+        if query == None:
+            return None
+
+        if self.negate:
+            # The negation of a necessary condition doesn't filter anything reliably:
+            if not self.mongoQueryIsExact:
+                return None
+
+            return {'$nor': [query]}
+
+        return query
+
+    @property
+    def requiresPythonApply(self) -> bool:
+        """True if the filter function must be applied to the fetched documents.
+        """
+        return self.active and (not self.mongoQueryIsExact or self.getMongoQuery() == None)
+
     def copy(self):
         f = self.__class__()
         f.filterFunction = self.filterFunction
+        f.requiredFields = self.requiredFields
+        f.mongoQueryFunction = self.mongoQueryFunction
+        f.mongoQueryIsExact = self.mongoQueryIsExact
         f.setFromDict(self.asDict())
         return f
 
     def preApply(self):
         pass
 
+    @property
+    def supportsPrefetch(self) -> bool:
+        """If True, prefetch is called with chunks of fetched documents before the filter is applied to them.
+        """
+        return False
+
+    def prefetch(self, documents):
+        """Can be overriden to batch expensive lookups (e.g. file system access) for the given documents.
+        """
+        pass
+
     def postApply(self):
         pass
 
@@ -1,11 +1,28 @@
 from MetadataManagerCore import Keys
 from MetadataManagerCore.Event import Event
 from MetadataManagerCore.filtering.DocumentFilter import DocumentFilter
-from typing import List
+from MetadataManagerCore.filtering.HasPreviewFilter import HasPreviewFilter
+from MetadataManagerCore.filtering.PreviewExistenceCache import PreviewExistenceCache
+from typing import List, Tuple
 from MetadataManagerCore.mongodb_manager import MongoDBManager
 import os
 import re
-from MetadataManagerCore.animation import anim_util
+import time
+import itertools
+
+class FilterStageStatistics(object):
+    def __init__(self, label: str, remainingCount: int, removedCount: int, durationInSeconds: float, evaluatedOnServer: bool) -> None:
+        super().__init__()
+
+        self.label = label
+        self.remainingCount = remainingCount
+        self.removedCount = removedCount
+        self.durationInSeconds = durationInSeconds
+        self.evaluatedOnServer = evaluatedOnServer
+
+    def __str__(self):
+        location = 'server' if self.evaluatedOnServer else 'python'
+        return f'{self.label} ({location}): removed {self.removedCount}, remaining {self.remainingCount}, took {self.durationInSeconds * 1000.0:.0f}ms'
 
 class DocumentFilterManager(object):
     def __init__(self, dbManager : MongoDBManager) -> None:
@@ -16,10 +33,18 @@ class DocumentFilterManager(object):
 
         self.onFilterListUpdateEvent = Event()
 
-        self.addFilter(DocumentFilter(self.hasPreviewFilter, 'Has Preview'))
+        # Number of documents passed to DocumentFilter.prefetch at once:
+        self.prefetchChunkSize = 512
+        self.previewCache = PreviewExistenceCache()
+        self.hasPreviewDocumentFilter = HasPreviewFilter(self.previewCache)
+
+        self.addFilter(self.hasPreviewDocumentFilter)
 
         self.collectionToFiltersDict = dict()
 
+    def shutdown(self):
+        self.previewCache.shutdown()
+
     def getFilterFromLabel(self, uniqueFilterLabel : str, collectionNames: List[str] = None):
         customFilters = self.getFilters(collectionNames)
 
@@ -29,6 +54,20 @@ class DocumentFilterManager(object):
         
         return None
 
+    def createFilterFromDict(self, filterDict: dict, collectionNames: List[str] = None) -> DocumentFilter:
+        """Returns a copy of the registered filter with the label of the filter dictionary (see DocumentFilter.asDict) configured from the dictionary.
+        The registered filter itself is not changed.
+        """
+        uniqueFilterLabel = filterDict.get('uniqueFilterLabel')
+        registeredFilter = self.getFilterFromLabel(uniqueFilterLabel, collectionNames)
+        if registeredFilter == None:
+            raise RuntimeError(f"Unknown document filter: {uniqueFilterLabel}")
+
+        documentFilter = registeredFilter.copy()
+        documentFilter.collectionName = registeredFilter.collectionName
+        documentFilter.setFromDict(filterDict)
+        return documentFilter
+
     def getFilters(self, collectionNames: List[str] = None) -> List[DocumentFilter]:
         if collectionNames == None:
             collectionNames = []
@@ -87,35 +126,194 @@ class DocumentFilterManager(object):
                 
         return True
 
-    def yieldFilteredDocuments(self, collectionName : str, mongodbFilter : dict = {}, distinctionText : str = '', filters : List[DocumentFilter] = None):
-        if filters == None:
-            filters = []
+    def getCollectionFilters(self, collectionName : str, filters : List[DocumentFilter] = None) -> List[DocumentFilter]:
+        """Returns the given filters extended by the filters registered for the collection.
+        """
+        filters = list(filters) if filters != None else []
 
+        # Given filters replace the collection filters with the same label (e.g. configured copies, see createFilterFromDict):
+        labels = set(f.uniqueFilterLabel for f in filters)
         collectionFilters = self.collectionToFiltersDict.get(collectionName, [])
         for f in collectionFilters:
-            if not f in filters:
+            if not f.uniqueFilterLabel in labels:
                 filters.append(f)
 
+        return filters
+
+    def getProjection(self, requiredFields : List[str], filters : List[DocumentFilter] = None) -> dict:
+        """Returns a projection containing the required fields, the fields read by the active filters and the system keys.
+        None is returned if the whole document is needed.
+        """
+        if requiredFields == None:
+            return None
+
+        projection = MongoDBManager.toProjection(requiredFields)
+        if not any(projection.values()):
+            # Exclusion projections can't be extended:
+            return projection
+
+        fields = set(Keys.systemKeys)
+        fields.add(Keys.collection)
+
+        for docFilter in (filters if filters != None else []):
+            if docFilter.requiresPythonApply:
+                if docFilter.requiredFields == None:
+                    return None
+
+                fields.update(docFilter.requiredFields)
+
+        for field in fields:
+            projection[field] = 1
+
+        return projection
+
+    def yieldFilteredDocuments(self, collectionName : str, mongodbFilter : dict = {}, distinctionText : str = '', filters : List[DocumentFilter] = None, 
+                               serverSideDistinction = False, projection = None, batchSize : int = None, sort = None):
+        """
+        Yields the documents of the collection that pass the mongodb filter and the custom python filters.
+        If a projection (list of fields or projection dictionary) is given, it is extended by the fields the active filters require.
+        sort is a list of (key, direction) pairs, see MongoDBManager.getFilteredDocuments.
+        """
+        filters = self.getCollectionFilters(collectionName, filters)
+
+        if projection != None:
+            projection = self.getProjection(projection, filters)
+
+        # Filters with a mongodb query fragment are evaluated by the server:
+        mongoQueries, pythonFilters = self.splitFilters(filters)
+        mongodbFilter = self.combineMongoQueries(mongodbFilter, mongoQueries)
+
         for filter in filters:
             filter.preApply()
-            
-        for document in self.dbManager.getFilteredDocuments(collectionName, mongodbFilter, distinctionText):
-            if self.applyFilters(document, filters):
-                yield document
+
+        documents = self.dbManager.getFilteredDocuments(collectionName, mongodbFilter, distinctionText, serverSideDistinction, batchSize, projection, sort)
+        prefetchFilters = [f for f in pythonFilters if f.supportsPrefetch]
+
+        if len(prefetchFilters) > 0:
+            while True:
+                chunk = list(itertools.islice(documents, self.prefetchChunkSize))
+                if len(chunk) == 0:
+                    break
+
+                for prefetchFilter in prefetchFilters:
+                    prefetchFilter.prefetch(chunk)
+
+                for document in chunk:
+                    if self.applyFilters(document, pythonFilters):
+                        yield document
+        else:
+            for document in documents:
+                if self.applyFilters(document, pythonFilters):
+                    yield document
 
         for filter in filters:
             filter.postApply()
 
-    def hasPreviewFilter(self, document):
-        try:
-            previewPath = document.get(Keys.preview)
+    def splitFilters(self, filters : List[DocumentFilter]) -> Tuple[List[dict], List[DocumentFilter]]:
+        """Returns the mongodb query fragments of the active filters and the filters that must be applied in python.
+        """
+        mongoQueries = []
+        pythonFilters = []
+        for docFilter in filters:
+            if not docFilter.active:
+                continue
 
-            if '#' in previewPath:
-                return anim_util.hasExistingFrameFilenames(previewPath)
-                
-            return os.path.exists(previewPath)
-        except:
-            return False
+            mongoQuery = docFilter.getMongoQuery()
+            if mongoQuery != None:
+                mongoQueries.append(mongoQuery)
+
+            if docFilter.requiresPythonApply:
+                pythonFilters.append(docFilter)
+
+        return mongoQueries, pythonFilters
+
+    @staticmethod
+    def combineMongoQueries(mongodbFilter : dict, mongoQueries : List[dict]) -> dict:
+        queries = ([mongodbFilter] if mongodbFilter else []) + list(mongoQueries)
+        if len(queries) == 0:
+            return {}
+
+        return queries[0] if len(queries) == 1 else {'$and': queries}
+
+    def explainFilteredDocuments(self, collectionName : str, mongodbFilter : dict = {}, filters : List[DocumentFilter] = None) -> List[FilterStageStatistics]:
+        """
+        Benchmarks the filter chain of yieldFilteredDocuments and returns per stage how many documents were removed and how long the stage took.
+        The server-side stages are measured with count queries, the python stages by streaming the remaining documents (distinction is not considered).
+        """
+        filters = self.getCollectionFilters(collectionName, filters)
+        collection = self.dbManager.db[collectionName]
+        stages: List[FilterStageStatistics] = []
+
+        tStart = time.time()
+        remainingCount = collection.count_documents({})
+        stages.append(FilterStageStatistics('Collection', remainingCount, 0, time.time() - tStart, True))
+
+        def addServerStage(label, query):
+            nonlocal remainingCount
+            tStart = time.time()
+            count = collection.count_documents(query)
+            stages.append(FilterStageStatistics(label, count, remainingCount - count, time.time() - tStart, True))
+            remainingCount = count
+
+        serverQuery = mongodbFilter if mongodbFilter else {}
+        addServerStage('Mongodb Filter', serverQuery)
+
+        pythonFilters = []
+        for docFilter in filters:
+            if not docFilter.active:
+                continue
+
+            mongoQuery = docFilter.getMongoQuery()
+            if mongoQuery != None:
+                serverQuery = DocumentFilterManager.combineMongoQueries(serverQuery, [mongoQuery])
+                addServerStage(docFilter.uniqueFilterLabel, serverQuery)
+
+            if docFilter.requiresPythonApply:
+                pythonFilters.append(docFilter)
+
+        if len(pythonFilters) > 0:
+            removedCounts = [0] * len(pythonFilters)
+            durations = [0.0] * len(pythonFilters)
+            tStart = time.time()
+
+            for docFilter in pythonFilters:
+                docFilter.preApply()
+
+            documents = self.dbManager.getFilteredDocuments(collectionName, serverQuery)
+            while True:
+                chunk = list(itertools.islice(documents, self.prefetchChunkSize))
+                if len(chunk) == 0:
+                    break
+
+                for i, docFilter in enumerate(pythonFilters):
+                    if docFilter.supportsPrefetch:
+                        tFilterStart = time.time()
+                        docFilter.prefetch(chunk)
+                        durations[i] += time.time() - tFilterStart
+
+                for document in chunk:
+                    for i, docFilter in enumerate(pythonFilters):
+                        tFilterStart = time.time()
+                        passed = docFilter.apply(document)
+                        durations[i] += time.time() - tFilterStart
+                        if not passed:
+                            removedCounts[i] += 1
+                            break
+
+            for docFilter in pythonFilters:
+                docFilter.postApply()
+
+            transferDuration = time.time() - tStart - sum(durations)
+            stages.append(FilterStageStatistics('Document Transfer', remainingCount, 0, transferDuration, True))
+
+            for docFilter, removedCount, duration in zip(pythonFilters, removedCounts, durations):
+                remainingCount -= removedCount
+                stages.append(FilterStageStatistics(docFilter.uniqueFilterLabel, remainingCount, removedCount, duration, False))
+
+        return stages
+
+    def hasPreviewFilter(self, document):
+        return self.hasPreviewDocumentFilter.hasPreview(document)
 
     def stringToFilter(self, filterString : str) -> dict:
         return self.dbManager.stringToFilter(filterString)
\ No newline at end of file
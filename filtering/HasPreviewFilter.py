@@ -0,0 +1,53 @@
+from MetadataManagerCore import Keys
+from MetadataManagerCore.filtering.DocumentFilter import DocumentFilter
+from MetadataManagerCore.filtering.PreviewExistenceCache import PreviewExistenceCache
+from MetadataManagerCore.animation import anim_util
+
+class HasPreviewFilter(DocumentFilter):
+    """
+    Filters documents with an existing preview file (or an existing first frame for # frame patterns).
+    Existence checks are answered from a PreviewExistenceCache that is revalidated for every filter pass.
+    """
+    def __init__(self, previewCache : PreviewExistenceCache = None, uniqueFilterLabel : str = 'Has Preview', active : bool = False) -> None:
+        super().__init__(self.hasPreview, uniqueFilterLabel, active, requiredFields=[Keys.preview], 
+                         mongoQueryFunction=HasPreviewFilter.previewQuery, mongoQueryIsExact=False)
+
+        self.previewCache = previewCache if previewCache != None else PreviewExistenceCache()
+
+    @staticmethod
+    def previewQuery():
+        return {Keys.preview: {'$type': 'string'}}
+
+    def hasPreview(self, document):
+        try:
+            previewPath = document.get(Keys.preview)
+
+            # Patterns with # in the directory can't be resolved from a single listing:
+            if '#' in previewPath and '#' in previewPath[:max(previewPath.rfind('/'), previewPath.rfind('\\')) + 1]:
+                return anim_util.hasExistingFrameFilenames(previewPath)
+
+            if '#' in previewPath:
+                return self.previewCache.hasExistingFrames(previewPath)
+                
+            return self.previewCache.exists(previewPath)
+        except:
+            return False
+
+    @property
+    def supportsPrefetch(self):
+        return True
+
+    def prefetch(self, documents):
+        self.previewCache.prefetch(document.get(Keys.preview) for document in documents)
+
+    def preApply(self):
+        self.previewCache.beginSession()
+
+    def postApply(self):
+        self.previewCache.endSession()
+
+    def copy(self):
+        f = super().copy()
+        f.previewCache = self.previewCache
+        f.filterFunction = f.hasPreview
+        return f
@@ -0,0 +1,150 @@
+from concurrent.futures import ThreadPoolExecutor
+from collections import OrderedDict
+from typing import Iterable, Set
+from MetadataManagerCore.animation import anim_util
+import threading
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+class DirectoryListing(object):
+    def __init__(self, mtime: int, filenames: Set[str], session: int) -> None:
+        super().__init__()
+
+        self.mtime = mtime
+        self.filenames = filenames
+        self.session = session
+        self.validationTime = time.time()
+
+class PreviewExistenceCache(object):
+    """
+    Answers file existence queries for preview paths from cached directory listings.
+    Each directory is listed once with a single os.scandir call instead of one stat per file, which matters on network shares.
+
+    Listings are revalidated by comparing the directory mtime once per session (see beginSession), so within a filter pass
+    a directory costs at most one stat (per maxSessionListingAgeInSeconds) and one listing. Outside of sessions every query 
+    revalidates the listing with one stat, so direct callers never get outdated results. Many directories can be listed concurrently with prefetch.
+    The prefetch thread pool is created on first use and kept until shutdown().
+    """
+    def __init__(self, maxWorkers: int = 16, maxCachedDirectories: int = 10000) -> None:
+        super().__init__()
+
+        self.maxWorkers = maxWorkers
+        self.maxCachedDirectories = maxCachedDirectories
+        self.listings: OrderedDict[str, DirectoryListing] = OrderedDict()
+        self.lock = threading.Lock()
+        self.session = 0
+        self.activeSessionCount = 0
+        # Bounds the staleness if a session isn't ended, e.g. because a filter pass was abandoned:
+        self.maxSessionListingAgeInSeconds = 10.0
+        self.executor: ThreadPoolExecutor = None
+        self.executorLock = threading.Lock()
+
+    def getExecutor(self) -> ThreadPoolExecutor:
+        with self.executorLock:
+            if self.executor == None:
+                self.executor = ThreadPoolExecutor(max_workers=self.maxWorkers, thread_name_prefix='PreviewExistenceCache')
+
+            return self.executor
+
+    def shutdown(self):
+        with self.executorLock:
+            if self.executor != None:
+                self.executor.shutdown(wait=True)
+                self.executor = None
+
+    def beginSession(self):
+        """Starts a new session. Cached listings are revalidated on their first access within the session.
+        """
+        with self.lock:
+            self.session += 1
+            self.activeSessionCount += 1
+
+    def endSession(self):
+        with self.lock:
+            self.activeSessionCount = max(self.activeSessionCount - 1, 0)
+
+    def clear(self):
+        with self.lock:
+            self.listings.clear()
+
+    @staticmethod
+    def normalizeFilename(filename: str):
+        return os.path.normcase(filename)
+
+    def getListing(self, directory: str) -> DirectoryListing:
+        directory = os.path.normcase(os.path.abspath(directory))
+
+        with self.lock:
+            listing = self.listings.get(directory)
+            session = self.session
+            if listing != None:
+                self.listings.move_to_end(directory)
+                if (self.activeSessionCount > 0 and listing.session == session and 
+                    time.time() - listing.validationTime < self.maxSessionListingAgeInSeconds):
+                    return listing
+
+        try:
+            mtime = os.stat(directory).st_mtime_ns
+        except OSError:
+            mtime = None
+
+        if listing != None and listing.mtime == mtime:
+            listing.session = session
+            listing.validationTime = time.time()
+            return listing
+
+        filenames = set()
+        if mtime != None:
+            try:
+                with os.scandir(directory) as entries:
+                    filenames = set(PreviewExistenceCache.normalizeFilename(entry.name) for entry in entries)
+            except OSError as e:
+                logger.warning(f'Failed to list directory {directory}: {str(e)}')
+
+        listing = DirectoryListing(mtime, filenames, session)
+
+        with self.lock:
+            self.listings[directory] = listing
+            self.listings.move_to_end(directory)
+            while len(self.listings) > self.maxCachedDirectories:
+                self.listings.popitem(last=False)
+
+        return listing
+
+    def exists(self, path: str) -> bool:
+        directory, filename = os.path.split(path)
+        return PreviewExistenceCache.normalizeFilename(filename) in self.getListing(directory if directory else '.').filenames
+
+    def hasExistingFrames(self, framePattern: str) -> bool:
+        """Equivalent to anim_util.hasExistingFrameFilenames: True if the first frame (index 0 or 1) of the # pattern exists.
+        """
+        directory, filename = os.path.split(framePattern)
+        if not '#' in filename:
+            return self.exists(framePattern)
+
+        filenames = self.getListing(directory if directory else '.').filenames
+        for idx in [0, 1]:
+            if PreviewExistenceCache.normalizeFilename(anim_util.getFrameFilename(filename, idx)) in filenames:
+                return True
+
+        return False
+
+    def prefetch(self, paths: Iterable[str]):
+        """Lists the directories of the given paths concurrently.
+        """
+        directories = set()
+        for path in paths:
+            if isinstance(path, str):
+                directory = os.path.dirname(path)
+                directories.add(directory if directory else '.')
+
+        if len(directories) <= 1:
+            for directory in directories:
+                self.getListing(directory)
+            return
+
+        for _ in self.getExecutor().map(self.getListing, directories):
+            pass
@@ -0,0 +1,142 @@
+from MetadataManagerCore.mongodb_manager import MongoDBManager
+from pymongo import UpdateOne
+from datetime import datetime
+from typing import Callable, Dict, List
+import pymongo
+import threading
+import random
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class HeartbeatRegistration(object):
+    def __init__(self, registrationId: str, collectionName: str, documentFilter: dict, upsert: bool, onFailure: Callable[[Exception], None]) -> None:
+        super().__init__()
+
+        self.registrationId = registrationId
+        self.collectionName = collectionName
+        self.documentFilter = documentFilter
+        self.upsert = upsert
+        self.onFailure = onFailure
+
+class HeartbeatWriter(object):
+    """
+    Writes the heartbeats of the host process and all service processes of this process with one bulk write per collection and interval
+    instead of one thread and one write per heartbeat.
+
+    The interval is jittered so a fleet restart doesn't synchronize the writes of all hosts. The measured write latency is exposed 
+    and written next to the heartbeat time so controllers can adapt the time after which a process is considered dead.
+    """
+    HEARTBEAT_TIME_KEY = 'heartbeat_time'
+    HEARTBEAT_LATENCY_KEY = 'heartbeat_latency'
+
+    def __init__(self, dbManager: MongoDBManager, intervalInSeconds: float = 1.0, jitterInSeconds: float = 0.2) -> None:
+        super().__init__()
+
+        self.dbManager = dbManager
+        self.intervalInSeconds = intervalInSeconds
+        self.jitterInSeconds = jitterInSeconds
+        self.isRunning = True
+        self.lock = threading.Lock()
+        self.registrations: Dict[str, HeartbeatRegistration] = dict()
+
+        self.lastWriteLatencyInSeconds: float = None
+        self.averageWriteLatencyInSeconds: float = None
+        self.maxWriteLatencyInSeconds: float = None
+        self.latencySmoothingFactor = 0.2
+
+        # Collections whose last heartbeat write failed with a connection error:
+        self.failingCollectionNames = set()
+
+    def register(self, registrationId: str, collectionName: str, documentFilter: dict, upsert: bool = False, onFailure: Callable[[Exception], None] = None):
+        """Registers a heartbeat that sets the heartbeat time of the documents matching documentFilter in every interval.
+        onFailure is called with the exception if the heartbeat document can't be written (a write error of the document). 
+        The registration is removed in that case. Connection errors are retried in the next interval and keep the registration.
+        """
+        with self.lock:
+            self.registrations[registrationId] = HeartbeatRegistration(registrationId, collectionName, documentFilter, upsert, onFailure)
+
+    def unregister(self, registrationId: str):
+        with self.lock:
+            self.registrations.pop(registrationId, None)
+
+    def isRegistered(self, registrationId: str):
+        with self.lock:
+            return registrationId in self.registrations
+
+    def shutdown(self):
+        self.isRunning = False
+
+    def nextIntervalInSeconds(self):
+        return max(self.intervalInSeconds + random.uniform(-self.jitterInSeconds, self.jitterInSeconds), 0.0)
+
+    def run(self):
+        # Desynchronize the first write of processes that were started at the same time:
+        time.sleep(random.uniform(0.0, self.intervalInSeconds))
+
+        while self.isRunning:
+            tStart = time.time()
+            self.writeHeartbeats()
+            time.sleep(max(self.nextIntervalInSeconds() - (time.time() - tStart), 0.0))
+
+    def writeHeartbeats(self):
+        """Writes all registered heartbeats with one bulk write per collection.
+        """
+        with self.lock:
+            registrationsByCollection: Dict[str, List[HeartbeatRegistration]] = dict()
+            for registration in self.registrations.values():
+                registrationsByCollection.setdefault(registration.collectionName, []).append(registration)
+
+        for collectionName, registrations in registrationsByCollection.items():
+            values = {HeartbeatWriter.HEARTBEAT_TIME_KEY: datetime.utcnow(), HeartbeatWriter.HEARTBEAT_LATENCY_KEY: self.lastWriteLatencyInSeconds}
+            requests = [UpdateOne(r.documentFilter, {'$set': values}, upsert=r.upsert) for r in registrations]
+
+            tStart = time.time()
+            try:
+                self.dbManager.db[collectionName].bulk_write(requests, ordered=False)
+                self.recordLatency(time.time() - tStart)
+            except pymongo.errors.BulkWriteError as e:
+                self.recordLatency(time.time() - tStart)
+                for writeError in e.details.get('writeErrors', []):
+                    self.failRegistration(registrations[writeError.get('index')], RuntimeError(writeError.get('errmsg')))
+            except Exception as e:
+                # Transient errors (e.g. a lost connection) must not end the heartbeats, the write is retried in the next interval:
+                if not collectionName in self.failingCollectionNames:
+                    logger.error(f'Heartbeat write to {collectionName} failed, retrying in the next interval. Reason: {str(e)}')
+                    self.failingCollectionNames.add(collectionName)
+
+                continue
+
+            if collectionName in self.failingCollectionNames:
+                logger.info(f'Heartbeat write to {collectionName} succeeded again.')
+                self.failingCollectionNames.discard(collectionName)
+
+    def failRegistration(self, registration: HeartbeatRegistration, exception: Exception):
+        logger.error(f'Heartbeat update of {registration.registrationId} failed with exception: {str(exception)}')
+        self.unregister(registration.registrationId)
+
+        if registration.onFailure:
+            try:
+                registration.onFailure(exception)
+            except Exception as e:
+                logger.error(f'Heartbeat failure handling of {registration.registrationId} failed with exception: {str(e)}')
+
+    def recordLatency(self, latencyInSeconds: float):
+        self.lastWriteLatencyInSeconds = latencyInSeconds
+        self.maxWriteLatencyInSeconds = latencyInSeconds if self.maxWriteLatencyInSeconds == None else max(self.maxWriteLatencyInSeconds, latencyInSeconds)
+
+        if self.averageWriteLatencyInSeconds == None:
+            self.averageWriteLatencyInSeconds = latencyInSeconds
+        else:
+            s = self.latencySmoothingFactor
+            self.averageWriteLatencyInSeconds = (1.0 - s) * self.averageWriteLatencyInSeconds + s * latencyInSeconds
+
+    def getDyingTimeInSeconds(self, baseDyingTimeInSeconds: float, writeLatencyInSeconds: float = None) -> float:
+        """Returns the time after which a process with missing heartbeats should be considered dead.
+        It is at least baseDyingTimeInSeconds and grows with the heartbeat write latency.
+        """
+        if writeLatencyInSeconds == None:
+            writeLatencyInSeconds = self.averageWriteLatencyInSeconds if self.averageWriteLatencyInSeconds != None else 0.0
+
+        return max(baseDyingTimeInSeconds, 2.0 * (self.intervalInSeconds + self.jitterInSeconds) + 4.0 * writeLatencyInSeconds)
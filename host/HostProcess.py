@@ -1,6 +1,8 @@
 from MetadataManagerCore.Event import Event
 from typing import Any
 from MetadataManagerCore.mongodb_manager import MongoDBManager
+from MetadataManagerCore.host.HeartbeatWriter import HeartbeatWriter
+from MetadataManagerCore import Keys
 import socket
 from datetime import datetime, timedelta
 import time
@@ -10,10 +12,11 @@ class HostProcess(object):
     # If the host doesn't update it's heartbeat time within this time interval it will be considered dead.
     dyingTimeInSeconds = 5.0
 
-    def __init__(self, dbManager: MongoDBManager) -> None:
+    def __init__(self, dbManager: MongoDBManager, heartbeatWriter: HeartbeatWriter = None) -> None:
         super().__init__()
 
         self.dbManager = dbManager
+        self.heartbeatWriter = heartbeatWriter
         self.hostname = socket.gethostname()
 
         self.heartbeatIntervalInSeconds = 1.0
@@ -25,7 +28,16 @@ class HostProcess(object):
         HostProcess.updateMongoDBEntry(self.dbManager, self.hostname, self.pid, 'close', False)
         self.signalHeartbeat()
 
+        if self.heartbeatWriter:
+            self.heartbeatWriter.register(self.hostProcessId, Keys.HOST_PROCESSES_COLLECTION, {'hostname': self.hostname, 'pid': self.pid}, upsert=True)
+
+    @property
+    def hostProcessId(self):
+        return f'{self.hostname}_{self.pid}'
+
     def runHeartbeat(self):
+        """Legacy heartbeat loop used if the host process has no shared heartbeat writer.
+        """
         while self.isRunning:
             if datetime.utcnow() - self.lastUpdateTime > timedelta(seconds=self.heartbeatIntervalInSeconds):
                 self.signalHeartbeat()
@@ -56,6 +68,9 @@ class HostProcess(object):
     def shutdown(self):
         self.isRunning = False
 
+        if self.heartbeatWriter:
+            self.heartbeatWriter.unregister(self.hostProcessId)
+
         # Remove db entry:
         HostProcess.delete(self.dbManager, self.hostname, self.pid)
 
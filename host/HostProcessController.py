@@ -1,8 +1,9 @@
 from MetadataManagerCore.host.HostProcess import HostProcess
+from MetadataManagerCore.host.HeartbeatWriter import HeartbeatWriter
+from MetadataManagerCore.host.HostProcessMembershipTracker import HostProcessMembershipTracker
+from MetadataManagerCore.task_processor.DistributedDocumentAction import DistributedDocumentActionWorker
 from typing import Dict
 from MetadataManagerCore.mongodb_manager import MongoDBManager
-import time
-from datetime import datetime, timedelta
 from MetadataManagerCore.Event import Event
 from concurrent.futures import ThreadPoolExecutor
 import logging
@@ -13,7 +14,6 @@ class HostProcessInfo(object):
 
         self.hostname = hostname
         self.pid = pid
-        self.dirty = False
 
     @property
     def hostProcessId(self):
@@ -27,16 +27,22 @@ class HostProcessController(object):
         self.isRunning = True
         self.logger = logging.getLogger(__name__)
 
-        self.dbManager.hostProcessesCollection.create_index("heartbeat_time", expireAfterSeconds=HostProcess.dyingTimeInSeconds)
-
         # Arguments are:
         self._onHostProcessAddedEvent = Event()
         self._onHostProcessRemovedEvent = Event()
 
-        self.threadPoolExecutor = ThreadPoolExecutor(max_workers=1)
+        # Runs the heartbeat writer and, if started, the distributed document action worker:
+        self.threadPoolExecutor = ThreadPoolExecutor(max_workers=2)
+        self.distributedDocumentActionWorker = None
+
+        # Writes the heartbeats of this host and of all service processes running in this process:
+        self.heartbeatWriter = HeartbeatWriter(dbManager)
 
         self._hostProcessInfos: Dict[str,HostProcessInfo] = dict()
-        self.thisHost = HostProcess(dbManager)
+        self.thisHost = HostProcess(dbManager, self.heartbeatWriter)
+        self.membershipTracker = HostProcessMembershipTracker(dbManager, self.getDyingTimeInSeconds)
+        # Dead host processes are removed by the stale sweep of the tracker, the TTL index only cleans up abandoned entries:
+        self.membershipTracker.ensureExpirationIndex()
 
     @property
     def hostProcessInfos(self) -> Dict[str,HostProcessInfo]:
@@ -65,80 +71,72 @@ class HostProcessController(object):
     def run(self):
         self.logger.info('Running controller.')
 
-        # Run this host:
-        self.threadPoolExecutor.submit(self.thisHost.runHeartbeat)
+        # Run the heartbeats of this host and its service processes:
+        self.threadPoolExecutor.submit(self.heartbeatWriter.run)
 
-        # Initialize info of available host processes:
-        hostProcesses = self.getHostProcesses()
-        if hostProcesses:
-            for processInfo in hostProcesses:
-                hostname = processInfo.get('hostname')
-                pid = processInfo.get('pid')
+        # Initialize info of available host processes without emitting events:
+        try:
+            self.membershipTracker.resync()
+        except Exception as e:
+            self.logger.error(f'Host process synchronization failed with exception: {str(e)}')
 
-                if hostname != None and pid != None:
-                    hostProcessId = HostProcessController.getHostProcessId(hostname, pid)
+        for processInfo in list(self.membershipTracker.hostProcesses.values()):
+            hostname = processInfo.get('hostname')
+            pid = processInfo.get('pid')
+            self._hostProcessInfos[HostProcessController.getHostProcessId(hostname, pid)] = HostProcessInfo(hostname, pid)
 
-                    self._hostProcessInfos[hostProcessId] = HostProcessInfo(hostname, pid)
+        self.membershipTracker.onHostProcessAddedEvent.subscribe(self.onHostProcessAdded)
+        self.membershipTracker.onHostProcessRemovedEvent.subscribe(self.removeHostProcessInfo)
+        self.membershipTracker.onHostProcessChangedEvent.subscribe(self.checkCloseRequest)
 
         # Check for host status changes:
         try:
-            while self.isRunning:
-                hostProcesses = self.getHostProcesses()
-
-                if hostProcesses:
-                    for cachedProcessInfo in self._hostProcessInfos.values():
-                        cachedProcessInfo.dirty = True
-
-                    for processInfo in hostProcesses:
-                        try:
-                            self.checkProcessInfo(processInfo)
-                        except Exception as e:
-                            self.logger.error(f'Host process check failed with exception: {str(e)}')
-
-                    removedHostProcessInfos = []
-                    for cachedProcessInfo in self._hostProcessInfos.values():
-                        if cachedProcessInfo.dirty:
-                            removedHostProcessInfos.append(cachedProcessInfo)
-
-                    for removedHostProcessInfo in removedHostProcessInfos:
-                        self.removeHostProcessInfo(removedHostProcessInfo.hostname, removedHostProcessInfo.pid)
-
-                time.sleep(1.0)
+            self.membershipTracker.run()
         except Exception as e:
             self.logger.error(str(e))
 
         self.thisHost.shutdown()
+        self.heartbeatWriter.shutdown()
+        if self.distributedDocumentActionWorker:
+            self.distributedDocumentActionWorker.shutdown()
+
         self.logger.info('Waiting for thread termination.')
         self.threadPoolExecutor.shutdown(True)
         self.logger.info('Shut down.')
 
-    def checkProcessInfo(self, processInfo):
-        hostname = processInfo.get('hostname')
-        pid = processInfo.get('pid')
-        heartbeatTime = processInfo.get('heartbeat_time')
-
-        if hostname != None and pid != None:
-            hostProcessId = HostProcessController.getHostProcessId(hostname, pid)
-
-            cachedProcessInfo = self._hostProcessInfos.get(hostProcessId)
-            if cachedProcessInfo:
-                cachedProcessInfo.dirty = False
-            else:
-                # New host process was added:
-                self._hostProcessInfos[hostProcessId] = HostProcessInfo(hostname, pid)
-                self._onHostProcessAddedEvent(hostname, pid)
-
-            # Check for heartbeat time:
-            if heartbeatTime and (datetime.utcnow() - heartbeatTime > timedelta(seconds=HostProcess.dyingTimeInSeconds)):
-                HostProcess.delete(self.dbManager, hostname, pid)
-                self.removeHostProcessInfo(hostname, pid)
-
-            # Check for close request:
-            if processInfo.get('close') and hostname == self.thisHost.hostname and pid == self.thisHost.pid:
-                try:
-                    self.thisHost.closeHostApplication()
-                except Exception as e:
-                    self.logger.error(e)
+    def startDistributedDocumentActionWorker(self, actionManager, documentFilterManager):
+        """Starts the DistributedDocumentActionWorker of this host process that processes the chunks of distributed document actions
+        submitted by any host process. Only one worker is started per controller. It is shut down with the controller.
+        """
+        if self.distributedDocumentActionWorker != None:
+            return self.distributedDocumentActionWorker
+
+        self.distributedDocumentActionWorker = DistributedDocumentActionWorker(self.dbManager, actionManager, documentFilterManager, self)
+        self.threadPoolExecutor.submit(self.distributedDocumentActionWorker.run)
+        self.logger.info('Started the distributed document action worker.')
+        return self.distributedDocumentActionWorker
+
+    def onHostProcessAdded(self, hostname: str, pid: int):
+        hostProcessId = HostProcessController.getHostProcessId(hostname, pid)
+        if not hostProcessId in self._hostProcessInfos:
+            self._hostProcessInfos[hostProcessId] = HostProcessInfo(hostname, pid)
+            self._onHostProcessAddedEvent(hostname, pid)
+
+    def checkCloseRequest(self, processInfo: dict):
+        if processInfo.get('close') and processInfo.get('hostname') == self.thisHost.hostname and processInfo.get('pid') == self.thisHost.pid:
+            try:
+                self.thisHost.closeHostApplication()
+            except Exception as e:
+                self.logger.error(e)
+
+    def getDyingTimeInSeconds(self, processInfo: dict = None) -> float:
+        """Returns the time without heartbeat after which the given host process is considered dead.
+        The time grows with the heartbeat write latency reported by the host process and measured by this process.
+        """
+        reportedLatency = processInfo.get(HeartbeatWriter.HEARTBEAT_LATENCY_KEY) if processInfo else None
+        latencies = [reportedLatency, self.heartbeatWriter.averageWriteLatencyInSeconds]
+        latency = max([l for l in latencies if l != None], default=0.0)
+        return self.heartbeatWriter.getDyingTimeInSeconds(HostProcess.dyingTimeInSeconds, latency)
 
     def getHostProcesses(self) -> dict:
         return self.dbManager.hostProcessesCollection.find({})
@@ -146,10 +144,11 @@ class HostProcessController(object):
     def shutdown(self):
         self.logger.info('Shutting down...')
         self.isRunning = False
+        self.membershipTracker.shutdown()
 
     def removeHostProcessInfo(self, hostname: str, pid: int):
-        self._hostProcessInfos.pop(HostProcessController.getHostProcessId(hostname, pid))
-        self.onHostProcessRemovedEvent(hostname, pid)
+        if self._hostProcessInfos.pop(HostProcessController.getHostProcessId(hostname, pid), None) != None:
+            self.onHostProcessRemovedEvent(hostname, pid)
         
     def closeHostProcess(self, hostname: str, pid: str):
         self.logger.info('Close Request.')
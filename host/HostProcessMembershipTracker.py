@@ -0,0 +1,238 @@
+from MetadataManagerCore.mongodb_manager import MongoDBManager
+from MetadataManagerCore.host.HeartbeatWriter import HeartbeatWriter
+from MetadataManagerCore.Event import Event
+from datetime import datetime, timedelta
+from typing import Callable, Dict
+import pymongo
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class HostProcessMembershipTracker(object):
+    """
+    Maintains the table of running host processes incrementally from a change stream on the host_processes collection.
+    Heartbeat-only updates are filtered out on the server so the tracker only receives membership and close flag changes.
+
+    Dead host processes are removed with a single server-side delete of entries with expired heartbeats every sweep interval.
+    The resulting delete events are picked up by the stream like any other removal.
+    Change streams require a replica set. On standalone servers the tracker falls back to polling and diffing the host table.
+    """
+    MEMBERSHIP_PROJECTION = {'hostname': 1, 'pid': 1, 'close': 1}
+    # The TTL index only removes entries that are never swept, e.g. because no controller is running.
+    # It must be much longer than any dying time, otherwise it removes hosts whose latency extends their dying time:
+    HEARTBEAT_EXPIRATION_IN_SECONDS = 3600
+
+    def __init__(self, dbManager: MongoDBManager, dyingTimeFunction: Callable[[dict], float] = None) -> None:
+        """
+        Args:
+            dbManager (MongoDBManager): The database manager.
+            dyingTimeFunction (Callable[[dict], float], optional): Returns the time without heartbeat after which the host process
+                of the given host document (or any host process if None is passed) is removed. 
+                The time for a document must not be less than the time for None.
+                If None, dead host processes are only removed by the TTL index after HEARTBEAT_EXPIRATION_IN_SECONDS.
+        """
+        super().__init__()
+
+        self.dbManager = dbManager
+        self.dyingTimeFunction = dyingTimeFunction
+        self.isRunning = True
+        self.pollingIntervalInSeconds = 1.0
+        self.retryIntervalInSeconds = 1.0
+        self.staleSweepIntervalInSeconds = 2.0
+        self.lastStaleSweepTime = 0.0
+        self.lock = threading.RLock()
+
+        # Key: Document id, Value: Document with the keys of MEMBERSHIP_PROJECTION.
+        self.hostProcesses: Dict[object, dict] = dict()
+
+        # None: Unknown until the first watch attempt.
+        self.changeStreamSupported: bool = None
+        self.resumeToken = None
+
+        # Arguments are: (hostname: str, pid: int)
+        self._onHostProcessAddedEvent = Event()
+        self._onHostProcessRemovedEvent = Event()
+
+        # Arguments are: (processInfo: dict)
+        self._onHostProcessChangedEvent = Event()
+
+    @property
+    def onHostProcessAddedEvent(self):
+        """ Event arguments: (hostname: str, pid: int)
+        """
+        return self._onHostProcessAddedEvent
+
+    @property
+    def onHostProcessRemovedEvent(self):
+        """ Event arguments: (hostname: str, pid: int)
+        """
+        return self._onHostProcessRemovedEvent
+
+    @property
+    def onHostProcessChangedEvent(self):
+        """ Event arguments: (processInfo: dict). Emitted if the close flag of a known host process changes.
+        """
+        return self._onHostProcessChangedEvent
+
+    @property
+    def collection(self):
+        return self.dbManager.hostProcessesCollection
+
+    def shutdown(self):
+        self.isRunning = False
+
+    def run(self):
+        while self.isRunning:
+            if self.changeStreamSupported != False:
+                try:
+                    self.watchChanges()
+                except pymongo.errors.PyMongoError as e:
+                    if self.changeStreamSupported == None:
+                        logger.info(f'Change streams are not available, falling back to polling. Reason: {str(e)}')
+                        self.changeStreamSupported = False
+                    else:
+                        logger.warning(f'Host process change stream interrupted: {str(e)}')
+                        time.sleep(self.retryIntervalInSeconds)
+                except Exception as e:
+                    logger.error(f'Host process tracking failed with exception: {str(e)}')
+                    time.sleep(self.retryIntervalInSeconds)
+            else:
+                try:
+                    self.resync()
+                    self.sweepStaleHostProcesses()
+                except Exception as e:
+                    logger.error(f'Host process tracking failed with exception: {str(e)}')
+
+                time.sleep(self.pollingIntervalInSeconds)
+
+    @staticmethod
+    def getChangeStreamPipeline():
+        updatedKeys = {'$map': {'input': {'$objectToArray': {'$ifNull': ['$updateDescription.updatedFields', {}]}}, 'in': '$$this.k'}}
+        return [{'$match': {
+            # Ignore updates that only change the heartbeat:
+            '$or': [
+                {'operationType': {'$ne': 'update'}},
+                {'$expr': {'$gt': [{'$size': {'$setDifference': [updatedKeys, [HeartbeatWriter.HEARTBEAT_TIME_KEY, HeartbeatWriter.HEARTBEAT_LATENCY_KEY]]}}, 0]}}
+            ]
+        }}]
+
+    def watchChanges(self):
+        resumeToken = self.resumeToken
+        try:
+            stream = self.collection.watch(HostProcessMembershipTracker.getChangeStreamPipeline(), full_document='updateLookup',
+                                           resume_after=resumeToken, max_await_time_ms=int(self.pollingIntervalInSeconds * 1000))
+        except pymongo.errors.OperationFailure:
+            if resumeToken == None:
+                raise
+
+            # The resume token may have expired. Start a new stream and resynchronize:
+            self.resumeToken = None
+            stream = self.collection.watch(HostProcessMembershipTracker.getChangeStreamPipeline(), full_document='updateLookup',
+                                           max_await_time_ms=int(self.pollingIntervalInSeconds * 1000))
+            resumeToken = None
+
+        with stream:
+            self.changeStreamSupported = True
+
+            # Changes that happened before the stream was opened are picked up by a full synchronization:
+            if resumeToken == None:
+                self.resync()
+
+            while self.isRunning and stream.alive:
+                change = stream.try_next()
+                self.resumeToken = stream.resume_token
+
+                if change != None:
+                    try:
+                        self.handleChange(change)
+                    except Exception as e:
+                        logger.error(f'Failed to handle host process change: {str(e)}')
+
+                self.sweepStaleHostProcesses()
+
+    def handleChange(self, change: dict):
+        operationType = change.get('operationType')
+        documentId = change.get('documentKey', {}).get('_id')
+
+        if operationType == 'delete':
+            self.removeHostProcess(documentId)
+        elif operationType in ('insert', 'update', 'replace'):
+            fullDocument = change.get('fullDocument')
+            if fullDocument != None:
+                self.applyHostProcess(fullDocument)
+        elif operationType in ('drop', 'invalidate'):
+            self.resync()
+
+    def applyHostProcess(self, processInfo: dict):
+        hostname = processInfo.get('hostname')
+        pid = processInfo.get('pid')
+        if hostname == None or pid == None:
+            return
+
+        documentId = processInfo.get('_id')
+        entry = {key: processInfo.get(key) for key in HostProcessMembershipTracker.MEMBERSHIP_PROJECTION}
+
+        with self.lock:
+            cachedEntry = self.hostProcesses.get(documentId)
+            self.hostProcesses[documentId] = entry
+
+        if cachedEntry == None:
+            self._onHostProcessAddedEvent(hostname, pid)
+        elif cachedEntry.get('close') != entry.get('close'):
+            self._onHostProcessChangedEvent(entry)
+
+    def removeHostProcess(self, documentId):
+        with self.lock:
+            entry = self.hostProcesses.pop(documentId, None)
+
+        if entry != None:
+            self._onHostProcessRemovedEvent(entry.get('hostname'), entry.get('pid'))
+
+    def resync(self):
+        """Synchronizes the host table with one query and emits the events of the differences.
+        """
+        processInfos = {p.get('_id'): p for p in self.collection.find({}, HostProcessMembershipTracker.MEMBERSHIP_PROJECTION)}
+
+        with self.lock:
+            removedIds = [documentId for documentId in self.hostProcesses if not documentId in processInfos]
+
+        for documentId in removedIds:
+            self.removeHostProcess(documentId)
+
+        for processInfo in processInfos.values():
+            self.applyHostProcess(processInfo)
+
+    def ensureExpirationIndex(self):
+        try:
+            self.collection.create_index(HeartbeatWriter.HEARTBEAT_TIME_KEY, expireAfterSeconds=HostProcessMembershipTracker.HEARTBEAT_EXPIRATION_IN_SECONDS)
+        except pymongo.errors.OperationFailure:
+            # The index exists with a different expiration time, e.g. the former dying time:
+            self.collection.database.command('collMod', self.collection.name, index={'keyPattern': {HeartbeatWriter.HEARTBEAT_TIME_KEY: 1}, 
+                                                                                     'expireAfterSeconds': HostProcessMembershipTracker.HEARTBEAT_EXPIRATION_IN_SECONDS})
+
+    def sweepStaleHostProcesses(self):
+        """Removes host processes with expired heartbeats with a single delete.
+        The TTL index only runs about once a minute so dead host processes would otherwise linger.
+
+        Candidates are queried with the minimum dying time. Each candidate is only removed if its heartbeat is older than its own dying time,
+        which grows with the heartbeat latency reported by the host. The delete matches the queried heartbeat time, 
+        so a host that wrote a heartbeat in the meantime is kept.
+        """
+        if self.dyingTimeFunction == None or time.time() - self.lastStaleSweepTime < self.staleSweepIntervalInSeconds:
+            return
+
+        self.lastStaleSweepTime = time.time()
+        now = datetime.utcnow()
+        candidateExpiredTime = now - timedelta(seconds=self.dyingTimeFunction(None))
+        projection = {HeartbeatWriter.HEARTBEAT_TIME_KEY: 1, HeartbeatWriter.HEARTBEAT_LATENCY_KEY: 1}
+
+        staleEntries = []
+        for processInfo in self.collection.find({HeartbeatWriter.HEARTBEAT_TIME_KEY: {'$lt': candidateExpiredTime}}, projection):
+            heartbeatTime = processInfo.get(HeartbeatWriter.HEARTBEAT_TIME_KEY)
+            if heartbeatTime < now - timedelta(seconds=self.dyingTimeFunction(processInfo)):
+                staleEntries.append({'_id': processInfo.get('_id'), HeartbeatWriter.HEARTBEAT_TIME_KEY: heartbeatTime})
+
+        if len(staleEntries) > 0:
+            self.collection.delete_many({'$or': staleEntries})
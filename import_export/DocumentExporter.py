@@ -0,0 +1,118 @@
+from MetadataManagerCore.mongodb_manager import MongoDBManager
+from MetadataManagerCore.filtering.DocumentFilter import DocumentFilter
+from MetadataManagerCore.filtering.DocumentFilterManager import DocumentFilterManager
+from MetadataManagerCore.import_export import document_writers
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ExportResult(object):
+    def __init__(self, collectionName: str, filePath: str) -> None:
+        super().__init__()
+
+        self.collectionName = collectionName
+        self.filePath = filePath
+        self.numDocuments = 0
+        self.fileSizeInBytes = 0
+        self.startTime = time.time()
+        self.durationInSeconds = 0.0
+
+    @property
+    def documentsPerSecond(self) -> float:
+        return self.numDocuments / self.durationInSeconds if self.durationInSeconds > 0.0 else 0.0
+
+    def finish(self):
+        self.durationInSeconds = time.time() - self.startTime
+        if os.path.isfile(self.filePath):
+            self.fileSizeInBytes = os.path.getsize(self.filePath)
+
+    def __str__(self):
+        return (f'{self.collectionName}: Exported {self.numDocuments} documents to {self.filePath} in {self.durationInSeconds:.1f}s '
+                f'({self.documentsPerSecond:.0f} documents/s, {self.fileSizeInBytes / (1024 * 1024):.1f} MB)')
+
+class DocumentExporter(object):
+    """
+    Exports the filtered documents of collections to CSV, JSON Lines or Parquet files.
+    Documents are streamed from the cursor through the filter chain of the DocumentFilterManager into the writer,
+    only the exported columns (and the fields the filters need) are fetched.
+    The column order is taken from the collection header (see MongoDBManager.extractCollectionHeaderInfo).
+
+    Files are written to a temporary path and renamed when complete, so consumers never read partial exports
+    (e.g. from Environment.autoExportPath).
+    """
+    def __init__(self, dbManager: MongoDBManager, documentFilterManager: DocumentFilterManager, batchSize: int = 1000) -> None:
+        super().__init__()
+
+        self.dbManager = dbManager
+        self.documentFilterManager = documentFilterManager
+        self.batchSize = batchSize
+
+    def getColumns(self, collectionName: str, onlyDisplayedColumns: bool = False) -> List[str]:
+        columns = []
+        for keyInfo in self.dbManager.extractCollectionHeaderInfo([collectionName]):
+            if (keyInfo.displayed or not onlyDisplayedColumns) and not keyInfo.key in columns:
+                columns.append(keyInfo.key)
+
+        return columns
+
+    def exportCollection(self, collectionName: str, filePath: str, fileFormat: str = document_writers.FORMAT_CSV, mongodbFilter: dict = None,
+                         filters: List[DocumentFilter] = None, distinctionText: str = '', columns: List[str] = None, compression: str = None,
+                         onlyDisplayedColumns: bool = False, **writerArgs) -> ExportResult:
+        """
+        Exports the documents of the collection that pass the mongodb filter, the active filters of the collection and the given custom filters.
+
+        Args:
+            columns: Exported keys in order. Defaults to the keys of the collection header.
+            compression: gzip or zstd for CSV and JSON Lines, a Parquet codec (e.g. snappy, gzip, zstd) for Parquet.
+            writerArgs: Passed to the writer, e.g. delimiter for CSV or rowGroupSize for Parquet.
+        """
+        result = ExportResult(collectionName, filePath)
+        columns = columns if columns != None else self.getColumns(collectionName, onlyDisplayedColumns)
+        documents = self.documentFilterManager.yieldFilteredDocuments(collectionName, mongodbFilter if mongodbFilter != None else {}, distinctionText,
+                                                                      filters, False, list(columns), self.batchSize)
+
+        temporaryFilePath = filePath + '.part'
+        try:
+            with document_writers.createWriter(temporaryFilePath, fileFormat, columns, compression, **writerArgs) as writer:
+                for document in documents:
+                    writer.write(document)
+
+            result.numDocuments = writer.numDocuments
+            os.replace(temporaryFilePath, filePath)
+        except:
+            if os.path.isfile(temporaryFilePath):
+                os.remove(temporaryFilePath)
+
+            raise
+
+        result.finish()
+        logger.info(str(result))
+        return result
+
+    def exportCollections(self, collectionNames: List[str], outputFolder: str, fileFormat: str = document_writers.FORMAT_CSV, mongodbFilter: dict = None,
+                          filters: List[DocumentFilter] = None, compression: str = None, onlyDisplayedColumns: bool = False, maxWorkers: int = 4,
+                          **writerArgs) -> Dict[str, ExportResult]:
+        """
+        Exports each collection to <outputFolder>/<collectionName>.<format>[.gz|.zst] with up to maxWorkers exports in parallel.
+        Returns the results of the successful exports. Failed exports are logged.
+        """
+        os.makedirs(outputFolder, exist_ok=True)
+        results: Dict[str, ExportResult] = dict()
+
+        def export(collectionName: str):
+            filePath = os.path.join(outputFolder, document_writers.getFileName(collectionName, fileFormat, compression))
+            return self.exportCollection(collectionName, filePath, fileFormat, mongodbFilter, filters, '', None, compression, onlyDisplayedColumns, **writerArgs)
+
+        with ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix='DocumentExporter') as executor:
+            futures = {collectionName: executor.submit(export, collectionName) for collectionName in collectionNames}
+            for collectionName, future in futures.items():
+                try:
+                    results[collectionName] = future.result()
+                except Exception as e:
+                    logger.error(f'Failed to export {collectionName}: {str(e)}')
+
+        return results
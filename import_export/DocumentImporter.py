@@ -0,0 +1,218 @@
+from MetadataManagerCore.mongodb_manager import MongoDBManager
+from MetadataManagerCore.DocumentModification import CONTENT_HASH_EXCLUDED_KEYS, DocOpResult, computeContentHash
+from MetadataManagerCore.import_export import document_readers
+from MetadataManagerCore.Event import Event
+from MetadataManagerCore import util
+from typing import Dict, Iterable, Iterator, List, Tuple
+import collections
+import itertools
+import time
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+class DocumentNormalizer(object):
+    """
+    Converts a row of an import file to a (sid, dataDict) tuple:
+        - Keys are stripped and renamed according to the key mapping. Dots are replaced by underscores and leading $ are removed
+          because MongoDB doesn't allow them in field names.
+        - The sid is taken from the sid key, stripped and German special characters are replaced.
+        - System keys like _id and s_version are removed so exported collections can be imported again.
+    Rows without a sid are normalized to None.
+    """
+    def __init__(self, sidKey: str, keyMapping: Dict[str, str] = None, skipEmptyValues: bool = False) -> None:
+        super().__init__()
+
+        self.sidKey = sidKey
+        self.keyMapping = keyMapping if keyMapping != None else dict()
+        self.skipEmptyValues = skipEmptyValues
+
+    def normalizeKey(self, key) -> str:
+        if key == None:
+            return None
+
+        key = str(key).strip()
+        key = self.keyMapping.get(key, key)
+        return key.replace('.', '_').lstrip('$')
+
+    def __call__(self, row: dict) -> Tuple[str, dict]:
+        dataDict = dict()
+        for key, val in row.items():
+            key = self.normalizeKey(key)
+            if not key:
+                continue
+
+            if self.skipEmptyValues and (val == None or val == ''):
+                continue
+
+            dataDict[key] = val
+
+        sid = dataDict.get(self.sidKey)
+        if sid == None:
+            return None
+
+        sid = util.replaceGermanCharacters(str(sid).strip())
+        if len(sid) == 0:
+            return None
+
+        for key in CONTENT_HASH_EXCLUDED_KEYS:
+            dataDict.pop(key, None)
+
+        return sid, dataDict
+
+class ImportProgress(object):
+    def __init__(self, filePath: str, collectionName: str) -> None:
+        super().__init__()
+
+        self.filePath = filePath
+        self.collectionName = collectionName
+        self.fileSizeInBytes = os.path.getsize(filePath) if filePath != None and os.path.isfile(filePath) else 0
+        self.numRows = 0
+        self.numSucceeded = 0
+        self.numConflicts = 0
+        self.numDuplicates = 0
+        self.numSkipped = 0
+        self.numBatches = 0
+        self.startTime = time.time()
+        self.durationInSeconds = 0.0
+
+    @property
+    def rowsPerSecond(self) -> float:
+        return self.numRows / self.durationInSeconds if self.durationInSeconds > 0.0 else 0.0
+
+    def update(self):
+        self.durationInSeconds = time.time() - self.startTime
+
+    def __str__(self):
+        return (f'{self.collectionName}: {self.numRows} rows in {self.durationInSeconds:.1f}s ({self.rowsPerSecond:.0f} rows/s). '
+                f'Succeeded (incl. unchanged): {self.numSucceeded}, Duplicates: {self.numDuplicates}, Skipped (no sid): {self.numSkipped}, Conflicts: {self.numConflicts}')
+
+class DocumentImporter(object):
+    """
+    Imports CSV, JSON Lines, JSON and Excel files into a collection with a streaming pipeline:
+        read rows -> normalize -> dedupe -> batched versioned upsert (MongoDBManager.insertOrModifyDocumentBatch)
+
+    Only one batch of documents is held in memory (plus a bounded number of parsed chunks if parsing in parallel).
+    Deduplication keeps the content hashes of the most recently seen sids, so its memory is bounded by dedupeCacheSize.
+    The collection header is updated once at the end of the import.
+    """
+    def __init__(self, dbManager: MongoDBManager, batchSize: int = 1000, checkForModifications: bool = True, dedupe: bool = True,
+                 numProcesses: int = 1, parallelThresholdInBytes: int = 64 * 1024 * 1024, useContentHashSnapshot: bool = False,
+                 dedupeCacheSize: int = 100000) -> None:
+        """
+        Args:
+            dedupe: Rows that repeat the data of an earlier row with the same sid are skipped.
+            dedupeCacheSize: Number of sids whose last content hash is remembered for deduplication (least recently seen sids are forgotten).
+                             None dedupes the whole file, its memory then grows with the number of distinct sids.
+                             Duplicates that aren't detected are still skipped as unchanged documents if checkForModifications is true.
+            numProcesses: Number of processes parsing CSV and JSON Lines files at least parallelThresholdInBytes large.
+            useContentHashSnapshot: Loads the content hashes of the collection once, so unchanged documents are skipped without queries.
+        """
+        super().__init__()
+
+        self.dbManager = dbManager
+        self.batchSize = batchSize
+        self.checkForModifications = checkForModifications
+        self.dedupe = dedupe
+        self.dedupeCacheSize = dedupeCacheSize
+        self.numProcesses = numProcesses
+        self.parallelThresholdInBytes = parallelThresholdInBytes
+        self.useContentHashSnapshot = useContentHashSnapshot
+        self.progressLogIntervalInSeconds = 5.0
+
+        self._onProgressEvent = Event()
+
+    @property
+    def onProgressEvent(self) -> Event:
+        """
+        Fired after every batch. Expected argument: ImportProgress
+        """
+        return self._onProgressEvent
+
+    def importFile(self, filePath: str, collectionName: str, sidKey: str, keyMapping: Dict[str, str] = None, fileFormat: str = None,
+                   delimiter: str = ',', encoding: str = None, sheetName: str = None, skipEmptyValues: bool = False) -> ImportProgress:
+        """
+        Imports the rows of the file. The sid of a document is the value of the sidKey column (after key normalization).
+        """
+        fileFormat = fileFormat if fileFormat != None else document_readers.getFileFormat(filePath)
+        normalizer = DocumentNormalizer(sidKey, keyMapping, skipEmptyValues)
+
+        parallel = (self.numProcesses > 1 and fileFormat in [document_readers.FORMAT_CSV, document_readers.FORMAT_JSONL] and
+                    os.path.getsize(filePath) >= self.parallelThresholdInBytes)
+        if parallel:
+            documents = document_readers.readParallel(filePath, fileFormat, self.numProcesses, normalizer, delimiter=delimiter, encoding=encoding)
+        else:
+            rows = document_readers.readRows(filePath, fileFormat, delimiter, encoding, sheetName)
+            documents = (normalizer(row) for row in rows)
+
+        progress = ImportProgress(filePath, collectionName)
+        logger.info(f'Importing {filePath} into {collectionName}' + (f' with {self.numProcesses} parser processes.' if parallel else '.'))
+        return self.importDocuments(documents, collectionName, progress)
+
+    def importRows(self, rows: Iterable[dict], collectionName: str, sidKey: str, keyMapping: Dict[str, str] = None, skipEmptyValues: bool = False) -> ImportProgress:
+        """
+        Imports row dictionaries from any source, e.g. a custom reader.
+        """
+        normalizer = DocumentNormalizer(sidKey, keyMapping, skipEmptyValues)
+        return self.importDocuments((normalizer(row) for row in rows), collectionName, ImportProgress(None, collectionName))
+
+    def dedupeDocuments(self, documents: Iterable[Tuple[str, dict]], progress: ImportProgress) -> Iterator[Tuple[str, dict]]:
+        contentHashes: Dict[str, str] = collections.OrderedDict()
+        for document in documents:
+            progress.numRows += 1
+            if document == None:
+                progress.numSkipped += 1
+                continue
+
+            if self.dedupe:
+                sid, dataDict = document
+                contentHash = computeContentHash(dataDict)
+                if contentHashes.get(sid) == contentHash:
+                    contentHashes.move_to_end(sid)
+                    progress.numDuplicates += 1
+                    continue
+
+                contentHashes[sid] = contentHash
+                contentHashes.move_to_end(sid)
+                if self.dedupeCacheSize != None and len(contentHashes) > self.dedupeCacheSize:
+                    contentHashes.popitem(last=False)
+
+            yield document
+
+    def importDocuments(self, documents: Iterable[Tuple[str, dict]], collectionName: str, progress: ImportProgress) -> ImportProgress:
+        contentHashes = self.dbManager.loadContentHashes(collectionName) if self.useContentHashSnapshot and self.checkForModifications else None
+        headerKeys: Dict[str, None] = dict()
+        lastLogTime = time.time()
+
+        iterator = self.dedupeDocuments(documents, progress)
+        while True:
+            batch = list(itertools.islice(iterator, self.batchSize))
+            if len(batch) == 0:
+                break
+
+            for _, dataDict in batch:
+                for key in dataDict.keys():
+                    headerKeys[key] = None
+
+            results = self.dbManager.insertOrModifyDocumentBatch(collectionName, batch, self.checkForModifications, contentHashes)
+            for _, result in results.values():
+                if result == DocOpResult.Successful:
+                    progress.numSucceeded += 1
+                else:
+                    progress.numConflicts += 1
+
+            progress.numBatches += 1
+            progress.update()
+            self._onProgressEvent(progress)
+
+            if time.time() - lastLogTime > self.progressLogIntervalInSeconds:
+                logger.info(str(progress))
+                lastLogTime = time.time()
+
+        if len(headerKeys) > 0:
+            self.dbManager.addMissingHeaderInfos(collectionName, list(headerKeys.keys()))
+
+        progress.update()
+        logger.info(str(progress))
+        return progress
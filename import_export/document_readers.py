@@ -0,0 +1,177 @@
+"""
+Streaming readers for CSV, JSON Lines, JSON and Excel files. All readers are generators yielding one row dictionary at a time,
+so the memory usage doesn't depend on the file size (except for JSON arrays if ijson isn't installed).
+
+CSV and JSON Lines files can be parsed by a process pool: The file is cut into chunks of lines that are parsed
+and normalized by the workers while the chunks are yielded in file order.
+"""
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Iterator, List
+import collections
+import json
+import csv
+import os
+import logging
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+logger = logging.getLogger(__name__)
+
+FORMAT_CSV = 'csv'
+FORMAT_JSONL = 'jsonl'
+FORMAT_JSON = 'json'
+FORMAT_EXCEL = 'xlsx'
+
+EXTENSION_FORMATS = {
+    '.csv': FORMAT_CSV,
+    '.txt': FORMAT_CSV,
+    '.jsonl': FORMAT_JSONL,
+    '.ndjson': FORMAT_JSONL,
+    '.json': FORMAT_JSON,
+    '.xlsx': FORMAT_EXCEL,
+    '.xlsm': FORMAT_EXCEL
+}
+
+def getFileFormat(filePath: str) -> str:
+    fileFormat = EXTENSION_FORMATS.get(os.path.splitext(filePath)[1].lower())
+    if fileFormat == None:
+        raise RuntimeError(f"Unsupported file format: {filePath}")
+
+    return fileFormat
+
+def readCsv(filePath: str, delimiter: str = ',', encoding: str = 'utf-8-sig') -> Iterator[dict]:
+    with open(filePath, 'r', newline='', encoding=encoding) as f:
+        yield from csv.DictReader(f, delimiter=delimiter)
+
+def readJsonLines(filePath: str, encoding: str = 'utf-8') -> Iterator[dict]:
+    with open(filePath, 'r', encoding=encoding) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+def readJson(filePath: str, encoding: str = 'utf-8') -> Iterator[dict]:
+    """
+    Reads a JSON array of objects. The array is streamed with ijson if it is installed, otherwise the whole file is loaded.
+    """
+    if ijson != None:
+        with open(filePath, 'rb') as f:
+            # Numbers are parsed as float like json.load does. Decimal values can't be stored in MongoDB:
+            yield from ijson.items(f, 'item', use_float=True)
+
+        return
+
+    with open(filePath, 'r', encoding=encoding) as f:
+        content = json.load(f)
+
+    if isinstance(content, dict):
+        content = [content]
+
+    yield from content
+
+def readExcel(filePath: str, sheetName: str = None) -> Iterator[dict]:
+    """
+    Reads the rows of the given sheet (the active sheet by default) in read-only mode. The first row is the header.
+    """
+    if openpyxl == None:
+        raise RuntimeError("Reading Excel files requires the openpyxl package.")
+
+    workbook = openpyxl.load_workbook(filePath, read_only=True, data_only=True)
+    try:
+        sheet = workbook[sheetName] if sheetName != None else workbook.active
+        rows = sheet.iter_rows(values_only=True)
+        header = next(rows, None)
+        if header == None:
+            return
+
+        header = [str(key) if key != None else None for key in header]
+        for row in rows:
+            if any(val != None for val in row):
+                yield {key: val for key, val in zip(header, row) if key != None}
+    finally:
+        workbook.close()
+
+def _parseCsvLines(header: List[str], lines: List[str], delimiter: str, rowFunction: Callable):
+    rows = csv.DictReader(lines, fieldnames=header, delimiter=delimiter)
+    return [rowFunction(row) for row in rows]
+
+def _parseJsonLines(lines: List[str], rowFunction: Callable):
+    return [rowFunction(json.loads(line)) for line in lines if line.strip()]
+
+def _identity(row):
+    return row
+
+def yieldLineChunks(f, chunkSizeInLines: int, quoteAware: bool) -> Iterator[List[str]]:
+    """
+    Yields chunks of lines. If quoteAware is true, chunks are only cut where the number of quotes is even,
+    so quoted CSV values containing line breaks aren't split.
+    """
+    lines = []
+    quoteCount = 0
+    for line in f:
+        lines.append(line)
+        if quoteAware:
+            quoteCount += line.count('"')
+
+        if len(lines) >= chunkSizeInLines and quoteCount % 2 == 0:
+            yield lines
+            lines = []
+            quoteCount = 0
+
+    if len(lines) > 0:
+        yield lines
+
+def readParallel(filePath: str, fileFormat: str, numProcesses: int, rowFunction: Callable = None, chunkSizeInLines: int = 10000,
+                 delimiter: str = ',', encoding: str = None) -> Iterator:
+    """
+    Parses a CSV or JSON Lines file with a process pool and yields rowFunction(row) for every row in file order.
+    rowFunction must be picklable. At most 2 * numProcesses chunks are in flight to bound the memory.
+    """
+    if not fileFormat in [FORMAT_CSV, FORMAT_JSONL]:
+        raise RuntimeError(f"Parallel parsing isn't supported for {fileFormat} files.")
+
+    rowFunction = rowFunction if rowFunction != None else _identity
+    encoding = encoding if encoding != None else ('utf-8-sig' if fileFormat == FORMAT_CSV else 'utf-8')
+    maxInFlightChunks = 2 * numProcesses
+    pendingChunks = collections.deque()
+
+    with open(filePath, 'r', newline='' if fileFormat == FORMAT_CSV else None, encoding=encoding) as f:
+        header = next(csv.reader(f, delimiter=delimiter), None) if fileFormat == FORMAT_CSV else None
+        if fileFormat == FORMAT_CSV and header == None:
+            return
+
+        with ProcessPoolExecutor(max_workers=numProcesses) as executor:
+            for lines in yieldLineChunks(f, chunkSizeInLines, fileFormat == FORMAT_CSV):
+                if fileFormat == FORMAT_CSV:
+                    pendingChunks.append(executor.submit(_parseCsvLines, header, lines, delimiter, rowFunction))
+                else:
+                    pendingChunks.append(executor.submit(_parseJsonLines, lines, rowFunction))
+
+                while len(pendingChunks) >= maxInFlightChunks:
+                    yield from pendingChunks.popleft().result()
+
+            while len(pendingChunks) > 0:
+                yield from pendingChunks.popleft().result()
+
+def readRows(filePath: str, fileFormat: str = None, delimiter: str = ',', encoding: str = None, sheetName: str = None) -> Iterator[dict]:
+    """
+    Yields the rows of the file as dictionaries. The format is derived from the file extension if not specified.
+    """
+    fileFormat = fileFormat if fileFormat != None else getFileFormat(filePath)
+    if fileFormat == FORMAT_CSV:
+        return readCsv(filePath, delimiter, encoding if encoding != None else 'utf-8-sig')
+    elif fileFormat == FORMAT_JSONL:
+        return readJsonLines(filePath, encoding if encoding != None else 'utf-8')
+    elif fileFormat == FORMAT_JSON:
+        return readJson(filePath, encoding if encoding != None else 'utf-8')
+    elif fileFormat == FORMAT_EXCEL:
+        return readExcel(filePath, sheetName)
+
+    raise RuntimeError(f"Unsupported file format: {fileFormat}")
@@ -0,0 +1,321 @@
+"""
+Streaming writers for CSV, JSON Lines and Parquet files. Documents are written one at a time (Parquet: one row group at a time),
+so the memory usage doesn't depend on the number of exported documents.
+
+CSV and JSON Lines files can be compressed with gzip or, if the zstandard package is installed, zstd.
+Parquet files require pyarrow and use Parquet's internal compression.
+"""
+from typing import List
+import datetime
+import gzip
+import json
+import csv
+import io
+import os
+import logging
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+FORMAT_CSV = 'csv'
+FORMAT_JSONL = 'jsonl'
+FORMAT_PARQUET = 'parquet'
+
+COMPRESSION_GZIP = 'gzip'
+COMPRESSION_ZSTD = 'zstd'
+
+FORMAT_EXTENSIONS = {FORMAT_CSV: '.csv', FORMAT_JSONL: '.jsonl', FORMAT_PARQUET: '.parquet'}
+COMPRESSION_EXTENSIONS = {COMPRESSION_GZIP: '.gz', COMPRESSION_ZSTD: '.zst'}
+
+def getFileName(baseName: str, fileFormat: str, compression: str = None) -> str:
+    fileName = baseName + FORMAT_EXTENSIONS[fileFormat]
+    if compression != None and fileFormat != FORMAT_PARQUET:
+        fileName += COMPRESSION_EXTENSIONS[compression]
+
+    return fileName
+
+def _toJsonCompatible(value):
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+
+    return str(value)
+
+def toText(value) -> str:
+    """Converts a document value to a CSV cell. Lists and dictionaries are written as JSON.
+    """
+    if value == None:
+        return ''
+
+    if isinstance(value, str):
+        return value
+
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=_toJsonCompatible, ensure_ascii=False)
+
+    if isinstance(value, (datetime.datetime, datetime.date)):
+        return value.isoformat()
+
+    return str(value)
+
+def openTextStream(filePath: str, compression: str = None, encoding: str = 'utf-8'):
+    if compression == None:
+        return open(filePath, 'w', newline='', encoding=encoding)
+    elif compression == COMPRESSION_GZIP:
+        return gzip.open(filePath, 'wt', newline='', encoding=encoding, compresslevel=6)
+    elif compression == COMPRESSION_ZSTD:
+        if zstandard == None:
+            raise RuntimeError("zstd compression requires the zstandard package.")
+
+        rawFile = open(filePath, 'wb')
+        return io.TextIOWrapper(zstandard.ZstdCompressor().stream_writer(rawFile, closefd=True), encoding=encoding, newline='')
+
+    raise RuntimeError(f"Unsupported compression: {compression}")
+
+class DocumentWriter(object):
+    """
+    Base class of the writers. The columns define the exported keys and their order.
+    """
+    def __init__(self, filePath: str, columns: List[str]) -> None:
+        super().__init__()
+
+        self.filePath = filePath
+        self.columns = columns
+        self.numDocuments = 0
+
+    def write(self, document: dict):
+        raise NotImplementedError()
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+class CsvDocumentWriter(DocumentWriter):
+    def __init__(self, filePath: str, columns: List[str], compression: str = None, delimiter: str = ',') -> None:
+        super().__init__(filePath, columns)
+
+        self.stream = openTextStream(filePath, compression)
+        self.writer = csv.writer(self.stream, delimiter=delimiter)
+        self.writer.writerow(columns)
+
+    def write(self, document: dict):
+        self.writer.writerow([toText(document.get(column)) for column in self.columns])
+        self.numDocuments += 1
+
+    def close(self):
+        self.stream.close()
+
+class JsonLinesDocumentWriter(DocumentWriter):
+    """
+    Writes one JSON object per line with the keys in column order. If no columns are given, whole documents are written.
+    """
+    def __init__(self, filePath: str, columns: List[str] = None, compression: str = None) -> None:
+        super().__init__(filePath, columns)
+
+        self.stream = openTextStream(filePath, compression)
+
+    def write(self, document: dict):
+        if self.columns != None:
+            document = {column: document[column] for column in self.columns if column in document}
+
+        self.stream.write(json.dumps(document, default=_toJsonCompatible, ensure_ascii=False))
+        self.stream.write('\n')
+        self.numDocuments += 1
+
+    def close(self):
+        self.stream.close()
+
+class ParquetDocumentWriter(DocumentWriter):
+    """
+    Writes row groups of rowGroupSize documents. The column types are inferred from the values:
+    Columns that only contain booleans or integers keep their type, integers mixed with floats are written as float64
+    and all other columns are written as strings.
+    If a later row group contains values that don't fit the type of their column (e.g. floats in an integer column), the column is widened
+    (int64 to float64, anything else to string). Because the schema of a Parquet file is fixed, the row groups written so far are rewritten
+    with the widened schema, one row group at a time.
+    """
+    def __init__(self, filePath: str, columns: List[str], compression: str = 'snappy', rowGroupSize: int = 10000) -> None:
+        super().__init__(filePath, columns)
+
+        if pyarrow == None:
+            raise RuntimeError("Parquet export requires the pyarrow package.")
+
+        self.compression = compression
+        self.rowGroupSize = rowGroupSize
+        self.rows: List[dict] = []
+        self.schema = None
+        self.writer = None
+        self.failed = False
+        self.numSchemaRewrites = 0
+
+    @staticmethod
+    def inferType(values):
+        values = [val for val in values if val != None]
+        valueTypes = set(type(val) for val in values)
+        if len(valueTypes) == 0:
+            return pyarrow.string()
+        elif valueTypes == set([bool]):
+            return pyarrow.bool_()
+        elif valueTypes == set([int]):
+            # Integers exceeding int64 are written as strings to keep them exact:
+            if any(not -2**63 <= val < 2**63 for val in values):
+                return pyarrow.string()
+
+            return pyarrow.int64()
+        elif valueTypes.issubset(set([int, float])):
+            return pyarrow.float64()
+
+        return pyarrow.string()
+
+    @staticmethod
+    def widenType(columnType, values):
+        """Returns the narrowest type that fits the values of columnType and the given values.
+        """
+        values = [val for val in values if val != None]
+        if len(values) == 0:
+            return columnType
+
+        valuesType = ParquetDocumentWriter.inferType(values)
+        if valuesType == columnType:
+            return columnType
+
+        numericTypes = [pyarrow.int64(), pyarrow.float64()]
+        if columnType in numericTypes and valuesType in numericTypes:
+            return pyarrow.float64()
+
+        return pyarrow.string()
+
+    @staticmethod
+    def convertValue(value, columnType):
+        if value == None:
+            return None
+
+        if pyarrow.types.is_string(columnType):
+            return toText(value)
+
+        if pyarrow.types.is_floating(columnType):
+            return float(value)
+
+        return value
+
+    @staticmethod
+    def convertColumn(column, columnType):
+        if column.type == columnType:
+            return column
+
+        return pyarrow.array([ParquetDocumentWriter.convertValue(val, columnType) for val in column.to_pylist()], type=columnType)
+
+    def rewriteWithSchema(self, schema):
+        """Rewrites the written row groups with the widened schema.
+        """
+        logger.info(f"{self.filePath}: Widening the columns {[f.name for f, w in zip(self.schema, schema) if f.type != w.type]} "
+                    f"and rewriting {self.numDocuments - len(self.rows)} documents.")
+
+        self.writer.close()
+        self.writer = None
+        previousFilePath = self.filePath + '.widening'
+        os.replace(self.filePath, previousFilePath)
+
+        try:
+            writer = pyarrow.parquet.ParquetWriter(self.filePath, schema, compression=self.compression)
+            try:
+                with open(previousFilePath, 'rb') as f:
+                    previousFile = pyarrow.parquet.ParquetFile(f)
+                    for i in range(previousFile.num_row_groups):
+                        rowGroup = previousFile.read_row_group(i)
+                        arrays = [ParquetDocumentWriter.convertColumn(rowGroup.column(field.name).combine_chunks(), field.type) for field in schema]
+                        writer.write_table(pyarrow.Table.from_arrays(arrays, schema=schema))
+            except:
+                writer.close()
+                raise
+        finally:
+            os.remove(previousFilePath)
+
+        self.writer = writer
+        self.schema = schema
+        self.numSchemaRewrites += 1
+
+    def writeRowGroup(self):
+        try:
+            if self.schema == None:
+                self.schema = pyarrow.schema([(column, ParquetDocumentWriter.inferType(row.get(column) for row in self.rows)) for column in self.columns])
+                self.writer = pyarrow.parquet.ParquetWriter(self.filePath, self.schema, compression=self.compression)
+            else:
+                schema = pyarrow.schema([(field.name, ParquetDocumentWriter.widenType(field.type, [row.get(field.name) for row in self.rows])) 
+                                         for field in self.schema])
+                if not schema.equals(self.schema):
+                    self.rewriteWithSchema(schema)
+
+            arrays = []
+            for field in self.schema:
+                arrays.append(pyarrow.array([ParquetDocumentWriter.convertValue(row.get(field.name), field.type) for row in self.rows], type=field.type))
+
+            self.writer.write_table(pyarrow.Table.from_arrays(arrays, schema=self.schema))
+        except:
+            # Don't retry the row group when the writer is closed:
+            self.failed = True
+            raise
+
+        self.rows = []
+
+    def write(self, document: dict):
+        self.rows.append(document)
+        self.numDocuments += 1
+        if len(self.rows) >= self.rowGroupSize:
+            self.writeRowGroup()
+
+    def close(self):
+        try:
+            if not self.failed and (len(self.rows) > 0 or self.writer == None):
+                self.writeRowGroup()
+        finally:
+            if self.writer != None:
+                self.writer.close()
+
+def createWriter(filePath: str, fileFormat: str, columns: List[str], compression: str = None, **kwargs) -> DocumentWriter:
+    if fileFormat == FORMAT_CSV:
+        return CsvDocumentWriter(filePath, columns, compression, **kwargs)
+    elif fileFormat == FORMAT_JSONL:
+        return JsonLinesDocumentWriter(filePath, columns, compression)
+    elif fileFormat == FORMAT_PARQUET:
+        return ParquetDocumentWriter(filePath, columns, compression if compression != None else 'snappy', **kwargs)
+
+    raise RuntimeError(f"Unsupported export format: {fileFormat}")
+
+if __name__ == "__main__":
+    import tempfile
+
+    # Later row groups with values that don't fit the inferred column types:
+    g_documents = [{'count': i, 'code': i, 'name': f'doc{i}'} for i in range(4)] + \
+                  [{'count': 4.5, 'code': 'A5', 'name': None}, {'count': 5, 'code': True, 'name': 'doc6'}]
+
+    with tempfile.TemporaryDirectory() as g_directory:
+        g_filePath = os.path.join(g_directory, 'documents.parquet')
+        with ParquetDocumentWriter(g_filePath, ['count', 'code', 'name'], rowGroupSize=2) as g_writer:
+            for g_document in g_documents:
+                g_writer.write(g_document)
+
+        g_table = pyarrow.parquet.read_table(g_filePath)
+        assert g_table.schema.field('count').type == pyarrow.float64()
+        assert g_table.schema.field('code').type == pyarrow.string()
+        assert g_table.column('count').to_pylist() == [0.0, 1.0, 2.0, 3.0, 4.5, 5.0]
+        assert g_table.column('code').to_pylist() == ['0', '1', '2', '3', 'A5', 'True']
+        assert g_table.column('name').to_pylist() == ['doc0', 'doc1', 'doc2', 'doc3', None, 'doc6']
+        assert pyarrow.parquet.ParquetFile(g_filePath).num_row_groups == 3
+        assert os.listdir(g_directory) == ['documents.parquet']
+
+    print('Parquet type widening works.')
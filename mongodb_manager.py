@@ -1,13 +1,17 @@
 import typing
 import pymongo
 from MetadataManagerCore import Keys
-from bson import Code
-from MetadataManagerCore.DocumentModification import DocOpResult, DocumentOperation
+from MetadataManagerCore.DocumentModification import AtomicDocumentOperation, BulkDocumentOperation, DocOpResult, DocumentOperation
 import numpy as np
 import json
 import logging
-from typing import List, Tuple
+import itertools
+import threading
+import time
+from typing import Dict, Iterable, List, Tuple
 from MetadataManagerCore.Event import Event
+from MetadataManagerCore.schema.CollectionSchemaIndex import CollectionSchemaIndex
+from MetadataManagerCore.versioning import document_versioning
 
 class CollectionHeaderKeyInfo(object):
     MD_KEY = "key"
@@ -30,7 +34,34 @@ class MongoDBManager:
         self.host = host
         self.databaseName = databaseName
         self.db = None
+        # Fired for every document modified by insertOrModifyDocument. Event args: (document: dict)
         self.onDocumentModifiedEvent = Event()
+        # Fired once per batch of insertOrModifyDocuments and insertOrModifyDocumentBatch instead of onDocumentModifiedEvent.
+        # Event args: (collectionName: str, documents: List[dict])
+        self.onDocumentsModifiedEvent = Event()
+
+        # If set, the keys of new collections are estimated from a random sample of this size instead of scanning all documents.
+        self.schemaSampleSize: int = None
+        self.schemaIndex = CollectionSchemaIndex(self)
+
+        # Cache of the collection name list to avoid listing the collections on every lookup:
+        self.collectionNamesCacheTTLInSeconds = 5.0
+        self._collectionNamesCache: List[str] = None
+        self._collectionNamesCacheTime = 0.0
+        self._collectionNamesCacheLock = threading.Lock()
+
+        # Previous document versions are stored as full copy every versionSnapshotInterval versions and as reverse patch otherwise.
+        # 1 stores full copies only. See versioning.document_versioning.
+        self.versionSnapshotInterval = 1
+
+        # If true, insertOrModifyDocument uses AtomicDocumentOperation: The live document keeps the stable _id sid and is modified
+        # with a single find_one_and_update. The version history is written in the background.
+        self.atomicDocumentUpdates = False
+        self._versionHistoryWriter: document_versioning.VersionHistoryWriter = None
+        self._versionHistoryWriterLock = threading.Lock()
+
+        # Cross-collection lookups use $unionWith (MongoDB 4.4+) and fall back to one query per collection if the server doesn't support it.
+        self.unionWithSupported = True
 
     def connect(self):
         self.client = pymongo.MongoClient(self.host)
@@ -38,14 +69,55 @@ class MongoDBManager:
         self.db = self.client[self.databaseName]
 
     def disconnect(self):
+        self.flushVersionHistory()
+        self.schemaIndex.flush()
         self.client.close()
 
+    @property
+    def versionHistoryWriter(self) -> document_versioning.VersionHistoryWriter:
+        with self._versionHistoryWriterLock:
+            if self._versionHistoryWriter == None:
+                self._versionHistoryWriter = document_versioning.VersionHistoryWriter(self.db)
+
+            return self._versionHistoryWriter
+
+    def flushVersionHistory(self):
+        """Waits until the version history of atomic document modifications is written.
+        """
+        if self._versionHistoryWriter != None:
+            self._versionHistoryWriter.flush()
+
     # entry: dictionary
     def insertOne(self, collectionName, entry : dict):
         self.db[collectionName].insert_one(entry)
+        self.registerCollectionName(collectionName)
 
     def getCollectionNames(self):
-        return self.db.list_collection_names() if self.db != None else []
+        if self.db == None:
+            return []
+
+        with self._collectionNamesCacheLock:
+            if self._collectionNamesCache != None and time.time() - self._collectionNamesCacheTime < self.collectionNamesCacheTTLInSeconds:
+                return list(self._collectionNamesCache)
+
+        collectionNames = self.db.list_collection_names()
+
+        with self._collectionNamesCacheLock:
+            self._collectionNamesCache = collectionNames
+            self._collectionNamesCacheTime = time.time()
+
+        return list(collectionNames)
+
+    def invalidateCollectionNamesCache(self):
+        with self._collectionNamesCacheLock:
+            self._collectionNamesCache = None
+
+    def registerCollectionName(self, collectionName: str):
+        """Adds a collection name that was implicitly created by a write to the collection name cache.
+        """
+        with self._collectionNamesCacheLock:
+            if self._collectionNamesCache != None and not collectionName in self._collectionNamesCache:
+                self._collectionNamesCache.append(collectionName)
 
     def getVisibleCollectionNames(self):
         for cn in self.getCollectionNames():
@@ -53,18 +125,10 @@ class MongoDBManager:
                 yield cn
 
     def findOne(self, uid: str):
-        for collectionName in self.getVisibleCollectionNames():
-            collection = self.db[collectionName]
-            val = collection.find_one({"_id":uid})
-            if val != None:
-                return val
+        return self.findOneInCollections(uid, list(self.getVisibleCollectionNames()))
 
     def findOneInCollections(self, uid: str, collectionNames: typing.List[str]):
-        for collectionName in collectionNames:
-            collection = self.db[collectionName]
-            val = collection.find_one({"_id":uid})
-            if val != None:
-                return val
+        return self.findFirstInCollections({"_id":uid}, collectionNames)
 
     def findOneInCollection(self, uid: str, collectionName: str):
         collection = self.db[collectionName]
@@ -73,11 +137,69 @@ class MongoDBManager:
             return val
 
     def findOneBySidInCollections(self, sid: str, collectionNames: typing.List[str]):
+        return self.findFirstInCollections({Keys.systemIDKey:sid}, collectionNames)
+
+    def findMany(self, uids: typing.Iterable[str], collectionNames: typing.List[str] = None) -> Dict[str, dict]:
+        """
+        Finds the documents with the given uids in the given collections (all visible collections if None) and returns them keyed by uid.
+        If a uid exists in multiple collections, the document of the first collection in collectionNames is returned.
+        """
+        uids = list(uids)
+        if collectionNames == None:
+            collectionNames = list(self.getVisibleCollectionNames())
+
+        documents = dict()
+        if len(uids) == 0:
+            return documents
+
+        for document in self.yieldFromCollections({"_id": {"$in": uids}}, collectionNames):
+            documents.setdefault(document["_id"], document)
+
+            if len(documents) == len(uids):
+                break
+
+        return documents
+
+    def findFirstInCollections(self, documentsFilter: dict, collectionNames: typing.List[str]):
+        for document in self.yieldFromCollections(documentsFilter, collectionNames, limitPerCollection=1):
+            return document
+
+        return None
+
+    def yieldFromCollections(self, documentsFilter: dict, collectionNames: typing.List[str], limitPerCollection: int = None):
+        """
+        Yields the documents matching the filter in the order of the given collections.
+        If supported by the server, a single $unionWith aggregation is used instead of one query per collection.
+        """
+        collectionNames = list(collectionNames)
+        if len(collectionNames) == 0:
+            return
+
+        if self.unionWithSupported:
+            subPipeline = [{'$match': documentsFilter}]
+            if limitPerCollection != None:
+                subPipeline.append({'$limit': limitPerCollection})
+
+            pipeline = list(subPipeline)
+            for collectionName in collectionNames[1:]:
+                pipeline.append({'$unionWith': {'coll': collectionName, 'pipeline': subPipeline}})
+
+            try:
+                cursor = self.db[collectionNames[0]].aggregate(pipeline)
+            except pymongo.errors.OperationFailure as e:
+                self.logger.warning(f"$unionWith is not supported, falling back to per-collection queries. Reason: {str(e)}")
+                self.unionWithSupported = False
+            else:
+                with cursor:
+                    for document in cursor:
+                        yield document
+
+                return
+
         for collectionName in collectionNames:
-            collection = self.db[collectionName]
-            val = collection.find_one({Keys.systemIDKey:sid})
-            if val != None:
-                return val
+            with self.db[collectionName].find(documentsFilter, limit=limitPerCollection if limitPerCollection != None else 0) as cursor:
+                for document in cursor:
+                    yield document
 
     @property
     def collectionsMD(self):
@@ -90,7 +212,7 @@ class MongoDBManager:
         # and add unique entries:
         for collectionName in collectionNames:
             cMD = self.collectionsMD.find_one({"_id":collectionName})
-            if cMD:
+            if cMD and "tableHeader" in cMD:
                 cTableHeader = cMD.get("tableHeader")
                 if cTableHeader != None:
                     for keyInfo in cTableHeader:
@@ -102,7 +224,7 @@ class MongoDBManager:
             else:
                 # New collection without header info. Extract default info (everything visible) and add it to db
                 newInfos = []
-                keys = self.findAllKeysInCollection(collectionName)
+                keys = self.findAllKeysInCollection(collectionName, self.schemaSampleSize)
                 for key in keys:
                     newInfos.append(CollectionHeaderKeyInfo(key, key, True))
 
@@ -130,33 +252,143 @@ class MongoDBManager:
 
         self.setCollectionHeaderInfo(collectionName, currentHeader)
 
-    def findAllKeysInCollection(self, collectionName):
-        map = Code("function() { for (var key in this) { emit(key, null); } }")
-        reduce = Code("function(key, stuff) { return null; }")
-        tempResultCollection = f"{collectionName}_keys_temp"
-        result = self.db[collectionName].map_reduce(map, reduce, tempResultCollection)
-
-        keys = [v for v in result.distinct('_id')]
-        self.db.drop_collection(tempResultCollection)
-        return keys
+    def findAllKeysInCollection(self, collectionName, sampleSize: int = None, rescan = False):
+        """
+        Returns the sorted keys of all documents in the collection. The keys are discovered once and maintained by the schema index afterwards.
+        If sampleSize is specified the keys are estimated from a random sample of documents.
+        """
+        return self.schemaIndex.getKeys(collectionName, sampleSize, rescan)
 
     def insertOrModifyDocument(self, collectionName, sid, dataDict, checkForModifications) -> Tuple[dict, DocOpResult]:
         """
         If checkForModifications is true, the new document will be compared to the old document (if present). 
         If the documents are identical the DB entry for the given sid won't be changed.
         """
-        op = DocumentOperation(self.db, collectionName, sid, dataDict)
+        if self.atomicDocumentUpdates:
+            return self.modifyDocumentAtomically(collectionName, sid, dataDict, checkForModifications)
+
+        self.registerCollectionName(collectionName)
+        op = DocumentOperation(self.db, collectionName, sid, dataDict, self.versionSnapshotInterval)
+
+        document, result = op.applyOperation(checkForModifications)
+        if result == DocOpResult.Successful:
+            self.schemaIndex.onDocumentsWritten(collectionName, [document], [sid] if op.inserted else [])
+            self.onDocumentModifiedEvent(document)
+
+        return document, result
+
+    def modifyDocumentAtomically(self, collectionName, sid, dataDict, checkForModifications=True, expectedVersion: int = None) -> Tuple[dict, DocOpResult]:
+        """
+        Inserts or modifies the document with a single find_one_and_update in the common case. See AtomicDocumentOperation.
+        If expectedVersion is given, DocOpResult.MergeConflict is returned if the document has a different version.
+        """
+        self.registerCollectionName(collectionName)
+        op = AtomicDocumentOperation(self.db, collectionName, sid, dataDict, self.versionHistoryWriter, self.versionSnapshotInterval, expectedVersion)
 
         document, result = op.applyOperation(checkForModifications)
         if result == DocOpResult.Successful:
+            self.schemaIndex.onDocumentsWritten(collectionName, [document], [sid] if op.inserted else [])
             self.onDocumentModifiedEvent(document)
 
         return document, result
 
-    def getFilteredDocuments(self, collectionName, documentsFilter : dict, distinctionText=''):
+    def loadContentHashes(self, collectionName) -> Dict[str, dict]:
+        """
+        Loads the content hashes of all documents of the collection with a projection-only query.
+        The result can be passed to insertOrModifyDocuments to skip unchanged documents of an import without any query.
+        """
+        return BulkDocumentOperation.loadContentHashes(self.db[collectionName])
+
+    def insertOrModifyDocuments(self, collectionName, documents: Iterable[Tuple[str, dict]], batchSize=1000, checkForModifications=True, 
+                                contentHashes: Dict[str, dict] = None) -> Dict[DocOpResult, int]:
+        """
+        Batched version of insertOrModifyDocument for large imports. documents is an iterable of (sid, dataDict) tuples.
+        Each batch costs a single prefetch query and one bulk write per affected collection instead of multiple round trips per document.
+        If checkForModifications is true, unchanged documents are detected by their content hash with a projection-only query
+        or, if contentHashes from loadContentHashes() are given, without any query. Only changed documents are fetched.
+
+        Returns the number of sids per DocOpResult. The documents aren't collected to keep the memory independent of the import size,
+        use insertOrModifyDocumentBatch for the per-sid results of a batch.
+        onDocumentsModifiedEvent (not onDocumentModifiedEvent) is fired once per batch with the successfully modified documents.
+        """
+        resultCounts = {result: 0 for result in DocOpResult}
+        iterator = iter(documents)
+        while True:
+            batch = list(itertools.islice(iterator, batchSize))
+            if len(batch) == 0:
+                break
+
+            for _, result in self.insertOrModifyDocumentBatch(collectionName, batch, checkForModifications, contentHashes).values():
+                resultCounts[result] += 1
+
+        return resultCounts
+
+    def insertOrModifyDocumentBatch(self, collectionName, batch: Iterable[Tuple[str, dict]], checkForModifications=True, 
+                                    contentHashes: Dict[str, dict] = None) -> Dict[str, Tuple[dict, DocOpResult]]:
+        self.registerCollectionName(collectionName)
+        op = BulkDocumentOperation(self.db, collectionName, batch, self.versionSnapshotInterval, contentHashes)
+
+        results = op.applyOperation(checkForModifications)
+        modifiedDocuments = [document for document, result in results.values() if result == DocOpResult.Successful]
+        if len(modifiedDocuments) > 0:
+            self.schemaIndex.onDocumentsWritten(collectionName, modifiedDocuments, op.insertedSids)
+            self.onDocumentsModifiedEvent(collectionName, modifiedDocuments)
+
+        return results
+
+    def reconstructVersion(self, collectionName, sid, version) -> dict:
+        """
+        Returns the document with the given sid as it was at the given version or None if the version doesn't exist.
+        """
+        self.flushVersionHistory()
+        return document_versioning.reconstructVersion(self.db, collectionName, sid, version)
+
+    @staticmethod
+    def toProjection(fields) -> dict:
+        """Converts a list of field names or a projection dictionary to a projection dictionary. None means the whole document.
+        """
+        if fields == None:
+            return None
+
+        if isinstance(fields, dict):
+            return dict(fields)
+
+        return {field: 1 for field in fields}
+
+    @staticmethod
+    def includeInProjection(projection: dict, key: str) -> dict:
+        if projection == None:
+            return None
+
+        projection = dict(projection)
+        if any(val for k, val in projection.items() if k != '_id'):
+            projection[key] = 1
+        else:
+            projection.pop(key, None)
+
+        return projection
+
+    def getFilteredDocuments(self, collectionName, documentsFilter : dict, distinctionText='', serverSideDistinction=False, batchSize: int = None, projection = None,
+                             sort = None):
+        """
+        Yields the documents matching the filter. If distinctionText is specified only the first document for each value of that key is yielded.
+        If serverSideDistinction is true, the deduplication is done by an aggregation so only the distinct documents are transferred.
+        batchSize controls the number of documents per cursor batch (server default if None).
+        projection is a list of field names or a projection dictionary restricting the transferred fields (whole documents if None).
+        sort is a list of (key, direction) pairs. It is ignored by the server-side distinction.
+        """
         collection = self.db[collectionName]
-        filteredCursor = collection.find(documentsFilter, no_cursor_timeout=True)
         distinctKey = distinctionText
+        projection = MongoDBManager.toProjection(projection)
+
+        if distinctKey:
+            projection = MongoDBManager.includeInProjection(projection, distinctKey)
+
+        if serverSideDistinction and distinctKey:
+            yield from self.getDistinctDocuments(collectionName, documentsFilter, distinctKey, batchSize, projection)
+            return
+
+        filteredCursor = collection.find(documentsFilter, projection, no_cursor_timeout=True, batch_size=batchSize if batchSize != None else 0, sort=sort)
         
         with filteredCursor:
             if len(distinctKey) > 0:
@@ -172,6 +404,30 @@ class MongoDBManager:
                 for item in filteredCursor:
                     yield item
 
+    def getDistinctDocuments(self, collectionName, documentsFilter : dict, distinctKey: str, batchSize: int = None, projection = None):
+        """
+        Yields the first document (ordered by _id) for each distinct value of distinctKey using an aggregation pipeline.
+        Documents without a value for distinctKey are skipped. The order of the yielded documents is not defined.
+        """
+        pipeline = [
+            {'$match': {'$and': [documentsFilter, {distinctKey: {'$ne': None}}]}},
+            {'$sort': {distinctKey: 1, '_id': 1}}
+        ]
+
+        projection = MongoDBManager.includeInProjection(MongoDBManager.toProjection(projection), distinctKey)
+        if projection != None:
+            pipeline.append({'$project': projection})
+
+        pipeline += [
+            {'$group': {'_id': '$' + distinctKey, 'document': {'$first': '$$ROOT'}}},
+            {'$replaceRoot': {'newRoot': '$document'}}
+        ]
+
+        aggregateKwargs = {'batchSize': batchSize} if batchSize != None else dict()
+        with self.db[collectionName].aggregate(pipeline, allowDiskUse=True, **aggregateKwargs) as cursor:
+            for document in cursor:
+                yield document
+
     def stringToFilter(self, filterString : str) -> dict:
         try:
             if len(filterString) == 0:
@@ -200,4 +456,6 @@ class MongoDBManager:
         return self.db[Keys.SERVICE_COLLECTION]
 
     def dropCollection(self, collectionName: str):
-        self.db.drop_collection(collectionName)
\ No newline at end of file
+        self.db.drop_collection(collectionName)
+        self.invalidateCollectionNamesCache()
+        self.schemaIndex.forget(collectionName)
\ No newline at end of file
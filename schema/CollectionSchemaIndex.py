@@ -0,0 +1,210 @@
+from MetadataManagerCore import Keys
+from typing import Dict, Iterable, List, Set
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class CollectionSchemaIndex(object):
+    """
+    Keeps track of the keys that are used by the documents of a collection.
+
+    The key set of a collection is discovered once with an aggregation over all documents (or estimated from a random sample)
+    and persisted with per-key document counts in the collection metadata. Afterwards the key set is kept up to date
+    incrementally from document modifications so later requests never need to rescan the collection.
+
+    Note: Counts are exact after a full scan. Incremental updates count every inserted document and add keys introduced by modifications
+    with a count of 1 because the previous version of a modified document is not known.
+    Incremental changes are persisted at most every flushIntervalInSeconds (and by flush()), so counts of other processes may lag behind.
+    """
+    MD_SCHEMA_KEYS = "schemaKeys"
+    MD_SCHEMA_SAMPLED = "schemaSampled"
+    MD_KEY = "key"
+    MD_COUNT = "count"
+
+    # If a collection is not indexed yet, the persisted state is checked again after this time interval:
+    notIndexedRecheckIntervalInSeconds = 60.0
+
+    def __init__(self, dbManager) -> None:
+        super().__init__()
+
+        self.dbManager = dbManager
+        self.lock = threading.Lock()
+        self.collectionKeyCounts: Dict[str, Dict[str, int]] = dict()
+        self.notIndexedCheckTimes: Dict[str, float] = dict()
+
+        # Key count changes that are not persisted yet:
+        self.flushIntervalInSeconds = 5.0
+        self.pendingNewKeyCounts: Dict[str, Dict[str, int]] = dict()
+        self.pendingIncrements: Dict[str, Dict[str, int]] = dict()
+        self.lastFlushTime = time.time()
+
+    def getKeys(self, collectionName: str, sampleSize: int = None, rescan: bool = False) -> List[str]:
+        return sorted(self.getKeyCounts(collectionName, sampleSize, rescan).keys())
+
+    def getKeyCounts(self, collectionName: str, sampleSize: int = None, rescan: bool = False) -> Dict[str, int]:
+        """Returns a dictionary mapping each key of the collection to the number of documents containing it.
+        The collection is only scanned if no key set was discovered yet or if rescan is true.
+
+        Args:
+            sampleSize (int, optional): If specified, the key set is estimated from a random sample of this size instead of scanning all documents.
+        """
+        if not rescan:
+            keyCounts = self.getIndexedKeyCounts(collectionName)
+            if keyCounts != None:
+                return keyCounts
+
+        keyCounts = self.scanKeyCounts(collectionName, sampleSize)
+        self.saveKeyCounts(collectionName, keyCounts, sampleSize != None)
+
+        with self.lock:
+            self.collectionKeyCounts[collectionName] = dict(keyCounts)
+            self.notIndexedCheckTimes.pop(collectionName, None)
+            self.pendingNewKeyCounts.pop(collectionName, None)
+            self.pendingIncrements.pop(collectionName, None)
+
+        return keyCounts
+
+    def getIndexedKeyCounts(self, collectionName: str) -> Dict[str, int]:
+        """Returns the cached or persisted key counts of the collection without scanning. None is returned if the collection is not indexed.
+        """
+        with self.lock:
+            keyCounts = self.collectionKeyCounts.get(collectionName)
+            if keyCounts != None:
+                return dict(keyCounts)
+
+            lastCheckTime = self.notIndexedCheckTimes.get(collectionName)
+            if lastCheckTime != None and time.time() - lastCheckTime < CollectionSchemaIndex.notIndexedRecheckIntervalInSeconds:
+                return None
+
+        keyCounts = self.loadKeyCounts(collectionName)
+
+        with self.lock:
+            if keyCounts != None:
+                self.collectionKeyCounts[collectionName] = dict(keyCounts)
+                self.notIndexedCheckTimes.pop(collectionName, None)
+            else:
+                self.notIndexedCheckTimes[collectionName] = time.time()
+
+        return keyCounts
+
+    def scanKeyCounts(self, collectionName: str, sampleSize: int = None) -> Dict[str, int]:
+        pipeline = []
+        if sampleSize != None:
+            pipeline.append({'$sample': {'size': sampleSize}})
+
+        pipeline += [
+            {'$project': {'keyValuePairs': {'$objectToArray': '$$ROOT'}}},
+            {'$unwind': '$keyValuePairs'},
+            {'$group': {'_id': '$keyValuePairs.k', CollectionSchemaIndex.MD_COUNT: {'$sum': 1}}}
+        ]
+
+        logger.info(f'Scanning keys of collection {collectionName}' + (f' using a sample of {sampleSize} documents.' if sampleSize != None else '.'))
+
+        with self.dbManager.db[collectionName].aggregate(pipeline, allowDiskUse=True) as cursor:
+            return {entry['_id']: entry[CollectionSchemaIndex.MD_COUNT] for entry in cursor}
+
+    def loadKeyCounts(self, collectionName: str) -> Dict[str, int]:
+        cMD = self.dbManager.collectionsMD.find_one({'_id': collectionName}, {CollectionSchemaIndex.MD_SCHEMA_KEYS: 1})
+        if cMD == None:
+            return None
+
+        schemaKeys = cMD.get(CollectionSchemaIndex.MD_SCHEMA_KEYS)
+        if schemaKeys == None:
+            return None
+
+        # Concurrent incremental updates may push the same key more than once:
+        keyCounts = dict()
+        for entry in schemaKeys:
+            key = entry.get(CollectionSchemaIndex.MD_KEY)
+            keyCounts[key] = keyCounts.get(key, 0) + entry.get(CollectionSchemaIndex.MD_COUNT, 0)
+
+        return keyCounts
+
+    def saveKeyCounts(self, collectionName: str, keyCounts: Dict[str, int], sampled: bool):
+        schemaKeys = [{CollectionSchemaIndex.MD_KEY: key, CollectionSchemaIndex.MD_COUNT: count} for key, count in keyCounts.items()]
+        self.dbManager.collectionsMD.update_one({'_id': collectionName}, 
+                                                {'$set': {CollectionSchemaIndex.MD_SCHEMA_KEYS: schemaKeys, CollectionSchemaIndex.MD_SCHEMA_SAMPLED: sampled}}, upsert=True)
+
+    def forget(self, collectionName: str):
+        with self.lock:
+            self.collectionKeyCounts.pop(collectionName, None)
+            self.notIndexedCheckTimes.pop(collectionName, None)
+            self.pendingNewKeyCounts.pop(collectionName, None)
+            self.pendingIncrements.pop(collectionName, None)
+
+        self.dbManager.collectionsMD.update_one({'_id': collectionName}, 
+                                                {'$unset': {CollectionSchemaIndex.MD_SCHEMA_KEYS: '', CollectionSchemaIndex.MD_SCHEMA_SAMPLED: ''}})
+
+    def onDocumentsWritten(self, collectionName: str, documents: List[dict], insertedSids: Iterable[str]):
+        """Updates the key counts from the documents returned by a document operation. Only the documents with a sid in insertedSids
+        were inserted and are counted, the others were modified or unchanged and only contribute keys that weren't known yet.
+        The changes are persisted in batches, see flush().
+        """
+        if collectionName == None or self.getIndexedKeyCounts(collectionName) == None:
+            return
+
+        try:
+            self.updateKeyCounts(collectionName, documents, set(insertedSids))
+        except Exception as e:
+            logger.error(f'Failed to update the key index of collection {collectionName}. Reason: {str(e)}')
+
+    def updateKeyCounts(self, collectionName: str, documents: List[dict], insertedSids: Set[str]):
+        with self.lock:
+            keyCounts = self.collectionKeyCounts.setdefault(collectionName, dict())
+            newKeyCounts = self.pendingNewKeyCounts.setdefault(collectionName, dict())
+            increments = self.pendingIncrements.setdefault(collectionName, dict())
+
+            for document in documents:
+                isNewDocument = document.get(Keys.systemIDKey) in insertedSids
+                for key in document.keys():
+                    if not key in keyCounts:
+                        keyCounts[key] = 1
+                        newKeyCounts[key] = 1
+                    elif isNewDocument:
+                        keyCounts[key] += 1
+                        if key in newKeyCounts:
+                            newKeyCounts[key] += 1
+                        else:
+                            increments[key] = increments.get(key, 0) + 1
+
+            flushRequired = time.time() - self.lastFlushTime >= self.flushIntervalInSeconds
+
+        if flushRequired:
+            self.flush()
+
+    def flush(self):
+        """Persists the pending key count changes of all collections with at most two writes per collection.
+        """
+        with self.lock:
+            pendingNewKeyCounts = self.pendingNewKeyCounts
+            pendingIncrements = self.pendingIncrements
+            self.pendingNewKeyCounts = dict()
+            self.pendingIncrements = dict()
+            self.lastFlushTime = time.time()
+
+        for collectionName in set(pendingNewKeyCounts.keys()) | set(pendingIncrements.keys()):
+            try:
+                self.writeKeyCountChanges(collectionName, pendingNewKeyCounts.get(collectionName, dict()), pendingIncrements.get(collectionName, dict()))
+            except Exception as e:
+                logger.error(f'Failed to save the key index of collection {collectionName}. Reason: {str(e)}')
+
+    def writeKeyCountChanges(self, collectionName: str, newKeyCounts: Dict[str, int], increments: Dict[str, int]):
+        if len(newKeyCounts) > 0:
+            schemaKeys = [{CollectionSchemaIndex.MD_KEY: key, CollectionSchemaIndex.MD_COUNT: count} for key, count in newKeyCounts.items()]
+            self.dbManager.collectionsMD.update_one({'_id': collectionName}, {'$push': {CollectionSchemaIndex.MD_SCHEMA_KEYS: {'$each': schemaKeys}}})
+
+        if len(increments) > 0:
+            # Group keys by increment to keep the number of array filters small:
+            keysByIncrement: Dict[int, List[str]] = dict()
+            for key, increment in increments.items():
+                keysByIncrement.setdefault(increment, []).append(key)
+
+            incUpdate = dict()
+            arrayFilters = []
+            for i, (increment, keys) in enumerate(keysByIncrement.items()):
+                incUpdate[f'{CollectionSchemaIndex.MD_SCHEMA_KEYS}.$[entry{i}].{CollectionSchemaIndex.MD_COUNT}'] = increment
+                arrayFilters.append({f'entry{i}.{CollectionSchemaIndex.MD_KEY}': {'$in': keys}})
+
+            self.dbManager.collectionsMD.update_one({'_id': collectionName}, {'$inc': incUpdate}, array_filters=arrayFilters)
@@ -1,4 +1,5 @@
 from MetadataManagerCore.service.ServiceMonitor import ServiceMonitor, ServiceProcessInfo
+from MetadataManagerCore.service.ServiceMonitorHub import ServiceMonitorHub
 import os
 import socket
 from MetadataManagerCore.service.ServiceTargetRestriction import ServiceTargetRestriction
@@ -8,7 +9,7 @@ from MetadataManagerCore.Event import Event
 from typing import Any, List
 from MetadataManagerCore.service.Service import Service, ServiceStatus
 from MetadataManagerCore.mongodb_manager import MongoDBManager
-from concurrent.futures import ThreadPoolExecutor
+from MetadataManagerCore.service.ServiceScheduler import ServiceScheduler, ServiceSchedulerMetrics
 import logging
 from datetime import datetime, timedelta
 from MetadataManagerCore.service.ServiceSerializationInfo import ServiceSerializationInfo
@@ -54,7 +55,8 @@ class ServiceManager(object):
         self.serviceClasses = set()
         self.serviceControllers: List[ServiceProcessController] = []
         self.serviceMonitors: List[ServiceMonitor] = []
-        self.threadPoolExecutor = ThreadPoolExecutor()
+        self.scheduler = ServiceScheduler()
+        self.serviceMonitorHub = ServiceMonitorHub(dbManager, self.scheduler)
         self.onServiceActiveStatusChanged = Event()
         self.onServiceProcessChangedEvent = Event()
         self.onServiceAdded = Event()
@@ -116,6 +118,12 @@ class ServiceManager(object):
             for s in unblockedServices:
                 self.addServiceFromName(s.serviceName)
             
+    @property
+    def schedulerMetrics(self) -> ServiceSchedulerMetrics:
+        """Returns the queue depth, task latency and thread count of the scheduler running the services and their monitors.
+        """
+        return self.scheduler.metrics
+
     def shutdown(self):
         self.isRunning = False
 
@@ -125,8 +133,10 @@ class ServiceManager(object):
         for serviceMonitor in self.serviceMonitors:
             serviceMonitor.shutdown()
 
+        self.serviceMonitorHub.shutdown()
+
         logger.info('Waiting for shutdown completion...')
-        self.threadPoolExecutor.shutdown(wait=True)
+        self.scheduler.shutdown(wait=True)
         logger.info('All services were shut down.')
         
     def save(self, settings, dbManager: MongoDBManager):
@@ -153,7 +163,7 @@ class ServiceManager(object):
             for serviceInfoDict in serviceInfos:
                 self.addServiceFromDict(serviceInfoDict)
 
-        self.threadPoolExecutor.submit(self.monitorServices)
+        self.scheduler.startThread('ServiceManager', self.monitorServices)
 
     def getServiceClassFromClassName(self, className: str):
         returnServiceClass = None
@@ -236,7 +246,8 @@ class ServiceManager(object):
                 # Try to create a service status and insert in DB. If this operation fails the service is locked to host/host process.
                 serviceProcessId = self.insertServiceStatus(serInfo, serviceClass)
                 if serviceProcessId != None:
-                    serviceController = ServiceProcessController(self.dbManager, self.serviceRegistry, serviceProcessId, serInfo, serviceClass, self.threadPoolExecutor)
+                    heartbeatWriter = self.hostProcessController.heartbeatWriter if self.hostProcessController else None
+                    serviceController = ServiceProcessController(self.dbManager, self.serviceRegistry, serviceProcessId, serInfo, serviceClass, self.scheduler, heartbeatWriter)
                     serviceController.service.statusChangedEvent.subscribe(lambda status: self.onServiceStatusChanged(serviceController.service, status))
                     serviceController.submitServiceRunner()
                     self.serviceControllers.append(serviceController)
@@ -252,7 +263,7 @@ class ServiceManager(object):
         hasServiceMonitor = any(True for m in self.serviceMonitors if m.serviceName == serInfo.name)
         if not hasServiceMonitor:
             serviceProcessId = ServiceManager.getServiceProcessId(serInfo, serviceClass)
-            serviceMonitor = ServiceMonitor(serviceInfoDict, self.dbManager, self.threadPoolExecutor)
+            serviceMonitor = ServiceMonitor(serviceInfoDict, self.dbManager, self.scheduler, self.serviceMonitorHub)
             self.serviceMonitors.append(serviceMonitor)
 
             self.onServiceAdded(ServiceInfo(serviceInfoDict))
@@ -2,7 +2,7 @@ from MetadataManagerCore.service.ServiceSerializationInfo import ServiceSerializ
 from typing import Dict, List
 from MetadataManagerCore.Event import Event
 from MetadataManagerCore.service.Service import ServiceStatus
-from concurrent.futures.thread import ThreadPoolExecutor
+from MetadataManagerCore.service.ServiceScheduler import ServiceScheduler
 from MetadataManagerCore.mongodb_manager import MongoDBManager
 import time
 from MetadataManagerCore.service.ServiceInfo import ServiceInfo
@@ -38,7 +38,12 @@ class ServiceProcessInfo(object):
         return self.processDict.get(key)
 
 class ServiceMonitor(object):
-    def __init__(self, serviceInfoDict: dict, dbManager: MongoDBManager, threadPoolExecutor: ThreadPoolExecutor) -> None:
+    def __init__(self, serviceInfoDict: dict, dbManager: MongoDBManager, scheduler: ServiceScheduler, monitorHub = None) -> None:
+        """
+        Args:
+            monitorHub (ServiceMonitorHub, optional): If specified, the monitor receives its updates from the hub shared by all monitors of this process.
+                                                      Otherwise the monitor polls the database as a periodic task of the scheduler.
+        """
         super().__init__()
 
         self.serviceName = serviceInfoDict.get('name')
@@ -47,6 +52,9 @@ class ServiceMonitor(object):
         self.checkIntervalInSeconds = 1.0
         self.lastStatus = None
         self.lastServiceInfo = ServiceInfo(serviceInfoDict)
+        self.monitorHub = monitorHub
+        self.initialized = False
+        self.periodicTask = None
 
         self.lastServiceProcessInfos: Dict[str, ServiceProcessInfo] = dict()
 
@@ -56,7 +64,10 @@ class ServiceMonitor(object):
         self._onServiceInfoChanged = Event()
         self._onServiceProcessChanged = Event()
 
-        threadPoolExecutor.submit(self.run)
+        if self.monitorHub:
+            self.monitorHub.register(self)
+        else:
+            self.periodicTask = scheduler.schedulePeriodic(f'ServiceMonitor {self.serviceName}', self.check, self.checkIntervalInSeconds)
 
     @property
     def serviceDescription(self):
@@ -109,7 +120,15 @@ class ServiceMonitor(object):
     def shutdown(self):
         self.isRunning = False
 
-    def run(self):
+        if self.monitorHub:
+            self.monitorHub.unregister(self)
+
+        if self.periodicTask:
+            self.periodicTask.cancel()
+
+    def initialize(self):
+        """Loads the current state without emitting events.
+        """
         self.lastServiceInfo = self.findServiceInfo()
         serviceProcessInfoDicts = self.findProcessInfos()
 
@@ -118,62 +137,103 @@ class ServiceMonitor(object):
                 id = processInfoDict.get('_id')
                 self.lastServiceProcessInfos[id] = ServiceProcessInfo(processInfoDict)
 
+        self.initialized = True
+
+    def check(self):
+        """Polls the current state and emits the change events. The first call loads the state without emitting events.
+        """
+        if not self.initialized:
+            self.initialize()
+            return
+
+        self.applyServiceInfo(self.findServiceInfo())
+        self.applyServiceProcessInfoDicts(self.findProcessInfos())
+
+    def run(self):
         while self.isRunning:
+            self.check()
             time.sleep(self.checkIntervalInSeconds)
 
-            curServiceInfo = self.findServiceInfo()
-
-            if curServiceInfo.serviceDict != self.lastServiceInfo.serviceDict:
-                lastServiceInfo = self.lastServiceInfo
-                self.lastServiceInfo = curServiceInfo
-                self._onServiceInfoChanged(lastServiceInfo, curServiceInfo)
-
-            # Check for service process changes:
-            # Set last info dicts to dirty:
-            for processInfo in self.lastServiceProcessInfos.values():
-                processInfo.dirty = True
-
-            curServiceProcessInfoDicts = self.findProcessInfos()
-            addedServiceProcessInfos: List[ServiceProcessInfo] = []
-            if curServiceProcessInfoDicts:
-                for curProcessInfoDict in curServiceProcessInfoDicts:
-                    curProcessInfo = ServiceProcessInfo(curProcessInfoDict)
-                    if self.lastServiceProcessInfos:
-                        id = curProcessInfo.id
-                        lastServiceProcessInfo = self.lastServiceProcessInfos.get(id)
-                        if lastServiceProcessInfo:
-                            lastServiceProcessInfo.dirty = False
-                            lastStatus = lastServiceProcessInfo.status
-                            curStatus = curProcessInfo.status
-
-                            if lastStatus != curStatus:
-                                lastStatus = ServiceStatus(lastStatus) if lastStatus else None
-                                curStatus = ServiceStatus(curStatus) if curStatus else None
-                                self.lastServiceProcessInfos[id] = curProcessInfo
-                                self.onServiceProcessStatusChangedEvent(id, lastStatus, curStatus)
-                                self._onServiceProcessChanged(curProcessInfo)
-                        else:
-                            addedServiceProcessInfos.append(curProcessInfo)
+    def applyServiceInfo(self, curServiceInfo: ServiceInfo):
+        if curServiceInfo.serviceDict != self.lastServiceInfo.serviceDict:
+            lastServiceInfo = self.lastServiceInfo
+            self.lastServiceInfo = curServiceInfo
+            self._onServiceInfoChanged(lastServiceInfo, curServiceInfo)
+
+    def applyServiceProcessInfoDicts(self, curServiceProcessInfoDicts):
+        """Compares the given complete set of service process dictionaries with the last known state and emits the change events.
+        """
+        # Check for service process changes:
+        # Set last info dicts to dirty:
+        for processInfo in self.lastServiceProcessInfos.values():
+            processInfo.dirty = True
+
+        addedServiceProcessInfos: List[ServiceProcessInfo] = []
+        if curServiceProcessInfoDicts:
+            for curProcessInfoDict in curServiceProcessInfoDicts:
+                curProcessInfo = ServiceProcessInfo(curProcessInfoDict)
+                if self.lastServiceProcessInfos:
+                    id = curProcessInfo.id
+                    lastServiceProcessInfo = self.lastServiceProcessInfos.get(id)
+                    if lastServiceProcessInfo:
+                        lastServiceProcessInfo.dirty = False
+                        self.updateServiceProcessStatus(lastServiceProcessInfo, curProcessInfo)
                     else:
                         addedServiceProcessInfos.append(curProcessInfo)
+                else:
+                    addedServiceProcessInfos.append(curProcessInfo)
 
-            removedServiceProcessIds: List[str] = []
-            for processInfo in self.lastServiceProcessInfos.values():
-                if processInfo.dirty:
-                    removedServiceProcessIds.append(processInfo.id)
-
-            for removedProcessId in removedServiceProcessIds:
-                removedProcessInfo = self.lastServiceProcessInfos.pop(removedProcessId)
-                self.onServiceProcessRemovedEvent(removedProcessId)
+        removedServiceProcessIds: List[str] = []
+        for processInfo in self.lastServiceProcessInfos.values():
+            if processInfo.dirty:
+                removedServiceProcessIds.append(processInfo.id)
 
-                self._onServiceProcessChanged(removedProcessInfo)
+        for removedProcessId in removedServiceProcessIds:
+            self.removeServiceProcess(removedProcessId)
 
-            for addedProcessInfo in addedServiceProcessInfos:
-                id = addedProcessInfo.id
-                self.lastServiceProcessInfos[id] = addedProcessInfo
-                self.onServiceProcessAddedEvent(id)
+        for addedProcessInfo in addedServiceProcessInfos:
+            self.addServiceProcess(addedProcessInfo)
 
-                self._onServiceProcessChanged(addedProcessInfo)
+    def applyServiceProcessInfoDict(self, processInfoDict: dict):
+        """Applies a single inserted or modified service process dictionary.
+        """
+        curProcessInfo = ServiceProcessInfo(processInfoDict)
+        lastServiceProcessInfo = self.lastServiceProcessInfos.get(curProcessInfo.id)
+        if lastServiceProcessInfo:
+            self.updateServiceProcessStatus(lastServiceProcessInfo, curProcessInfo)
+        else:
+            self.addServiceProcess(curProcessInfo)
+
+    def updateServiceProcessStatus(self, lastServiceProcessInfo: ServiceProcessInfo, curProcessInfo: ServiceProcessInfo):
+        id = curProcessInfo.id
+        lastStatus = lastServiceProcessInfo.status
+        curStatus = curProcessInfo.status
+
+        if lastStatus != curStatus:
+            lastStatus = ServiceStatus(lastStatus) if lastStatus else None
+            curStatus = ServiceStatus(curStatus) if curStatus else None
+            self.lastServiceProcessInfos[id] = curProcessInfo
+            self.onServiceProcessStatusChangedEvent(id, lastStatus, curStatus)
+            self._onServiceProcessChanged(curProcessInfo)
+
+    def addServiceProcess(self, addedProcessInfo: ServiceProcessInfo):
+        id = addedProcessInfo.id
+        self.lastServiceProcessInfos[id] = addedProcessInfo
+        self.onServiceProcessAddedEvent(id)
+
+        self._onServiceProcessChanged(addedProcessInfo)
+
+    def removeServiceProcess(self, removedProcessId: str):
+        removedProcessInfo = self.lastServiceProcessInfos.pop(removedProcessId, None)
+        if removedProcessInfo == None:
+            return
+
+        self.onServiceProcessRemovedEvent(removedProcessId)
+
+        self._onServiceProcessChanged(removedProcessInfo)
+
+    def hasServiceProcess(self, serviceProcessId: str):
+        return serviceProcessId in self.lastServiceProcessInfos
 
     @property
     def serviceProcessInfos(self) -> List[ServiceProcessInfo]:
@@ -0,0 +1,162 @@
+from MetadataManagerCore import Keys
+from MetadataManagerCore.mongodb_manager import MongoDBManager
+from MetadataManagerCore.host.HeartbeatWriter import HeartbeatWriter
+from MetadataManagerCore.service.ServiceInfo import ServiceInfo
+from MetadataManagerCore.service.ServiceScheduler import ServiceScheduler
+from typing import Dict, List
+import pymongo
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class ServiceMonitorHub(object):
+    """
+    Feeds all ServiceMonitors of this process from a single MongoDB change stream on the services and service_processes collections.
+    Heartbeat-only updates of service processes are filtered out on the server.
+
+    Change streams require a replica set. On standalone servers the hub falls back to polling with one batched query per collection 
+    for all registered services instead of two queries per service.
+    """
+    def __init__(self, dbManager: MongoDBManager, scheduler: ServiceScheduler) -> None:
+        super().__init__()
+
+        self.dbManager = dbManager
+        self.isRunning = True
+        self.pollingIntervalInSeconds = 1.0
+        self.retryIntervalInSeconds = 1.0
+        self.lock = threading.RLock()
+        self.monitors: Dict[str, object] = dict()
+
+        # None: Unknown until the first watch attempt.
+        self.changeStreamSupported: bool = None
+        self.resumeToken = None
+
+        scheduler.startThread('ServiceMonitorHub', self.run)
+
+    def register(self, monitor):
+        """Registers the ServiceMonitor and initializes its state. Changes are dispatched to the monitor from the hub thread afterwards.
+        """
+        with self.lock:
+            monitor.initialize()
+            self.monitors[monitor.serviceName] = monitor
+
+    def unregister(self, monitor):
+        with self.lock:
+            if self.monitors.get(monitor.serviceName) == monitor:
+                self.monitors.pop(monitor.serviceName)
+
+    def shutdown(self):
+        self.isRunning = False
+
+    def run(self):
+        while self.isRunning:
+            if self.changeStreamSupported != False:
+                try:
+                    self.watchChanges()
+                except pymongo.errors.PyMongoError as e:
+                    if self.changeStreamSupported == None:
+                        logger.info(f'Change streams are not available, falling back to polling. Reason: {str(e)}')
+                        self.changeStreamSupported = False
+                    else:
+                        logger.warning(f'Service change stream interrupted: {str(e)}')
+                        time.sleep(self.retryIntervalInSeconds)
+                except Exception as e:
+                    logger.error(f'Service monitoring failed with exception: {str(e)}')
+                    time.sleep(self.retryIntervalInSeconds)
+            else:
+                try:
+                    self.poll()
+                except Exception as e:
+                    logger.error(f'Service monitoring failed with exception: {str(e)}')
+
+                time.sleep(self.pollingIntervalInSeconds)
+
+    @staticmethod
+    def getChangeStreamPipeline():
+        updatedKeys = {'$map': {'input': {'$objectToArray': {'$ifNull': ['$updateDescription.updatedFields', {}]}}, 'in': '$$this.k'}}
+        return [{'$match': {
+            'ns.coll': {'$in': [Keys.SERVICE_COLLECTION, Keys.SERVICE_PROCESS_COLLECTION]},
+            # Ignore updates that only change the heartbeat:
+            '$or': [
+                {'operationType': {'$ne': 'update'}},
+                {'$expr': {'$gt': [{'$size': {'$setDifference': [updatedKeys, [HeartbeatWriter.HEARTBEAT_TIME_KEY, HeartbeatWriter.HEARTBEAT_LATENCY_KEY]]}}, 0]}}
+            ]
+        }}]
+
+    def watchChanges(self):
+        resumeToken = self.resumeToken
+        try:
+            stream = self.dbManager.db.watch(ServiceMonitorHub.getChangeStreamPipeline(), full_document='updateLookup', 
+                                             resume_after=resumeToken, max_await_time_ms=int(self.pollingIntervalInSeconds * 1000))
+        except pymongo.errors.OperationFailure:
+            if resumeToken == None:
+                raise
+
+            # The resume token may have expired. Start a new stream and resynchronize:
+            self.resumeToken = None
+            stream = self.dbManager.db.watch(ServiceMonitorHub.getChangeStreamPipeline(), full_document='updateLookup', 
+                                             max_await_time_ms=int(self.pollingIntervalInSeconds * 1000))
+            resumeToken = None
+
+        with stream:
+            self.changeStreamSupported = True
+
+            # Changes that happened before the stream was opened are picked up by a full synchronization:
+            if resumeToken == None:
+                self.poll()
+
+            while self.isRunning and stream.alive:
+                change = stream.try_next()
+                self.resumeToken = stream.resume_token
+
+                if change != None:
+                    try:
+                        self.dispatch(change)
+                    except Exception as e:
+                        logger.error(f'Failed to dispatch service change: {str(e)}')
+
+    def dispatch(self, change: dict):
+        collectionName = change.get('ns', {}).get('coll')
+        operationType = change.get('operationType')
+        documentId = change.get('documentKey', {}).get('_id')
+        fullDocument = change.get('fullDocument')
+
+        with self.lock:
+            if collectionName == Keys.SERVICE_COLLECTION:
+                monitor = self.monitors.get(documentId)
+                if monitor:
+                    if operationType == 'delete':
+                        monitor.applyServiceInfo(ServiceInfo(None))
+                    elif fullDocument != None:
+                        monitor.applyServiceInfo(ServiceInfo(fullDocument))
+            elif collectionName == Keys.SERVICE_PROCESS_COLLECTION:
+                if operationType == 'delete':
+                    for monitor in list(self.monitors.values()):
+                        if monitor.hasServiceProcess(documentId):
+                            monitor.removeServiceProcess(documentId)
+                elif fullDocument != None:
+                    monitor = self.monitors.get(fullDocument.get('name'))
+                    if monitor:
+                        monitor.applyServiceProcessInfoDict(fullDocument)
+
+    def poll(self):
+        """Synchronizes all registered monitors with one query per collection.
+        """
+        with self.lock:
+            serviceNames = list(self.monitors.keys())
+            if len(serviceNames) == 0:
+                return
+
+            serviceDicts = {d.get('_id'): d for d in self.dbManager.serviceCollection.find({'_id': {'$in': serviceNames}})}
+            processDicts: Dict[str, List[dict]] = dict()
+            for processDict in self.dbManager.serviceProcessCollection.find({'name': {'$in': serviceNames}}):
+                processDicts.setdefault(processDict.get('name'), []).append(processDict)
+
+            for serviceName, monitor in list(self.monitors.items()):
+                try:
+                    monitor.applyServiceInfo(ServiceInfo(serviceDicts.get(serviceName)))
+                    monitor.applyServiceProcessInfoDicts(processDicts.get(serviceName, []))
+                except Exception as e:
+                    logger.error(f'Failed to update the service monitor of {serviceName}: {str(e)}')
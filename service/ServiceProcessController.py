@@ -1,19 +1,22 @@
 from MetadataManagerCore.Event import Event
 from MetadataManagerCore.mongodb_manager import MongoDBManager
-from concurrent.futures.thread import ThreadPoolExecutor
+from MetadataManagerCore.host.HeartbeatWriter import HeartbeatWriter
+from MetadataManagerCore import Keys
+from MetadataManagerCore.service.ServiceScheduler import ServiceScheduler
 from typing import Any
 from MetadataManagerCore.service.Service import Service, ServiceStatus
 import logging
 from MetadataManagerCore.service.ServiceSerializationInfo import ServiceSerializationInfo
 from datetime import datetime
-import time
+import threading
 
 logger = logging.getLogger(__name__)
 
 class ServiceProcessController(object):
     dyingTimeInSeconds = 5.0
 
-    def __init__(self, dbManager: MongoDBManager, serviceRegistry, serviceProcessId: str, serviceSerializationInfo: ServiceSerializationInfo, serviceClass: Any, threadPoolExecutor: ThreadPoolExecutor) -> None:
+    def __init__(self, dbManager: MongoDBManager, serviceRegistry, serviceProcessId: str, serviceSerializationInfo: ServiceSerializationInfo, serviceClass: Any, scheduler: ServiceScheduler, 
+                 heartbeatWriter: HeartbeatWriter = None) -> None:
         super().__init__()
 
         self.dbManager = dbManager
@@ -22,7 +25,11 @@ class ServiceProcessController(object):
         self.isRunning = True
         self.heartbeatUpdateIntervalInSeconds = 1.0
         self._onServiceProcessFailedEvent = Event()
-        self.threadPoolExecutor = threadPoolExecutor
+        self.scheduler = scheduler
+        self.heartbeatWriter = heartbeatWriter
+        self.heartbeatTask = None
+        self.heartbeatStopped = False
+        self.heartbeatLock = threading.Lock()
         self.serviceClass = serviceClass
         self.service, self.successfulServiceCreation = serviceSerializationInfo.constructService(self.serviceClass)
         self.statusSerializationFailed = False
@@ -31,10 +38,14 @@ class ServiceProcessController(object):
         self.service.statusChangedEvent.subscribe(self.onServiceProcessStatusChanged)
 
     def submitServiceRunner(self):
-        self.threadPoolExecutor.submit(self.runHeartbeatUpdate)
+        if self.heartbeatWriter:
+            self.heartbeatWriter.register(self.serviceProcessId, Keys.SERVICE_PROCESS_COLLECTION, {'_id': self.serviceProcessId}, 
+                                          upsert=False, onFailure=self.onHeartbeatFailed)
+        else:
+            self.heartbeatTask = self.scheduler.schedulePeriodic(f'Heartbeat {self.serviceProcessId}', self.updateHeartbeat, self.heartbeatUpdateIntervalInSeconds)
 
         if self.successfulServiceCreation:
-            self.threadPoolExecutor.submit(self.runService)
+            self.scheduler.startThread(f'Service {self.service.name}', self.runService)
         else:
             self.service.status = ServiceStatus.Failed
             self.updateServiceProcessValue('status', str(ServiceStatus.Failed.value))
@@ -49,6 +60,7 @@ class ServiceProcessController(object):
         logger.info(f'Shutting down service {self.service.name} ...')
         self.isRunning = False
         self.service.status = ServiceStatus.ShuttingDown
+        self.stopHeartbeat()
     
     def onServiceProcessStatusChanged(self, serviceStatus: ServiceStatus):
         if self.statusSerializationFailed:
@@ -61,6 +73,7 @@ class ServiceProcessController(object):
             self.statusSerializationFailed = True
             self.service.status = ServiceStatus.Failed
             self.isRunning = False
+            self.stopHeartbeat()
             return
 
         if serviceStatus == ServiceStatus.Starting:
@@ -69,6 +82,7 @@ class ServiceProcessController(object):
             self.updateServiceValue('active', False)
         elif serviceStatus == ServiceStatus.Failed:
             self.isRunning = False
+            self.stopHeartbeat()
 
     def runService(self):
         try:
@@ -77,24 +91,49 @@ class ServiceProcessController(object):
             logger.error(f'Service {self.service.name} failed with exception: {str(e)}')
             self.service.status = ServiceStatus.Failed
 
-    def runHeartbeatUpdate(self):
-        while self.isRunning:
-            try:
-                self.updateServiceProcessValue('heartbeat_time', datetime.utcnow())
-            except Exception as e:
-                logger.error(f'Heartbeat update failed with exception: {str(e)}')
-                self.service.status = ServiceStatus.Failed
-                self.isRunning = False
-                break
+    def onHeartbeatFailed(self, exception: Exception):
+        self.service.status = ServiceStatus.Failed
+        self.isRunning = False
+        self.stopHeartbeat()
+
+    def stopHeartbeat(self):
+        """Stops the heartbeat and removes the service process.
+        """
+        with self.heartbeatLock:
+            if self.heartbeatStopped:
+                return
+
+            self.heartbeatStopped = True
 
-            time.sleep(self.heartbeatUpdateIntervalInSeconds)
+        if self.heartbeatWriter:
+            self.heartbeatWriter.unregister(self.serviceProcessId)
 
-        # Remove service process
+        if self.heartbeatTask:
+            self.heartbeatTask.cancel()
+
+        self.deleteServiceProcess()
+
+    def deleteServiceProcess(self):
         try:
             self.dbManager.serviceProcessCollection.delete_one({'_id': self.serviceProcessId})
         except Exception as e:
             logger.error(f'Deleting service process with id {self.serviceProcessId} failed with exception: {str(e)}')
 
+    def updateHeartbeat(self):
+        """Periodic heartbeat task used if no shared heartbeat writer is available.
+        """
+        if not self.isRunning:
+            self.stopHeartbeat()
+            return
+
+        try:
+            self.updateServiceProcessValue(HeartbeatWriter.HEARTBEAT_TIME_KEY, datetime.utcnow())
+        except Exception as e:
+            logger.error(f'Heartbeat update failed with exception: {str(e)}')
+            self.service.status = ServiceStatus.Failed
+            self.isRunning = False
+            self.stopHeartbeat()
+
     def saveService(self):
         serInfo = ServiceSerializationInfo(self.serviceRegistry)
         serInfo.setupFromService(self.service)
@@ -0,0 +1,226 @@
+from concurrent.futures import ThreadPoolExecutor, Future
+from typing import Callable, List
+import itertools
+import threading
+import heapq
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+class PeriodicTask(object):
+    def __init__(self, name: str, function: Callable[[], None], intervalInSeconds: float) -> None:
+        super().__init__()
+
+        self.name = name
+        self.function = function
+        self.intervalInSeconds = intervalInSeconds
+        self.cancelled = False
+        self.running = False
+        self.runCount = 0
+        self.skippedRunCount = 0
+
+    def cancel(self):
+        self.cancelled = True
+
+class ServiceSchedulerMetrics(object):
+    def __init__(self) -> None:
+        super().__init__()
+
+        # Number of tasks that were dispatched to the worker pool but didn't start yet.
+        self.queueDepth = 0
+
+        # Time between the scheduled and the actual start of tasks.
+        self.averageTaskLatencyInSeconds = 0.0
+        self.maxTaskLatencyInSeconds = 0.0
+
+        self.threadCount = 0
+        self.dedicatedThreadCount = 0
+        self.workerThreadCount = 0
+        self.periodicTaskCount = 0
+        self.executedTaskCount = 0
+
+        # Runs of periodic tasks that were skipped because the previous run was still in progress.
+        self.skippedRunCount = 0
+
+    def __str__(self) -> str:
+        return (f'Queue depth: {self.queueDepth}, Threads: {self.threadCount} (dedicated: {self.dedicatedThreadCount}, workers: {self.workerThreadCount}), '
+                f'Periodic tasks: {self.periodicTaskCount}, Executed tasks: {self.executedTaskCount}, Skipped runs: {self.skippedRunCount}, '
+                f'Task latency: {self.averageTaskLatencyInSeconds * 1000.0:.1f} ms (max: {self.maxTaskLatencyInSeconds * 1000.0:.1f} ms)')
+
+class ServiceScheduler(object):
+    """
+    Runs the work of the ServiceManager:
+        - Long-running service bodies get a dedicated thread each so they can't starve each other.
+        - Periodic tasks like monitors and heartbeats are driven by a single timer thread and executed on a bounded worker pool.
+          A periodic task never overlaps with itself: If a run is still in progress when the next one is due, the run is skipped.
+    """
+    def __init__(self, maxWorkers: int = 4, name: str = 'ServiceScheduler') -> None:
+        super().__init__()
+
+        self.name = name
+        self.maxWorkers = maxWorkers
+        self.isRunning = True
+        self.condition = threading.Condition()
+
+        # Entries: (dueTime, sequence number, PeriodicTask)
+        self.timerHeap = []
+        self.sequence = itertools.count()
+        self.periodicTasks: List[PeriodicTask] = []
+        self.dedicatedThreads: List[threading.Thread] = []
+        self.workerPool = ThreadPoolExecutor(max_workers=maxWorkers, thread_name_prefix=f'{name}Worker')
+
+        self.metricsLock = threading.Lock()
+        self.queueDepth = 0
+        self.executedTaskCount = 0
+        self.averageTaskLatencyInSeconds = 0.0
+        self.maxTaskLatencyInSeconds = 0.0
+        self.latencySmoothingFactor = 0.1
+        self.workerThreadIds = set()
+
+        self.timerThread = threading.Thread(target=self.runTimer, name=f'{name}Timer', daemon=True)
+        self.timerThread.start()
+
+    def startThread(self, name: str, target: Callable, *args) -> threading.Thread:
+        """Runs the given long-running function on a dedicated thread.
+        """
+        thread = threading.Thread(target=self.runDedicated, args=(name, target, args), name=name)
+
+        with self.metricsLock:
+            self.dedicatedThreads = [t for t in self.dedicatedThreads if t.is_alive()]
+            self.dedicatedThreads.append(thread)
+
+        thread.start()
+        return thread
+
+    def schedulePeriodic(self, name: str, function: Callable[[], None], intervalInSeconds: float, initialDelayInSeconds: float = 0.0) -> PeriodicTask:
+        """Runs the given function every intervalInSeconds on the worker pool until the returned task is cancelled.
+        """
+        task = PeriodicTask(name, function, intervalInSeconds)
+
+        with self.condition:
+            self.periodicTasks.append(task)
+            heapq.heappush(self.timerHeap, (time.monotonic() + initialDelayInSeconds, next(self.sequence), task))
+            self.condition.notify()
+
+        return task
+
+    def submit(self, function: Callable, *args) -> Future:
+        """Runs the given short function once on the worker pool.
+        """
+        return self.dispatch(lambda: function(*args), time.monotonic())
+
+    def runDedicated(self, name: str, target: Callable, args):
+        try:
+            target(*args)
+        except Exception as e:
+            logger.error(f'{name} failed with exception: {str(e)}')
+
+    def runTimer(self):
+        with self.condition:
+            while self.isRunning:
+                if len(self.timerHeap) == 0:
+                    self.condition.wait()
+                    continue
+
+                dueTime, _, task = self.timerHeap[0]
+                now = time.monotonic()
+                if dueTime > now:
+                    self.condition.wait(dueTime - now)
+                    continue
+
+                heapq.heappop(self.timerHeap)
+                if task.cancelled:
+                    self.periodicTasks.remove(task)
+                    continue
+
+                if task.running:
+                    task.skippedRunCount += 1
+                else:
+                    task.running = True
+                    self.dispatch(task.function, dueTime, task)
+
+                # Keep a fixed rate but don't try to catch up with missed runs:
+                nextDueTime = dueTime + task.intervalInSeconds
+                if nextDueTime < now:
+                    nextDueTime = now + task.intervalInSeconds
+
+                heapq.heappush(self.timerHeap, (nextDueTime, next(self.sequence), task))
+
+    def dispatch(self, function: Callable[[], None], scheduledTime: float, task: PeriodicTask = None) -> Future:
+        with self.metricsLock:
+            self.queueDepth += 1
+
+        try:
+            return self.workerPool.submit(self.execute, function, scheduledTime, task)
+        except RuntimeError:
+            # The pool was shut down.
+            with self.metricsLock:
+                self.queueDepth -= 1
+
+            if task:
+                task.running = False
+
+            raise
+
+    def execute(self, function: Callable[[], None], scheduledTime: float, task: PeriodicTask):
+        latency = max(time.monotonic() - scheduledTime, 0.0)
+        with self.metricsLock:
+            self.queueDepth -= 1
+            self.executedTaskCount += 1
+            self.workerThreadIds.add(threading.get_ident())
+            self.maxTaskLatencyInSeconds = max(self.maxTaskLatencyInSeconds, latency)
+            s = self.latencySmoothingFactor
+            self.averageTaskLatencyInSeconds = (1.0 - s) * self.averageTaskLatencyInSeconds + s * latency
+
+        try:
+            function()
+        except Exception as e:
+            taskName = task.name if task else 'Task'
+            logger.error(f'{taskName} failed with exception: {str(e)}')
+        finally:
+            if task:
+                task.runCount += 1
+                task.running = False
+
+    @property
+    def metrics(self) -> ServiceSchedulerMetrics:
+        metrics = ServiceSchedulerMetrics()
+
+        with self.condition:
+            metrics.periodicTaskCount = sum(1 for t in self.periodicTasks if not t.cancelled)
+            metrics.skippedRunCount = sum(t.skippedRunCount for t in self.periodicTasks)
+
+        with self.metricsLock:
+            metrics.queueDepth = self.queueDepth
+            metrics.executedTaskCount = self.executedTaskCount
+            metrics.averageTaskLatencyInSeconds = self.averageTaskLatencyInSeconds
+            metrics.maxTaskLatencyInSeconds = self.maxTaskLatencyInSeconds
+            metrics.dedicatedThreadCount = sum(1 for t in self.dedicatedThreads if t.is_alive())
+            metrics.workerThreadCount = len(self.workerThreadIds)
+
+        timerThreadCount = 1 if self.timerThread.is_alive() else 0
+        metrics.threadCount = metrics.dedicatedThreadCount + metrics.workerThreadCount + timerThreadCount
+        return metrics
+
+    def shutdown(self, wait: bool = True):
+        """Stops the periodic tasks. The owners of dedicated threads are responsible for ending their loops.
+        If wait is True, waits for running tasks and dedicated threads to finish.
+        """
+        with self.condition:
+            self.isRunning = False
+            for task in self.periodicTasks:
+                task.cancel()
+
+            self.condition.notify()
+
+        self.workerPool.shutdown(wait=wait)
+
+        if wait:
+            with self.metricsLock:
+                self.workerThreadIds.clear()
+                dedicatedThreads = list(self.dedicatedThreads)
+
+            for thread in dedicatedThreads:
+                if thread != threading.current_thread():
+                    thread.join()
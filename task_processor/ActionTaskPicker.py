@@ -8,11 +8,20 @@ class ActionTaskPicker(TaskPicker):
     """
     Handles Action and DocumentAction task types.
     """
-    def __init__(self, actionManager : ActionManager, documentFilterManager : DocumentFilterManager):
+    def __init__(self, actionManager : ActionManager, documentFilterManager : DocumentFilterManager, hostProcessController = None):
+        """
+        Args:
+            hostProcessController: Optional. If given, this host process takes part in distributed document actions:
+                The controller runs a DistributedDocumentActionWorker (see HostProcessController.startDistributedDocumentActionWorker).
+        """
         super().__init__()
 
         self.actionManager = actionManager
         self.documentFilterManager = documentFilterManager
+        self.hostProcessController = hostProcessController
+
+        if self.hostProcessController != None:
+            self.hostProcessController.startDistributedDocumentActionWorker(actionManager, documentFilterManager)
 
     def pickTask(self, taskType: str):
         """
@@ -21,6 +30,6 @@ class ActionTaskPicker(TaskPicker):
         if taskType == 'Action':
             return ActionTask(self.actionManager)
         elif taskType == 'DocumentAction':
-            return DocumentActionTask(self.actionManager, self.documentFilterManager)
+            return DocumentActionTask(self.actionManager, self.documentFilterManager, self.hostProcessController)
 
         return None
\ No newline at end of file
@@ -0,0 +1,389 @@
+from MetadataManagerCore.mongodb_manager import MongoDBManager
+from MetadataManagerCore.actions.ActionManager import ActionManager
+from MetadataManagerCore.filtering.DocumentFilterManager import DocumentFilterManager
+from MetadataManagerCore.task_processor.DocumentActionExecutor import DocumentActionExecutor, DocumentActionSummary, DocumentActionError
+from MetadataManagerCore import Keys
+from datetime import datetime, timedelta
+from collections import deque
+from typing import List
+import pymongo
+import socket
+import time
+import uuid
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+CHUNK_PENDING = 'pending'
+CHUNK_RUNNING = 'running'
+CHUNK_DONE = 'done'
+CHUNK_FAILED = 'failed'
+
+class ChunkProgress(object):
+    """
+    Tracks the documents of a chunk that were processed. The documents are processed in _id order, resumeAfterId is the _id of the last
+    document up to which all documents are processed (the processing order of concurrent execution may differ from the submission order).
+    """
+    def __init__(self, chunk: dict) -> None:
+        super().__init__()
+
+        progress = chunk.get('progress') or {}
+        self.resumeAfterId = progress.get('resumeAfterId')
+        self.numProcessed = progress.get('numProcessed', 0)
+        self.numFailed = progress.get('numFailed', 0)
+        self.errors: List[str] = list(progress.get('errors', []))
+
+        self.submittedIds = deque()
+        # Whether the action failed, per processed document that is not yet part of the processed prefix:
+        self.finishedIdToFailed = dict()
+
+    @property
+    def hasStarted(self):
+        return self.resumeAfterId != None
+
+    def onDocumentSubmitted(self, documentId):
+        self.submittedIds.append(documentId)
+
+    def onDocumentProcessed(self, documentId, failed: bool):
+        self.finishedIdToFailed[documentId] = failed
+
+        while len(self.submittedIds) > 0 and self.submittedIds[0] in self.finishedIdToFailed:
+            self.resumeAfterId = self.submittedIds.popleft()
+            self.numProcessed += 1
+            if self.finishedIdToFailed.pop(self.resumeAfterId):
+                self.numFailed += 1
+
+    def asDict(self) -> dict:
+        return {'resumeAfterId': self.resumeAfterId, 'numProcessed': self.numProcessed, 'numFailed': self.numFailed, 'errors': self.errors}
+
+class DocumentChunkWorkQueue(object):
+    """
+    Stores the _id-range chunks of distributed document action jobs in a work collection.
+    Chunks are claimed with leases. Chunks of expired leases or of host processes that were removed are requeued.
+    Each claim has its own lease token, so only the claimer can renew, complete or fail the chunk even if other workers of the same
+    host process claim it after the lease expired. The lease duration is stored with the chunks, so all hosts use the duration of the job.
+    """
+    def __init__(self, dbManager: MongoDBManager, collectionName: str = Keys.DOCUMENT_ACTION_WORK_COLLECTION,
+                 leaseDurationInSeconds: float = 120.0, maxAttempts: int = 3) -> None:
+        super().__init__()
+
+        self.dbManager = dbManager
+        self.collectionName = collectionName
+        self.leaseDurationInSeconds = leaseDurationInSeconds
+        self.maxAttempts = maxAttempts
+
+        self.collection.create_index([('jobId', pymongo.ASCENDING), ('status', pymongo.ASCENDING)])
+
+    @property
+    def collection(self):
+        return self.dbManager.db[self.collectionName]
+
+    def createJob(self, actionId: str, collectionNames: List[str], documentFilterString: str, settings: dict, chunkSize: int = 1000) -> str:
+        """Splits the documents matching the filter into _id-range chunks of at most chunkSize documents and returns the job id.
+        The settings are passed to the workers (customDocumentFilters, projection, batchSize, maxWorkers, useProcessPool, maxInFlight).
+        """
+        jobId = uuid.uuid4().hex
+        documentFilter = self.dbManager.stringToFilter(documentFilterString)
+        chunks = []
+
+        def addChunk(collectionName, minId, maxId, count):
+            chunks.append({
+                '_id': f'{jobId}_{len(chunks)}',
+                'jobId': jobId,
+                'actionId': actionId,
+                'collection': collectionName,
+                'documentFilter': documentFilterString,
+                'minId': minId,
+                'maxId': maxId,
+                'documentCount': count,
+                'settings': settings,
+                'status': CHUNK_PENDING,
+                'attempts': 0,
+                'maxAttempts': self.maxAttempts,
+                'leaseDurationInSeconds': self.leaseDurationInSeconds,
+                'createdTime': datetime.utcnow()
+            })
+
+        for collectionName in collectionNames:
+            # Only the ids are read to determine the chunk boundaries:
+            cursor = self.dbManager.db[collectionName].find(documentFilter, {'_id': 1}).sort('_id', pymongo.ASCENDING)
+            minId = None
+            lastId = None
+            count = 0
+            for d in cursor:
+                if count == 0:
+                    minId = d['_id']
+
+                lastId = d['_id']
+                count += 1
+                if count == chunkSize:
+                    addChunk(collectionName, minId, lastId, count)
+                    count = 0
+
+            if count > 0:
+                addChunk(collectionName, minId, lastId, count)
+
+        if len(chunks) > 0:
+            self.collection.insert_many(chunks)
+
+        logger.info(f'Created distributed job {jobId} with {len(chunks)} chunks for action {actionId}.')
+        return jobId
+
+    def claim(self, hostProcessId: str, jobId: str = None) -> dict:
+        """Claims the next pending chunk (of the given job if specified) or returns None.
+        Every claim counts as attempt. Chunks that were requeued after their last attempt (e.g. because they crashed or hung their host process)
+        are marked as failed instead of being returned.
+        """
+        query = {'status': CHUNK_PENDING}
+        if jobId != None:
+            query['jobId'] = jobId
+
+        while True:
+            now = datetime.utcnow()
+            leaseToken = uuid.uuid4().hex
+            chunk = self.collection.find_one_and_update(query,
+                {'$set': {'status': CHUNK_RUNNING, 'leaseOwner': hostProcessId, 'leaseToken': leaseToken, 
+                          'leaseExpiration': now + timedelta(seconds=self.leaseDurationInSeconds)},
+                 '$inc': {'attempts': 1}},
+                sort=[('_id', pymongo.ASCENDING)], return_document=pymongo.ReturnDocument.AFTER)
+
+            if chunk == None:
+                return None
+
+            # The stored attempts include this claim:
+            attempts = chunk.get('attempts', 1) - 1
+            if attempts >= chunk.get('maxAttempts', self.maxAttempts):
+                error = chunk.get('lastError') or f'The chunk was abandoned {attempts} times.'
+                self.collection.update_one({'_id': chunk['_id'], 'leaseToken': leaseToken},
+                                           {'$set': {'status': CHUNK_FAILED, 'attempts': attempts, 'lastError': error}, 
+                                            '$unset': {'leaseOwner': '', 'leaseToken': '', 'leaseExpiration': ''}})
+                logger.error(f'Chunk {chunk["_id"]} failed after {attempts} attempts: {error}')
+                continue
+
+            # The claim used the lease duration of this queue, apply the one of the job:
+            if self.getLeaseDurationInSeconds(chunk) != self.leaseDurationInSeconds:
+                self.renewLease(chunk)
+
+            return chunk
+
+    def getLeaseDurationInSeconds(self, chunk: dict) -> float:
+        return chunk.get('leaseDurationInSeconds', self.leaseDurationInSeconds)
+
+    def renewLease(self, chunk: dict, progress: ChunkProgress = None) -> bool:
+        """Extends the lease of the running chunk. If progress is given, it is stored as checkpoint the chunk is resumed from if it is requeued.
+        Returns False if the lease was lost, i.e. the chunk was requeued and possibly claimed by another worker.
+        """
+        values = {'leaseExpiration': datetime.utcnow() + timedelta(seconds=self.getLeaseDurationInSeconds(chunk))}
+        if progress != None:
+            values['progress'] = progress.asDict()
+
+        result = self.collection.update_one({'_id': chunk['_id'], 'leaseToken': chunk.get('leaseToken'), 'status': CHUNK_RUNNING}, {'$set': values})
+        return result.matched_count > 0
+
+    def complete(self, chunk: dict, summary: DocumentActionSummary, progress: ChunkProgress = None):
+        """Marks the chunk as done. If progress is given, its counts (including the documents of previous attempts) are stored 
+        instead of the counts of the summary.
+        """
+        numProcessed = summary.numProcessed
+        numFailed = summary.numFailed
+        errors = [str(e) for e in summary.errors]
+        if progress != None:
+            numProcessed = progress.numProcessed
+            numFailed = progress.numFailed
+            errors = (progress.errors + errors)[:DocumentActionSummary.maxRecordedErrors]
+
+        self.collection.update_one({'_id': chunk['_id'], 'leaseToken': chunk.get('leaseToken')}, {'$set': {
+            'status': CHUNK_DONE,
+            'numProcessed': numProcessed,
+            'numFailed': numFailed,
+            'errors': errors,
+            'finishedTime': datetime.utcnow()
+        }})
+
+    def fail(self, chunk: dict, error: str, progress: ChunkProgress = None):
+        """Requeues the chunk or marks it as failed if it has no attempts left.
+        If progress is given, the requeued chunk is resumed after the last processed document.
+        """
+        status = CHUNK_FAILED if chunk.get('attempts', 1) >= chunk.get('maxAttempts', self.maxAttempts) else CHUNK_PENDING
+        values = {'status': status, 'lastError': error}
+        if progress != None:
+            values['progress'] = progress.asDict()
+
+        self.collection.update_one({'_id': chunk['_id'], 'leaseToken': chunk.get('leaseToken')},
+                                   {'$set': values, '$unset': {'leaseOwner': '', 'leaseToken': '', 'leaseExpiration': ''}})
+
+    def requeueAbandonedChunks(self) -> int:
+        """Requeues running chunks with expired leases. Returns the number of requeued chunks.
+        """
+        return self.requeueChunks({'status': CHUNK_RUNNING, 'leaseExpiration': {'$lt': datetime.utcnow()}})
+
+    def requeueChunksOfHostProcess(self, hostProcessId: str) -> int:
+        """Requeues the running chunks claimed by the given host process. Must only be called for host processes that are known to be dead.
+        Returns the number of requeued chunks.
+        """
+        return self.requeueChunks({'status': CHUNK_RUNNING, 'leaseOwner': hostProcessId})
+
+    def requeueChunks(self, chunkFilter: dict) -> int:
+        result = self.collection.update_many(chunkFilter, {'$set': {'status': CHUNK_PENDING}, '$unset': {'leaseOwner': '', 'leaseToken': '', 'leaseExpiration': ''}})
+
+        if result.modified_count > 0:
+            logger.info(f'Requeued {result.modified_count} abandoned chunks.')
+
+        return result.modified_count
+
+    def getStatusCounts(self, jobId: str) -> dict:
+        counts = {CHUNK_PENDING: 0, CHUNK_RUNNING: 0, CHUNK_DONE: 0, CHUNK_FAILED: 0}
+        for entry in self.collection.aggregate([{'$match': {'jobId': jobId}}, {'$group': {'_id': '$status', 'count': {'$sum': 1}}}]):
+            counts[entry['_id']] = entry['count']
+
+        return counts
+
+    def isJobFinished(self, jobId: str) -> bool:
+        return self.collection.count_documents({'jobId': jobId, 'status': {'$in': [CHUNK_PENDING, CHUNK_RUNNING]}}, limit=1) == 0
+
+    def getJobSummary(self, jobId: str, actionId: str) -> DocumentActionSummary:
+        summary = DocumentActionSummary(actionId)
+        for chunk in self.collection.find({'jobId': jobId}):
+            if chunk.get('status') == CHUNK_FAILED:
+                # The documents processed before the chunk failed count as processed, the remaining ones as failed:
+                progress = chunk.get('progress') or {}
+                numProcessed = progress.get('numProcessed', 0)
+                summary.numProcessed += chunk.get('documentCount', 0)
+                summary.numFailed += progress.get('numFailed', 0) + max(chunk.get('documentCount', 0) - numProcessed, 0)
+                if len(summary.errors) < DocumentActionSummary.maxRecordedErrors:
+                    summary.errors.append(DocumentActionError(chunk['_id'], f'Chunk failed: {chunk.get("lastError")}'))
+            else:
+                summary.numProcessed += chunk.get('numProcessed', 0)
+                summary.numFailed += chunk.get('numFailed', 0)
+                for error in chunk.get('errors', []):
+                    if len(summary.errors) < DocumentActionSummary.maxRecordedErrors:
+                        summary.errors.append(DocumentActionError(chunk['_id'], error))
+
+        summary.finish()
+        return summary
+
+    def deleteJob(self, jobId: str):
+        self.collection.delete_many({'jobId': jobId})
+
+class DistributedDocumentActionWorker(object):
+    """
+    Processes chunks of distributed document action jobs. Every host process that should take part in distributed jobs runs a worker,
+    usually started by HostProcessController.startDistributedDocumentActionWorker.
+    If a HostProcessController is given, the running worker requeues the chunks of host processes immediately when the controller
+    removes them instead of after their lease expired. Host processes that were never discovered only lose their chunks by lease expiration.
+
+    The progress of a chunk is checkpointed with every lease renewal and when the chunk fails. A requeued chunk is resumed after the 
+    last checkpointed document, so only the documents processed after the last checkpoint of a crashed host process are processed again.
+    """
+    def __init__(self, dbManager: MongoDBManager, actionManager: ActionManager, documentFilterManager: DocumentFilterManager,
+                 hostProcessController = None, workQueue: DocumentChunkWorkQueue = None) -> None:
+        super().__init__()
+
+        self.dbManager = dbManager
+        self.actionManager = actionManager
+        self.documentFilterManager = documentFilterManager
+        self.hostProcessController = hostProcessController
+        self.workQueue = workQueue if workQueue != None else DocumentChunkWorkQueue(dbManager)
+        self.isRunning = True
+        self.pollingIntervalInSeconds = 2.0
+        self.checkpointIntervalInSeconds = 10.0
+
+    @property
+    def hostProcessId(self) -> str:
+        if self.hostProcessController:
+            return self.hostProcessController.thisHost.hostProcessId
+
+        return f'{socket.gethostname()}_{os.getpid()}'
+
+    def onHostProcessRemoved(self, hostname: str, pid: int):
+        hostProcessId = self.hostProcessController.getHostProcessId(hostname, pid)
+        try:
+            self.workQueue.requeueChunksOfHostProcess(hostProcessId)
+        except Exception as e:
+            logger.error(f'Failed to requeue the chunks of host process {hostProcessId}: {str(e)}')
+
+    def run(self):
+        if self.hostProcessController:
+            self.hostProcessController.onHostProcessRemovedEvent.subscribe(self.onHostProcessRemoved)
+
+        while self.isRunning:
+            try:
+                self.workQueue.requeueAbandonedChunks()
+                self.processAvailableChunks()
+            except Exception as e:
+                logger.error(f'Distributed document action worker failed with exception: {str(e)}')
+
+            time.sleep(self.pollingIntervalInSeconds)
+
+        if self.hostProcessController:
+            self.hostProcessController.onHostProcessRemovedEvent.unsubscribe(self.onHostProcessRemoved)
+
+    def shutdown(self):
+        self.isRunning = False
+
+    def processAvailableChunks(self, jobId: str = None) -> int:
+        """Claims and processes chunks (of the given job if specified) until none are left. Returns the number of processed chunks.
+        """
+        processedChunkCount = 0
+        while self.isRunning:
+            chunk = self.workQueue.claim(self.hostProcessId, jobId)
+            if chunk == None:
+                break
+
+            progress = ChunkProgress(chunk)
+            try:
+                summary = self.processChunk(chunk, progress)
+                self.workQueue.complete(chunk, summary, progress)
+            except Exception as e:
+                logger.error(f'Chunk {chunk["_id"]} failed with exception: {str(e)}')
+                self.workQueue.fail(chunk, str(e), progress)
+
+            processedChunkCount += 1
+
+        return processedChunkCount
+
+    def processChunk(self, chunk: dict, progress: ChunkProgress = None) -> DocumentActionSummary:
+        """Processes the documents of the chunk in _id order, starting after the last processed document of progress.
+        The returned summary only contains the documents of this attempt, progress is advanced by every processed document.
+        """
+        if progress == None:
+            progress = ChunkProgress(chunk)
+
+        action = self.actionManager.getActionById(chunk['actionId'])
+        if action is None:
+            raise RuntimeError(f'Unknown actionId: {chunk["actionId"]}')
+
+        collectionName = chunk['collection']
+        settings = chunk.get('settings', {})
+        idRange = {'$gt': progress.resumeAfterId} if progress.hasStarted else {'$gte': chunk['minId']}
+        idRange['$lte'] = chunk['maxId']
+        documentFilter = {'$and': [self.documentFilterManager.stringToFilter(chunk['documentFilter']), {'_id': idRange}]}
+
+        customPythonFilters = []
+        for filterDict in settings.get('customDocumentFilters') or []:
+            customPythonFilters.append(self.documentFilterManager.createFilterFromDict(filterDict, [collectionName]))
+
+        filters = self.documentFilterManager.getCollectionFilters(collectionName, customPythonFilters)
+        projection = self.documentFilterManager.getProjection(settings.get('projection', action.requiredFields), filters)
+        documents = self.documentFilterManager.yieldFilteredDocuments(collectionName, documentFilter, '', filters, False, projection, settings.get('batchSize'),
+                                                                      sort=[('_id', pymongo.ASCENDING)])
+
+        executor = DocumentActionExecutor(action, settings.get('maxWorkers', 1), settings.get('useProcessPool', False), settings.get('maxInFlight'))
+        renewalIntervalInSeconds = min(self.checkpointIntervalInSeconds, self.workQueue.getLeaseDurationInSeconds(chunk) / 3.0)
+
+        # Keep the lease alive and checkpoint the progress between documents of long running chunks:
+        def yieldDocumentsWithLeaseRenewal():
+            lastRenewalTime = time.time()
+            for document in documents:
+                if time.time() - lastRenewalTime > renewalIntervalInSeconds:
+                    if not self.workQueue.renewLease(chunk, progress):
+                        # Another worker may process the chunk now, stop before submitting more documents:
+                        raise RuntimeError(f'The lease of chunk {chunk["_id"]} was lost.')
+
+                    lastRenewalTime = time.time()
+
+                progress.onDocumentSubmitted(document['_id'])
+                yield document
+
+        return executor.execute(yieldDocumentsWithLeaseRenewal(), onDocumentProcessed=progress.onDocumentProcessed)
@@ -0,0 +1,167 @@
+from MetadataManagerCore.actions.DocumentAction import DocumentAction
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+from typing import Callable, Iterable, List
+import traceback
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# The action executed by the current worker process of a process pool. Set once per worker by the pool initializer.
+_workerAction: DocumentAction = None
+
+def _initializeWorker(action: DocumentAction):
+    global _workerAction
+    _workerAction = action
+
+def _executeInWorker(document: dict):
+    _workerAction.execute(document)
+
+class DocumentActionError(object):
+    def __init__(self, documentId, message: str, tracebackString: str = None) -> None:
+        super().__init__()
+
+        self.documentId = documentId
+        self.message = message
+        self.traceback = tracebackString
+
+    def __str__(self):
+        return f'{self.documentId}: {self.message}'
+
+class DocumentActionSummary(object):
+    # Only the first errors are kept to bound the memory of huge failing tasks:
+    maxRecordedErrors = 100
+
+    def __init__(self, actionId: str) -> None:
+        super().__init__()
+
+        self.actionId = actionId
+        self.numProcessed = 0
+        self.numFailed = 0
+        self.errors: List[DocumentActionError] = []
+        self.startTime = time.time()
+        self.durationInSeconds = 0.0
+
+    @property
+    def numSucceeded(self):
+        return self.numProcessed - self.numFailed
+
+    def addError(self, error: DocumentActionError):
+        self.numFailed += 1
+        if len(self.errors) < DocumentActionSummary.maxRecordedErrors:
+            self.errors.append(error)
+
+    def finish(self):
+        self.durationInSeconds = time.time() - self.startTime
+
+    def __str__(self):
+        summary = f'{self.actionId}: {self.numSucceeded}/{self.numProcessed} documents succeeded in {self.durationInSeconds:.1f}s.'
+        if self.numFailed > 0:
+            summary += f' {self.numFailed} failed:\n' + '\n'.join(str(e) for e in self.errors)
+            if self.numFailed > len(self.errors):
+                summary += f'\n... and {self.numFailed - len(self.errors)} more.'
+
+        return summary
+
+class DocumentActionExecutor(object):
+    """
+    Executes a document action for a stream of documents.
+
+    With maxWorkers <= 1 the documents are processed one after another and the first exception aborts the execution.
+    Otherwise the documents are processed by a thread pool (or a process pool if useProcessPool is true) with at most maxInFlight
+    submitted documents at a time. In this mode exceptions are recorded per document and reported in the returned summary.
+    The action must declare that it supports the requested mode (DocumentAction.isThreadSafe/isProcessSafe), 
+    otherwise it is executed sequentially.
+    """
+    def __init__(self, action: DocumentAction, maxWorkers: int = 1, useProcessPool = False, maxInFlight: int = None) -> None:
+        super().__init__()
+
+        self.action = action
+        self.maxWorkers = maxWorkers if maxWorkers != None else 1
+        self.useProcessPool = useProcessPool
+        self.maxInFlight = maxInFlight if maxInFlight != None else 4 * self.maxWorkers
+        self.progressUpdateStep = 0.01
+
+        if self.maxWorkers > 1:
+            if self.useProcessPool and not action.isProcessSafe:
+                logger.warning(f'The action {action.id} does not support process pool execution. Executing sequentially.')
+                self.maxWorkers = 1
+            elif not self.useProcessPool and not action.isThreadSafe:
+                logger.warning(f'The action {action.id} is not thread-safe. Executing sequentially.')
+                self.maxWorkers = 1
+
+    @property
+    def concurrent(self):
+        return self.maxWorkers > 1
+
+    def execute(self, documents: Iterable[dict], totalCount: int = None, onDocumentProcessed: Callable[[object, bool], None] = None) -> DocumentActionSummary:
+        """Executes the action for all documents. totalCount is used for progress updates if specified (may be an upper bound).
+        onDocumentProcessed is called with the _id of every processed document and whether the action failed for it.
+        In concurrent mode the calls are not in document order.
+        """
+        summary = DocumentActionSummary(self.action.id)
+        self.lastReportedProgress = 0.0
+
+        if self.concurrent:
+            self.executeConcurrently(documents, totalCount, summary, onDocumentProcessed)
+        else:
+            for document in documents:
+                self.action.execute(document)
+                summary.numProcessed += 1
+                if onDocumentProcessed:
+                    onDocumentProcessed(document.get('_id') if isinstance(document, dict) else None, False)
+
+                self.reportProgress(summary, totalCount)
+
+        summary.finish()
+        if totalCount:
+            self.action.updateProgress(1.0, f'{summary.numProcessed} documents processed.')
+
+        return summary
+
+    def executeConcurrently(self, documents: Iterable[dict], totalCount: int, summary: DocumentActionSummary, onDocumentProcessed: Callable[[object, bool], None] = None):
+        if self.useProcessPool:
+            executor = ProcessPoolExecutor(max_workers=self.maxWorkers, initializer=_initializeWorker, initargs=(self.action,))
+            executeFunction = _executeInWorker
+        else:
+            executor = ThreadPoolExecutor(max_workers=self.maxWorkers)
+            executeFunction = self.action.execute
+
+        futureToDocumentId = dict()
+
+        def collect(doneFutures):
+            for future in doneFutures:
+                documentId = futureToDocumentId.pop(future)
+                summary.numProcessed += 1
+                exception = future.exception()
+                if exception != None:
+                    tracebackString = ''.join(traceback.format_exception(type(exception), exception, exception.__traceback__))
+                    summary.addError(DocumentActionError(documentId, str(exception), tracebackString))
+                    logger.error(f'Action {self.action.id} failed for document {documentId}: {str(exception)}')
+
+                if onDocumentProcessed:
+                    onDocumentProcessed(documentId, exception != None)
+
+            self.reportProgress(summary, totalCount)
+
+        with executor:
+            for document in documents:
+                # Bound the number of submitted documents to keep memory constant:
+                if len(futureToDocumentId) >= self.maxInFlight:
+                    done, _ = wait(futureToDocumentId.keys(), return_when=FIRST_COMPLETED)
+                    collect(done)
+
+                future = executor.submit(executeFunction, document)
+                futureToDocumentId[future] = document.get('_id') if isinstance(document, dict) else None
+
+            done, _ = wait(futureToDocumentId.keys())
+            collect(done)
+
+    def reportProgress(self, summary: DocumentActionSummary, totalCount: int):
+        if not totalCount:
+            return
+
+        progress = min(summary.numProcessed / totalCount, 1.0)
+        if progress - self.lastReportedProgress >= self.progressUpdateStep:
+            self.lastReportedProgress = progress
+            self.action.updateProgress(progress, f'{summary.numProcessed}/{totalCount} documents processed.')
@@ -1,19 +1,23 @@
 from MetadataManagerCore.filtering.DocumentFilter import DocumentFilter
 from MetadataManagerCore.filtering.DocumentFilterManager import DocumentFilterManager
 from MetadataManagerCore.task_processor.DataRetrievalType import DataRetrievalType
+from MetadataManagerCore.task_processor.DocumentActionExecutor import DocumentActionExecutor
 from MetadataManagerCore.task_processor.Task import Task
 from MetadataManagerCore.actions.ActionManager import ActionManager
 from MetadataManagerCore.filtering.DocumentFilterManager import DocumentFilterManager
+from MetadataManagerCore.task_processor.DistributedDocumentAction import DocumentChunkWorkQueue, DistributedDocumentActionWorker
+import time
 import logging
 
 logger = logging.getLogger(__name__)
 
 class DocumentActionTask(Task):
-    def __init__(self, actionManager : ActionManager, documentFilterManager : DocumentFilterManager):
+    def __init__(self, actionManager : ActionManager, documentFilterManager : DocumentFilterManager, hostProcessController = None):
         super().__init__()
 
         self.actionManager = actionManager
         self.documentFilterManager = documentFilterManager
+        self.hostProcessController = hostProcessController
 
     def getEntryVerified(self, dataDict, key):
         value = dataDict.get(key)
@@ -38,33 +42,87 @@ class DocumentActionTask(Task):
             collectionNames = self.getEntryVerified(dataDict, 'collections')
             documentFilterString = self.getEntryVerified(dataDict, 'documentFilter')
             distinctionFilterString = self.getEntryVerified(dataDict, 'distinctionFilter')
+            serverSideDistinction = dataDict.get('serverSideDistinction', False)
 
             customPythonFilterDicts = dataDict.get('customDocumentFilters', [])
-            if customPythonFilterDicts != None:
+            if customPythonFilterDicts == None:
                 customPythonFilterDicts = []
 
+            # Optional retrieval settings. If no projection is specified, it is derived from the fields the action declares.
+            requiredFields = dataDict.get('projection', action.requiredFields)
+            batchSize = dataDict.get('batchSize')
+
             customPythonFilters = []
             for filterDict in customPythonFilterDicts:
-                uniqueLabel = filterDict['uniqueFilterLabel']
-                documentFilter = self.documentFilterManager.getFilterFromLabel(uniqueLabel, collectionNames)
-                documentFilter.setFromDict(filterDict)
-                customPythonFilters.append(documentFilter)
+                customPythonFilters.append(self.documentFilterManager.createFilterFromDict(filterDict, collectionNames))
 
             if collectionNames and documentFilterString:
                 if len(collectionNames) == 0:
                     raise RuntimeError("No collections were specified.")
 
+                if dataDict.get('distributed', False):
+                    summary = self.executeDistributed(action, collectionNames, documentFilterString, distinctionFilterString, dataDict)
+                    self.checkSummary(summary)
+                    return
+
                 documentFilter = self.documentFilterManager.stringToFilter(documentFilterString)
-                numDocumentsProcessed = 0
 
-                for collectionName in collectionNames:
-                    for document in self.documentFilterManager.yieldFilteredDocuments(collectionName, documentFilter, distinctionFilterString, customPythonFilters):
-                        numDocumentsProcessed += 1
-                        action.execute(document)
-                
-                if numDocumentsProcessed == 0:
-                    raise RuntimeError("No documents were processed.")
+                # Optional concurrent execution:
+                executor = DocumentActionExecutor(action, dataDict.get('maxWorkers', 1), dataDict.get('useProcessPool', False), dataDict.get('maxInFlight'))
+                totalCount = None
+                if executor.concurrent:
+                    # Upper bound because the python filters and the distinction are not considered:
+                    totalCount = sum(self.documentFilterManager.dbManager.db[collectionName].count_documents(documentFilter) for collectionName in collectionNames)
+
+                def yieldDocuments():
+                    for collectionName in collectionNames:
+                        filters = self.documentFilterManager.getCollectionFilters(collectionName, customPythonFilters)
+                        projection = self.documentFilterManager.getProjection(requiredFields, filters)
+                        yield from self.documentFilterManager.yieldFilteredDocuments(collectionName, documentFilter, distinctionFilterString, filters, 
+                                                                                     serverSideDistinction, projection, batchSize)
+
+                summary = executor.execute(yieldDocuments(), totalCount)
+                self.checkSummary(summary)
 
         elif dataRetrievalType == DataRetrievalType.UseSubmittedData:
             submittedData = dataDict.get('submittedData')
-            action.execute(submittedData)
\ No newline at end of file
+            action.execute(submittedData)
+
+    def checkSummary(self, summary):
+        logger.info(str(summary))
+        
+        if summary.numProcessed == 0:
+            raise RuntimeError("No documents were processed.")
+
+        if summary.numFailed > 0:
+            raise RuntimeError(str(summary))
+
+    def executeDistributed(self, action, collectionNames, documentFilterString: str, distinctionFilterString: str, dataDict: dict):
+        """
+        Splits the filtered documents into _id-range chunks that are processed by the DistributedDocumentActionWorkers of all host processes.
+        This process takes part in the processing and waits until all chunks are finished.
+        """
+        if distinctionFilterString:
+            raise RuntimeError("A distinction filter can't be used in distributed mode because chunks are processed independently.")
+
+        workQueue = DocumentChunkWorkQueue(self.documentFilterManager.dbManager, leaseDurationInSeconds=dataDict.get('leaseDurationInSeconds', 120.0))
+        worker = DistributedDocumentActionWorker(self.documentFilterManager.dbManager, self.actionManager, self.documentFilterManager, 
+                                                 self.hostProcessController, workQueue)
+
+        settingKeys = ['customDocumentFilters', 'projection', 'batchSize', 'maxWorkers', 'useProcessPool', 'maxInFlight']
+        settings = {key: dataDict[key] for key in settingKeys if key in dataDict}
+        jobId = workQueue.createJob(action.id, collectionNames, documentFilterString, settings, dataDict.get('chunkSize', 1000))
+
+        try:
+            while True:
+                worker.processAvailableChunks(jobId)
+                if workQueue.isJobFinished(jobId):
+                    break
+
+                # Other host processes are still working. Take over their chunks if their leases expire:
+                time.sleep(1.0)
+                workQueue.requeueAbandonedChunks()
+
+            return workQueue.getJobSummary(jobId, action.id)
+        finally:
+            workQueue.deleteJob(jobId)
@@ -1,6 +1,7 @@
 from MetadataManagerCore.communication.socket_util import JsonSocket
 from MetadataManagerCore.task_processor.Task import Task
 from MetadataManagerCore.task_processor.TaskPicker import TaskPicker
+from MetadataManagerCore.task_processor.TaskQueue import TaskQueue, TaskQueueRunner, TaskQueueStatistics
 import socket
 import logging
 import json
@@ -13,25 +14,81 @@ class TaskProcessor(JsonSocket):
         self.logger = logging.getLogger(__name__)
         self.taskPickers: typing.List[TaskPicker] = []
 
+        # Settings of the asyncio server mode (runAsyncServer):
+        self.asyncMode = False
+        self.maxConnections = 100
+        self.maxConcurrentTasks = 4
+
+        # If set, submitted tasks are persisted in the queue and executed by its workers:
+        self.taskQueueRunner: TaskQueueRunner = None
+
     def addTaskPicker(self, taskPicker : TaskPicker):
         self.taskPickers.append(taskPicker)
 
     def removeTaskPicker(self, taskPicker : TaskPicker):
         self.taskPickers.remove(taskPicker)
 
+    def setTaskQueue(self, taskQueue: TaskQueue, concurrency: int = None):
+        """
+        Persists all submitted tasks in the given queue before they are executed by concurrency worker threads.
+        Failed tasks are retried with exponential backoff. If concurrency is None, maxConcurrentTasks is used.
+        """
+        if self.taskQueueRunner:
+            self.taskQueueRunner.stop()
+            self.taskQueueRunner.taskQueue.close()
+
+        self.taskQueueRunner = TaskQueueRunner(taskQueue, self.processTask, concurrency if concurrency != None else self.maxConcurrentTasks)
+        self.taskQueueRunner.start()
+
+    @property
+    def taskQueueStatistics(self) -> TaskQueueStatistics:
+        """
+        Returns the throughput, latency and counts of the task queue or None if no queue is used.
+        """
+        return self.taskQueueRunner.statistics if self.taskQueueRunner else None
+
+    def submitTask(self, taskDataDictionary: dict) -> str:
+        """
+        Enqueues the task if a task queue is used and returns its id. Otherwise the task is processed immediately and None is returned.
+        """
+        if self.taskQueueRunner:
+            return self.taskQueueRunner.submit(taskDataDictionary)
+
+        self.processTask(taskDataDictionary)
+        return None
+
+    def run(self, port, host = None, numConnections=1):
+        """
+        Serves task requests until close() is called, either with the asyncio server or the blocking thread pool server.
+        """
+        if self.asyncMode:
+            self.runAsyncServer(port, host, maxConnections=self.maxConnections, maxConcurrentRequests=self.maxConcurrentTasks)
+        else:
+            self.connectServer(port, host, numConnections)
+            self.runServer()
+
     def handleClientSocket(self, clientSocket : socket.socket, address, dataDictionary : dict):
+        self.handleClientData(address, dataDictionary)
+
+    def handleClientData(self, address, dataDictionary : dict):
         self.logger.info(f"Handling client socket with address {address} and data {str(dataDictionary)}")
         try:
-            self.processTask(dataDictionary)
+            self.submitTask(dataDictionary)
         except Exception as e:
             self.logger.error(f"Failed to process the task from {address}. Reason: {str(e)}")
 
+    def handleRequest(self, address, dataDictionary : dict):
+        self.logger.debug(f"Handling request from address {address} and data {str(dataDictionary)}")
+
+        # The response of queued tasks is sent once the task is persisted and contains the task id:
+        return self.submitTask(dataDictionary)
+
     def processTaskFromJsonFile(self, jsonFilePath : str):
         self.logger.info(f"Processing task request from json file: {jsonFilePath}")
         try:
             with open(jsonFilePath, mode='r') as f:
                 taskDataDictionary = json.load(f)
-                self.processTask(taskDataDictionary)
+                self.submitTask(taskDataDictionary)
         except Exception as e:
             self.logger.error(f"Failed to process the task from {jsonFilePath}. Reason: {str(e)}")
             self.logger.error(traceback.format_exc())
@@ -57,6 +114,13 @@ class TaskProcessor(JsonSocket):
         else:
             raise RuntimeError(f"No taskType was specified.")
         
+    def close(self):
+        super().close()
+
+        if self.taskQueueRunner:
+            self.taskQueueRunner.stop()
+            self.taskQueueRunner.taskQueue.close()
+
     def save(self, settings, dbManager):
         """
         Serializes the state in settings and/or in the database.
@@ -66,6 +130,9 @@ class TaskProcessor(JsonSocket):
             - dbManager: MongoDBManager
         """
         settings.setValue('task_processor_socket_timeout', self.timeout)
+        settings.setValue('task_processor_async_mode', self.asyncMode)
+        settings.setValue('task_processor_max_connections', self.maxConnections)
+        settings.setValue('task_processor_max_concurrent_tasks', self.maxConcurrentTasks)
 
     def load(self, settings, dbManager):
         """
@@ -80,4 +147,16 @@ class TaskProcessor(JsonSocket):
             self.timeout = timeout
 
             if self.sock:
-                self.sock.settimeout(self.timeout)
\ No newline at end of file
+                self.sock.settimeout(self.timeout)
+
+        asyncMode = settings.value('task_processor_async_mode')
+        if asyncMode != None:
+            self.asyncMode = asyncMode in (True, 'true', 'True', 1)
+
+        maxConnections = settings.value('task_processor_max_connections')
+        if maxConnections:
+            self.maxConnections = int(maxConnections)
+
+        maxConcurrentTasks = settings.value('task_processor_max_concurrent_tasks')
+        if maxConcurrentTasks:
+            self.maxConcurrentTasks = int(maxConcurrentTasks)
\ No newline at end of file
@@ -0,0 +1,584 @@
+from MetadataManagerCore.mongodb_manager import MongoDBManager
+from MetadataManagerCore import Keys
+from abc import ABCMeta, abstractmethod
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List
+import pymongo
+import threading
+import random
+import socket
+import heapq
+import json
+import time
+import uuid
+import os
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Optional keys of task data dictionaries:
+TASK_PRIORITY_KEY = 'taskPriority'
+TASK_MAX_ATTEMPTS_KEY = 'taskMaxAttempts'
+
+class QueuedTask(object):
+    def __init__(self, taskId: str, taskDataDictionary: dict, priority: int = 0, maxAttempts: int = 3, attempts: int = 0,
+                 enqueueTime: float = None, availableTime: float = None, lastError: str = None) -> None:
+        """
+        Args:
+            enqueueTime (float): Unix time of the submission.
+            availableTime (float): Unix time from which the task may be claimed.
+        """
+        super().__init__()
+
+        self.taskId = taskId
+        self.taskDataDictionary = taskDataDictionary
+        self.priority = priority
+        self.maxAttempts = maxAttempts
+        self.attempts = attempts
+        self.enqueueTime = enqueueTime if enqueueTime != None else time.time()
+        self.availableTime = availableTime if availableTime != None else self.enqueueTime
+        self.lastError = lastError
+
+        # Identifies the claim of the task in queues with leases:
+        self.leaseToken: str = None
+
+    @property
+    def taskType(self):
+        return self.taskDataDictionary.get('taskType')
+
+    def asDict(self) -> dict:
+        return {
+            'taskId': self.taskId,
+            'task': self.taskDataDictionary,
+            'priority': self.priority,
+            'maxAttempts': self.maxAttempts,
+            'attempts': self.attempts,
+            'enqueueTime': self.enqueueTime,
+            'availableTime': self.availableTime,
+            'lastError': self.lastError
+        }
+
+    @staticmethod
+    def fromDict(taskDict: dict):
+        return QueuedTask(taskDict.get('taskId'), taskDict.get('task'), taskDict.get('priority', 0), taskDict.get('maxAttempts', 3), taskDict.get('attempts', 0),
+                          taskDict.get('enqueueTime'), taskDict.get('availableTime'), taskDict.get('lastError'))
+
+class TaskQueue(object,metaclass=ABCMeta):
+    """
+    Interface of durable task queues. Tasks are claimed by priority (higher first) and submission order.
+    A claimed task must be completed or failed. Tasks that were claimed when the process crashed are claimed again after a restart,
+    so tasks are executed at least once.
+    """
+    # Queues with leases require claimed tasks to be renewed within this duration.
+    leaseDurationInSeconds: float = None
+
+    @abstractmethod
+    def put(self, taskDataDictionary: dict, priority: int = 0, maxAttempts: int = 3) -> str:
+        """Durably adds the task and returns its id.
+        """
+        ...
+
+    @abstractmethod
+    def claim(self) -> QueuedTask:
+        """Returns the next available task or None.
+        """
+        ...
+
+    @abstractmethod
+    def complete(self, task: QueuedTask):
+        ...
+
+    @abstractmethod
+    def fail(self, task: QueuedTask, error: str, retryDelayInSeconds: float):
+        """Schedules a retry after the given delay or marks the task as failed if it has no attempts left.
+        """
+        ...
+
+    def renewLease(self, task: QueuedTask):
+        """Keeps the claim of a long running task alive. Only needed by queues with leases.
+        """
+        pass
+
+    @property
+    @abstractmethod
+    def pendingCount(self) -> int:
+        ...
+
+    def close(self):
+        pass
+
+class LocalTaskQueue(TaskQueue):
+    """
+    A task queue of this process that is persisted in a JSON lines write-ahead log.
+    The log is replayed on construction and compacted once it mostly consists of finished tasks.
+    Claims are logged as well: A task that was running when the process ended counts the interrupted run as attempt,
+    so a task that keeps crashing the process fails after maxAttempts runs.
+    """
+    def __init__(self, walFilePath: str, syncWrites: bool = False, compactionThreshold: int = 10000) -> None:
+        """
+        Args:
+            syncWrites (bool): If True, every record is fsynced. Otherwise records survive process crashes but not necessarily power loss.
+            compactionThreshold (int): Minimum number of finished tasks in the log before it is compacted.
+        """
+        super().__init__()
+
+        self.walFilePath = walFilePath
+        self.syncWrites = syncWrites
+        self.compactionThreshold = compactionThreshold
+        self.lock = threading.Lock()
+
+        # Entries: (-priority, availableTime, sequence number, task id)
+        self.heap = []
+        self.sequence = 0
+        self.tasks: Dict[str, QueuedTask] = dict()
+        self.claimedTaskIds = set()
+        self.finishedRecordCount = 0
+
+        interruptedTasks = self.replay()
+        self.walFile = open(self.walFilePath, mode='a', encoding='utf-8')
+
+        for task in interruptedTasks:
+            self.failInterruptedTask(task)
+
+    def replay(self) -> List[QueuedTask]:
+        """Restores the unfinished tasks from the log. Returns the tasks that were claimed but not finished.
+        """
+        if not os.path.exists(self.walFilePath):
+            return []
+
+        claimedTaskIds = set()
+        with open(self.walFilePath, mode='r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    # The last record may be incomplete after a crash.
+                    logger.warning(f'Skipping a corrupt record of the task log {self.walFilePath}.')
+                    continue
+
+                operation = record.get('op')
+                taskId = record.get('taskId')
+                if operation == 'put':
+                    self.tasks[taskId] = QueuedTask.fromDict(record)
+                elif operation == 'claim':
+                    claimedTaskIds.add(taskId)
+                elif operation == 'retry':
+                    claimedTaskIds.discard(taskId)
+                    task = self.tasks.get(taskId)
+                    if task:
+                        task.attempts = record.get('attempts')
+                        task.availableTime = record.get('availableTime')
+                        task.lastError = record.get('lastError')
+                elif operation in ('done', 'failed'):
+                    claimedTaskIds.discard(taskId)
+                    self.tasks.pop(taskId, None)
+                    self.finishedRecordCount += 1
+
+        interruptedTasks = [self.tasks[taskId] for taskId in claimedTaskIds if taskId in self.tasks]
+        for task in self.tasks.values():
+            if not task.taskId in claimedTaskIds:
+                self.push(task)
+
+        if len(self.tasks) > 0:
+            logger.info(f'Recovered {len(self.tasks)} tasks from {self.walFilePath}.')
+
+        return interruptedTasks
+
+    def failInterruptedTask(self, task: QueuedTask):
+        """Counts the interrupted run of a recovered task as failed attempt. The task is retried immediately if it has attempts left.
+        """
+        logger.warning(f'Task {task.taskId} was running when the process ended.')
+        with self.lock:
+            self.claimedTaskIds.add(task.taskId)
+
+        self.fail(task, task.lastError or 'The process ended while the task was running.', 0.0)
+
+    def push(self, task: QueuedTask):
+        self.sequence += 1
+        heapq.heappush(self.heap, (-task.priority, task.availableTime, self.sequence, task.taskId))
+
+    def writeRecord(self, record: dict):
+        self.walFile.write(json.dumps(record) + '\n')
+        self.walFile.flush()
+        if self.syncWrites:
+            os.fsync(self.walFile.fileno())
+
+    def put(self, taskDataDictionary: dict, priority: int = 0, maxAttempts: int = 3) -> str:
+        task = QueuedTask(uuid.uuid4().hex, taskDataDictionary, priority, maxAttempts)
+        record = task.asDict()
+        record['op'] = 'put'
+
+        with self.lock:
+            self.writeRecord(record)
+            self.tasks[task.taskId] = task
+            self.push(task)
+
+        return task.taskId
+
+    def claim(self) -> QueuedTask:
+        with self.lock:
+            now = time.time()
+            postponed = []
+            claimedTask = None
+            while len(self.heap) > 0:
+                entry = heapq.heappop(self.heap)
+                task = self.tasks.get(entry[3])
+                if task == None or task.taskId in self.claimedTaskIds:
+                    continue
+
+                if task.availableTime > now:
+                    # Waiting for a retry. Lower priority tasks may run in the meantime.
+                    postponed.append(entry)
+                    continue
+
+                self.writeRecord({'op': 'claim', 'taskId': task.taskId})
+                self.claimedTaskIds.add(task.taskId)
+                claimedTask = task
+                break
+
+            for entry in postponed:
+                heapq.heappush(self.heap, entry)
+
+            return claimedTask
+
+    def complete(self, task: QueuedTask):
+        with self.lock:
+            self.writeRecord({'op': 'done', 'taskId': task.taskId})
+            self.finish(task)
+
+    def fail(self, task: QueuedTask, error: str, retryDelayInSeconds: float):
+        with self.lock:
+            task.attempts += 1
+            task.lastError = error
+            if task.attempts >= task.maxAttempts:
+                self.writeRecord({'op': 'failed', 'taskId': task.taskId, 'lastError': error})
+                self.finish(task)
+            else:
+                task.availableTime = time.time() + retryDelayInSeconds
+                self.writeRecord({'op': 'retry', 'taskId': task.taskId, 'attempts': task.attempts, 'availableTime': task.availableTime, 'lastError': error})
+                self.claimedTaskIds.discard(task.taskId)
+                self.push(task)
+
+    def finish(self, task: QueuedTask):
+        self.tasks.pop(task.taskId, None)
+        self.claimedTaskIds.discard(task.taskId)
+        self.finishedRecordCount += 1
+
+        if self.finishedRecordCount >= self.compactionThreshold and self.finishedRecordCount > len(self.tasks):
+            self.compact()
+
+    def compact(self):
+        """Rewrites the log with the unfinished tasks only. Must be called with the lock held.
+        """
+        tempFilePath = self.walFilePath + '.tmp'
+        with open(tempFilePath, mode='w', encoding='utf-8') as f:
+            for task in self.tasks.values():
+                record = task.asDict()
+                record['op'] = 'put'
+                f.write(json.dumps(record) + '\n')
+                if task.taskId in self.claimedTaskIds:
+                    f.write(json.dumps({'op': 'claim', 'taskId': task.taskId}) + '\n')
+
+            f.flush()
+            os.fsync(f.fileno())
+
+        self.walFile.close()
+        os.replace(tempFilePath, self.walFilePath)
+        self.walFile = open(self.walFilePath, mode='a', encoding='utf-8')
+        self.finishedRecordCount = 0
+
+    @property
+    def pendingCount(self) -> int:
+        return len(self.tasks) - len(self.claimedTaskIds)
+
+    def close(self):
+        with self.lock:
+            self.walFile.close()
+
+class MongoTaskQueue(TaskQueue):
+    """
+    A task queue shared by all task processors connected to the database.
+    Claims are leases: A claimed task becomes available to other processors again if its lease isn't renewed in time.
+    Every claim counts as attempt, so a task that keeps crashing its processor fails after maxAttempts claims.
+    Each claim has its own lease token, so only the claimer can complete, fail or renew the task.
+    """
+    def __init__(self, dbManager: MongoDBManager, collectionName: str = Keys.TASK_QUEUE_COLLECTION, leaseDurationInSeconds: float = 60.0) -> None:
+        super().__init__()
+
+        self.dbManager = dbManager
+        self.collectionName = collectionName
+        self.leaseDurationInSeconds = leaseDurationInSeconds
+        self.leaseOwner = f'{socket.gethostname()}_{os.getpid()}_{uuid.uuid4().hex[:8]}'
+
+        self.collection.create_index([('status', pymongo.ASCENDING), ('priority', pymongo.DESCENDING), ('availableTime', pymongo.ASCENDING)])
+
+    @property
+    def collection(self):
+        return self.dbManager.db[self.collectionName]
+
+    def put(self, taskDataDictionary: dict, priority: int = 0, maxAttempts: int = 3) -> str:
+        taskId = uuid.uuid4().hex
+        now = datetime.utcnow()
+        self.collection.insert_one({
+            '_id': taskId,
+            'task': taskDataDictionary,
+            'status': 'pending',
+            'priority': priority,
+            'maxAttempts': maxAttempts,
+            'attempts': 0,
+            'enqueueTime': now,
+            'availableTime': now
+        })
+
+        return taskId
+
+    def claim(self) -> QueuedTask:
+        while True:
+            now = datetime.utcnow()
+            leaseToken = uuid.uuid4().hex
+            taskDict = self.collection.find_one_and_update(
+                {'$or': [
+                    {'status': 'pending', 'availableTime': {'$lte': now}},
+                    # Tasks of processors that died or stopped renewing their lease:
+                    {'status': 'running', 'leaseExpiration': {'$lt': now}}
+                ]},
+                {'$set': {'status': 'running', 'leaseOwner': self.leaseOwner, 'leaseToken': leaseToken, 
+                          'leaseExpiration': now + timedelta(seconds=self.leaseDurationInSeconds)},
+                 '$inc': {'attempts': 1}},
+                sort=[('priority', pymongo.DESCENDING), ('availableTime', pymongo.ASCENDING)],
+                return_document=pymongo.ReturnDocument.AFTER)
+
+            if taskDict == None:
+                return None
+
+            # The stored attempts include this claim:
+            attempts = taskDict.get('attempts', 1) - 1
+            maxAttempts = taskDict.get('maxAttempts', 3)
+            if attempts >= maxAttempts:
+                # All attempts ended without completing or failing the task, e.g. because the task crashed its processors:
+                error = taskDict.get('lastError') or f'The lease of the task expired {attempts} times.'
+                self.collection.update_one({'_id': taskDict.get('_id'), 'leaseToken': leaseToken},
+                                           {'$set': {'status': 'failed', 'attempts': attempts, 'lastError': error}, 
+                                            '$unset': {'leaseOwner': '', 'leaseToken': '', 'leaseExpiration': ''}})
+                logger.error(f'Task {taskDict.get("_id")} failed after {attempts} attempts: {error}')
+                continue
+
+            task = QueuedTask(taskDict.get('_id'), taskDict.get('task'), taskDict.get('priority', 0), maxAttempts, attempts,
+                              MongoTaskQueue.toUnixTime(taskDict.get('enqueueTime')), MongoTaskQueue.toUnixTime(taskDict.get('availableTime')), 
+                              taskDict.get('lastError'))
+            task.leaseToken = leaseToken
+            return task
+
+    @staticmethod
+    def toUnixTime(utcTime: datetime) -> float:
+        return (utcTime - datetime(1970, 1, 1)).total_seconds() if utcTime else None
+
+    def complete(self, task: QueuedTask):
+        self.collection.delete_one({'_id': task.taskId, 'leaseToken': task.leaseToken})
+
+    def fail(self, task: QueuedTask, error: str, retryDelayInSeconds: float):
+        task.attempts += 1
+        task.lastError = error
+        if task.attempts >= task.maxAttempts:
+            update = {'status': 'failed', 'attempts': task.attempts, 'lastError': error}
+        else:
+            update = {'status': 'pending', 'attempts': task.attempts, 'lastError': error, 'availableTime': datetime.utcnow() + timedelta(seconds=retryDelayInSeconds)}
+
+        self.collection.update_one({'_id': task.taskId, 'leaseToken': task.leaseToken}, 
+                                   {'$set': update, '$unset': {'leaseOwner': '', 'leaseToken': '', 'leaseExpiration': ''}})
+
+    def renewLease(self, task: QueuedTask):
+        leaseExpiration = datetime.utcnow() + timedelta(seconds=self.leaseDurationInSeconds)
+        self.collection.update_one({'_id': task.taskId, 'leaseToken': task.leaseToken, 'status': 'running'}, {'$set': {'leaseExpiration': leaseExpiration}})
+
+    @property
+    def pendingCount(self) -> int:
+        return self.collection.count_documents({'status': 'pending'})
+
+class TaskQueueStatistics(object):
+    def __init__(self) -> None:
+        super().__init__()
+
+        self.submittedCount = 0
+        self.completedCount = 0
+        self.retriedCount = 0
+        self.failedCount = 0
+        self.runningCount = 0
+        self.pendingCount = 0
+
+        # Completed tasks per second since the workers were started.
+        self.throughputPerSecond = 0.0
+
+        # Time between submission and start of the last execution.
+        self.averageQueueLatencyInSeconds = 0.0
+        self.averageExecutionTimeInSeconds = 0.0
+
+    def __str__(self) -> str:
+        return (f'Submitted: {self.submittedCount}, Completed: {self.completedCount}, Retried: {self.retriedCount}, Failed: {self.failedCount}, '
+                f'Running: {self.runningCount}, Pending: {self.pendingCount}, Throughput: {self.throughputPerSecond:.2f} tasks/s, '
+                f'Queue latency: {self.averageQueueLatencyInSeconds:.3f} s, Execution time: {self.averageExecutionTimeInSeconds:.3f} s')
+
+class TaskQueueRunner(object):
+    """
+    Executes the tasks of a TaskQueue on worker threads. Failed tasks are retried with exponential backoff.
+    """
+    def __init__(self, taskQueue: TaskQueue, processTask: Callable[[dict], None], concurrency: int = 4) -> None:
+        super().__init__()
+
+        self.taskQueue = taskQueue
+        self.processTask = processTask
+        self.concurrency = concurrency
+        self.isRunning = False
+        self.idleWaitInSeconds = 0.5
+        self.retryBaseDelayInSeconds = 1.0
+        self.maxRetryDelayInSeconds = 300.0
+        self.workers: List[threading.Thread] = []
+        self.taskAvailable = threading.Event()
+
+        self.statisticsLock = threading.Lock()
+        self.startTime = None
+        self.submittedCount = 0
+        self.completedCount = 0
+        self.retriedCount = 0
+        self.failedCount = 0
+        self.runningCount = 0
+        self.averageQueueLatencyInSeconds = 0.0
+        self.averageExecutionTimeInSeconds = 0.0
+        self.smoothingFactor = 0.1
+
+    def submit(self, taskDataDictionary: dict) -> str:
+        """Durably enqueues the task and returns its id. The priority and maximum attempts are taken from the optional
+        TASK_PRIORITY_KEY and TASK_MAX_ATTEMPTS_KEY entries of the dictionary.
+        """
+        priority = int(taskDataDictionary.get(TASK_PRIORITY_KEY, 0))
+        maxAttempts = int(taskDataDictionary.get(TASK_MAX_ATTEMPTS_KEY, 3))
+        taskId = self.taskQueue.put(taskDataDictionary, priority, maxAttempts)
+
+        with self.statisticsLock:
+            self.submittedCount += 1
+
+        self.taskAvailable.set()
+        return taskId
+
+    def start(self):
+        if self.isRunning:
+            return
+
+        self.isRunning = True
+        self.startTime = time.time()
+        for i in range(self.concurrency):
+            worker = threading.Thread(target=self.runWorker, name=f'TaskQueueWorker{i}', daemon=True)
+            worker.start()
+            self.workers.append(worker)
+
+    def stop(self, wait: bool = True):
+        self.isRunning = False
+        self.taskAvailable.set()
+
+        if wait:
+            for worker in self.workers:
+                worker.join()
+
+        self.workers = []
+
+    def getRetryDelayInSeconds(self, attempts: int) -> float:
+        delay = min(self.retryBaseDelayInSeconds * (2 ** max(attempts - 1, 0)), self.maxRetryDelayInSeconds)
+        return delay * random.uniform(0.8, 1.2)
+
+    def runWorker(self):
+        while self.isRunning:
+            try:
+                task = self.taskQueue.claim()
+            except Exception as e:
+                logger.error(f'Failed to claim a task: {str(e)}')
+                task = None
+
+            if task == None:
+                self.taskAvailable.wait(self.idleWaitInSeconds)
+                self.taskAvailable.clear()
+                continue
+
+            self.executeTask(task)
+
+    def executeTask(self, task: QueuedTask):
+        tStart = time.time()
+        with self.statisticsLock:
+            self.runningCount += 1
+            self.averageQueueLatencyInSeconds = self.smooth(self.averageQueueLatencyInSeconds, tStart - task.availableTime)
+
+        leaseRenewal = self.startLeaseRenewal(task)
+        try:
+            self.processTask(task.taskDataDictionary)
+            error = None
+        except Exception as e:
+            error = str(e)
+        finally:
+            leaseRenewal.set()
+
+        with self.statisticsLock:
+            self.runningCount -= 1
+            self.averageExecutionTimeInSeconds = self.smooth(self.averageExecutionTimeInSeconds, time.time() - tStart)
+
+        try:
+            if error == None:
+                self.taskQueue.complete(task)
+                with self.statisticsLock:
+                    self.completedCount += 1
+            else:
+                willRetry = task.attempts + 1 < task.maxAttempts
+                self.taskQueue.fail(task, error, self.getRetryDelayInSeconds(task.attempts + 1))
+                with self.statisticsLock:
+                    if willRetry:
+                        self.retriedCount += 1
+                    else:
+                        self.failedCount += 1
+
+                if willRetry:
+                    logger.warning(f'Task {task.taskId} ({task.taskType}) failed and will be retried: {error}')
+                else:
+                    logger.error(f'Task {task.taskId} ({task.taskType}) failed after {task.attempts} attempts: {error}')
+        except Exception as e:
+            logger.error(f'Failed to update the state of task {task.taskId}: {str(e)}')
+
+    def startLeaseRenewal(self, task: QueuedTask) -> threading.Event:
+        """Renews the lease of the task until the returned event is set. Only used by queues with leases.
+        """
+        finished = threading.Event()
+        leaseDurationInSeconds = self.taskQueue.leaseDurationInSeconds
+        if leaseDurationInSeconds == None:
+            return finished
+
+        def renew():
+            while not finished.wait(leaseDurationInSeconds / 3.0):
+                try:
+                    self.taskQueue.renewLease(task)
+                except Exception as e:
+                    logger.error(f'Failed to renew the lease of task {task.taskId}: {str(e)}')
+
+        threading.Thread(target=renew, name=f'TaskLease{task.taskId}', daemon=True).start()
+        return finished
+
+    def smooth(self, average: float, value: float) -> float:
+        return (1.0 - self.smoothingFactor) * average + self.smoothingFactor * value
+
+    @property
+    def statistics(self) -> TaskQueueStatistics:
+        statistics = TaskQueueStatistics()
+        with self.statisticsLock:
+            statistics.submittedCount = self.submittedCount
+            statistics.completedCount = self.completedCount
+            statistics.retriedCount = self.retriedCount
+            statistics.failedCount = self.failedCount
+            statistics.runningCount = self.runningCount
+            statistics.averageQueueLatencyInSeconds = self.averageQueueLatencyInSeconds
+            statistics.averageExecutionTimeInSeconds = self.averageExecutionTimeInSeconds
+
+        if self.startTime != None:
+            statistics.throughputPerSecond = statistics.completedCount / max(time.time() - self.startTime, 1e-6)
+
+        try:
+            statistics.pendingCount = self.taskQueue.pendingCount
+        except Exception as e:
+            logger.error(f'Failed to count the pending tasks: {str(e)}')
+
+        return statistics
@@ -0,0 +1,327 @@
+"""
+Delta versioning of documents in the <collection>_old_versions collections.
+
+Every modification moves the previous version of a document to the versions collection. With a snapshot interval of 1 the full
+previous document is stored. With a snapshot interval N > 1 only versions that are a multiple of N are stored as full snapshots.
+All other versions are stored as reverse patch: the changes that turn the next version back into the stored version.
+Entries without a patch are full snapshots, so collections written with full copies stay readable.
+
+A version is reconstructed by applying the reverse patches from the next snapshot (or the live document) down to the requested version.
+
+Existing versions collections can be compacted with:
+    python -m MetadataManagerCore.versioning.document_versioning mongodbUrl databaseName snapshotInterval [collectionNames...]
+"""
+from MetadataManagerCore import Keys
+from pymongo import ReplaceOne
+from typing import Dict, List
+import pymongo
+import bson
+import queue
+import threading
+import time
+import logging
+
+logger = logging.getLogger(__name__)
+
+# Key of the reverse patch of delta entries: {'set': {key: previous value}, 'unset': [keys added by the next version]}
+DELTA_KEY = 's_delta'
+
+# Keys that differ between all versions and are derived from sid and version:
+DERIVED_KEYS = set(['_id', Keys.systemVersionKey])
+
+# Number of version entries fetched at once during reconstruction:
+RECONSTRUCTION_BATCH_SIZE = 64
+
+def getVersionId(sid: str, version: int) -> str:
+    return sid + "_" + str(version)
+
+def isDeltaEntry(versionEntry: dict) -> bool:
+    return DELTA_KEY in versionEntry
+
+def createReversePatch(previousDocument: dict, nextDocument: dict) -> dict:
+    """
+    Returns the patch that turns nextDocument back into previousDocument.
+    """
+    setEntries = dict()
+    unsetKeys = []
+    for key, val in nextDocument.items():
+        if key in DERIVED_KEYS:
+            continue
+
+        if not key in previousDocument:
+            unsetKeys.append(key)
+        elif previousDocument[key] != val:
+            setEntries[key] = previousDocument[key]
+
+    for key, val in previousDocument.items():
+        if not key in DERIVED_KEYS and not key in nextDocument:
+            setEntries[key] = val
+
+    return {'set': setEntries, 'unset': unsetKeys}
+
+def applyReversePatch(nextDocument: dict, patch: dict, sid: str, version: int) -> dict:
+    """
+    Returns a new document of the given version by applying the reverse patch to the document of the next version.
+    """
+    document = dict(nextDocument)
+    for key in patch.get('unset', []):
+        document.pop(key, None)
+
+    document.update(patch.get('set', dict()))
+    document['_id'] = getVersionId(sid, version)
+    document[Keys.systemVersionKey] = version
+    return document
+
+def createVersionEntry(previousDocument: dict, nextDocument: dict, snapshotInterval: int = 1) -> dict:
+    """
+    Returns the versions collection entry of previousDocument which is replaced by nextDocument:
+    A full snapshot if the version is a multiple of snapshotInterval, otherwise a reverse patch.
+    """
+    version = previousDocument[Keys.systemVersionKey]
+    versionId = getVersionId(previousDocument[Keys.systemIDKey], version)
+    if snapshotInterval == None or snapshotInterval <= 1 or version % snapshotInterval == 0:
+        if previousDocument['_id'] == versionId:
+            return previousDocument
+
+        # Live documents with a stable _id (see AtomicDocumentOperation):
+        snapshot = dict(previousDocument)
+        snapshot['_id'] = versionId
+        return snapshot
+
+    return {
+        '_id': versionId,
+        Keys.systemIDKey: previousDocument[Keys.systemIDKey],
+        Keys.systemVersionKey: version,
+        DELTA_KEY: createReversePatch(previousDocument, nextDocument)
+    }
+
+def reconstructVersion(database, collectionName: str, sid: str, version: int) -> dict:
+    """
+    Returns the document with the given sid as it was at the given version or None if the version doesn't exist.
+    """
+    liveDocument = database[collectionName].find_one({Keys.systemIDKey: sid})
+    if liveDocument != None and liveDocument[Keys.systemVersionKey] == version:
+        return liveDocument
+
+    liveVersion = liveDocument[Keys.systemVersionKey] if liveDocument != None else None
+    if liveVersion != None and version > liveVersion:
+        return None
+
+    versionCollection = database[collectionName + Keys.OLD_VERSIONS_COLLECTION_SUFFIX]
+
+    # Collect the patches up to the next snapshot. Entries are fetched by _id to use the primary index:
+    patches: List[dict] = []
+    baseDocument = None
+    nextVersion = version
+    while baseDocument == None:
+        lastVersion = nextVersion + RECONSTRUCTION_BATCH_SIZE
+        if liveVersion != None:
+            lastVersion = min(lastVersion, liveVersion)
+
+        ids = [getVersionId(sid, v) for v in range(nextVersion, lastVersion)]
+        entries = {entry[Keys.systemVersionKey]: entry for entry in versionCollection.find({'_id': {'$in': ids}})} if len(ids) > 0 else dict()
+
+        for v in range(nextVersion, lastVersion):
+            entry = entries.get(v)
+            if entry == None:
+                if v == version:
+                    return None
+
+                logger.error(f"Failed to reconstruct version {version} of {sid}: Version {v} is missing.")
+                return None
+
+            if isDeltaEntry(entry):
+                patches.append(entry[DELTA_KEY])
+            else:
+                baseDocument = entry
+                break
+
+        if baseDocument == None and lastVersion == liveVersion:
+            baseDocument = liveDocument
+
+        nextVersion = lastVersion
+
+    document = baseDocument
+    baseVersion = baseDocument[Keys.systemVersionKey]
+    for i in range(len(patches) - 1, -1, -1):
+        baseVersion -= 1
+        document = applyReversePatch(document, patches[i], sid, baseVersion)
+
+    return document
+
+class VersionHistoryWriter(object):
+    """
+    Writes version entries to the versions collections on a background thread.
+    Pending entries are batched into one unordered bulk write per collection.
+    Entries that are still queued when the process dies are lost, call flush() where the history must be complete.
+    """
+    def __init__(self, database, maxBatchSize: int = 1000) -> None:
+        super().__init__()
+
+        self.database = database
+        self.maxBatchSize = maxBatchSize
+        self.queue = queue.Queue()
+        self.isRunning = True
+        self.thread = threading.Thread(target=self.run, name='VersionHistoryWriter', daemon=True)
+        self.thread.start()
+
+    def write(self, collectionName: str, versionEntry: dict):
+        self.queue.put((collectionName, versionEntry))
+
+    def run(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.maxBatchSize:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            try:
+                self.writeBatch([item for item in batch if item != None])
+            finally:
+                for _ in batch:
+                    self.queue.task_done()
+
+            if None in batch:
+                break
+
+    def writeBatch(self, batch):
+        collectionRequests: Dict[str, List[ReplaceOne]] = dict()
+        for collectionName, versionEntry in batch:
+            collectionRequests.setdefault(collectionName, []).append(ReplaceOne({'_id': versionEntry['_id']}, versionEntry, upsert=True))
+
+        for collectionName, requests in collectionRequests.items():
+            try:
+                self.database[collectionName + Keys.OLD_VERSIONS_COLLECTION_SUFFIX].bulk_write(requests, ordered=False)
+            except Exception as e:
+                logger.error(f"Failed to write {len(requests)} version entries of {collectionName}: {str(e)}")
+
+    def flush(self):
+        """Waits until all queued entries are written.
+        """
+        self.queue.join()
+
+    def shutdown(self):
+        if self.isRunning:
+            self.isRunning = False
+            self.queue.put(None)
+            self.thread.join()
+
+class VersionCompactionResult(object):
+    def __init__(self, collectionName: str) -> None:
+        super().__init__()
+
+        self.collectionName = collectionName
+        self.numSids = 0
+        self.numEntries = 0
+        self.numRewrittenEntries = 0
+        self.sizeBeforeInBytes = 0
+        self.sizeAfterInBytes = 0
+        self.startTime = time.time()
+        self.durationInSeconds = 0.0
+
+    def finish(self):
+        self.durationInSeconds = time.time() - self.startTime
+
+    def __str__(self):
+        ratio = self.sizeBeforeInBytes / self.sizeAfterInBytes if self.sizeAfterInBytes > 0 else 1.0
+        return (f'{self.collectionName}: Rewrote {self.numRewrittenEntries}/{self.numEntries} versions of {self.numSids} documents in {self.durationInSeconds:.1f}s. '
+                f'Size: {self.sizeBeforeInBytes / (1024 * 1024):.1f} MB -> {self.sizeAfterInBytes / (1024 * 1024):.1f} MB (ratio: {ratio:.1f})')
+
+def compactSidVersions(sid: str, entries: List[dict], liveDocument: dict, snapshotInterval: int, result: VersionCompactionResult) -> List[ReplaceOne]:
+    """
+    Returns the writes that convert the version entries of a sid to the layout of the given snapshot interval.
+    """
+    entries = sorted(entries, key=lambda e: e[Keys.systemVersionKey])
+
+    # Reconstruct all full versions from the newest to the oldest:
+    fullDocuments: Dict[int, dict] = dict()
+    if liveDocument != None:
+        fullDocuments[liveDocument[Keys.systemVersionKey]] = liveDocument
+
+    for entry in reversed(entries):
+        version = entry[Keys.systemVersionKey]
+        if not isDeltaEntry(entry):
+            fullDocuments[version] = entry
+        elif version + 1 in fullDocuments:
+            fullDocuments[version] = applyReversePatch(fullDocuments[version + 1], entry[DELTA_KEY], sid, version)
+        else:
+            logger.warning(f"Skipping {sid}: The successor of version {version} is missing.")
+            return []
+
+    requests = []
+    for entry in entries:
+        version = entry[Keys.systemVersionKey]
+        nextDocument = fullDocuments.get(version + 1)
+        if nextDocument == None:
+            # Without a successor the version can only be stored as snapshot:
+            newEntry = fullDocuments[version]
+        else:
+            newEntry = createVersionEntry(fullDocuments[version], nextDocument, snapshotInterval)
+
+        entrySize = len(bson.encode(entry))
+        result.numEntries += 1
+        result.sizeBeforeInBytes += entrySize
+        if isDeltaEntry(newEntry) == isDeltaEntry(entry) and (not isDeltaEntry(entry) or newEntry[DELTA_KEY] == entry[DELTA_KEY]):
+            result.sizeAfterInBytes += entrySize
+            continue
+
+        result.sizeAfterInBytes += len(bson.encode(newEntry))
+        result.numRewrittenEntries += 1
+        requests.append(ReplaceOne({'_id': entry['_id']}, newEntry))
+
+    return requests
+
+def compactVersionCollection(database, collectionName: str, snapshotInterval: int, batchSize: int = 500) -> VersionCompactionResult:
+    """
+    Converts the entries of the versions collection of the given collection to the layout of the given snapshot interval.
+    Full copies are replaced by reverse patches except for every snapshotInterval-th version. A snapshot interval of 1 expands all patches again.
+    Versions are immutable, so the compaction can run while documents are modified.
+
+    Note: Creates an index on (s_id, s_version) in the versions collection.
+    """
+    result = VersionCompactionResult(collectionName)
+    collection = database[collectionName]
+    versionCollection = database[collectionName + Keys.OLD_VERSIONS_COLLECTION_SUFFIX]
+    versionCollection.create_index([(Keys.systemIDKey, pymongo.ASCENDING), (Keys.systemVersionKey, pymongo.ASCENDING)])
+
+    sids = versionCollection.distinct(Keys.systemIDKey)
+    for i in range(0, len(sids), batchSize):
+        batchSids = sids[i:i + batchSize]
+        liveDocuments = {d[Keys.systemIDKey]: d for d in collection.find({Keys.systemIDKey: {'$in': batchSids}})}
+        sidEntries: Dict[str, List[dict]] = dict()
+        for entry in versionCollection.find({Keys.systemIDKey: {'$in': batchSids}}):
+            sidEntries.setdefault(entry[Keys.systemIDKey], []).append(entry)
+
+        requests = []
+        for sid, entries in sidEntries.items():
+            result.numSids += 1
+            requests += compactSidVersions(sid, entries, liveDocuments.get(sid), snapshotInterval, result)
+
+        if len(requests) > 0:
+            versionCollection.bulk_write(requests, ordered=False)
+
+        logger.info(f'{collectionName}: Compacted {min(i + batchSize, len(sids))}/{len(sids)} documents.')
+
+    result.finish()
+    return result
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description='Compacts the versions collections of a database.')
+    parser.add_argument('mongodbUrl')
+    parser.add_argument('databaseName')
+    parser.add_argument('snapshotInterval', type=int)
+    parser.add_argument('collectionNames', nargs='*', help='Defaults to all collections with a versions collection.')
+    args = parser.parse_args()
+
+    database = pymongo.MongoClient(args.mongodbUrl)[args.databaseName]
+    collectionNames = args.collectionNames
+    if len(collectionNames) == 0:
+        collectionNames = [cn[:-len(Keys.OLD_VERSIONS_COLLECTION_SUFFIX)] for cn in database.list_collection_names() if cn.endswith(Keys.OLD_VERSIONS_COLLECTION_SUFFIX)]
+
+    for collectionName in collectionNames:
+        print(compactVersionCollection(database, collectionName, args.snapshotInterval))